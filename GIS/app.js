@@ -113,13 +113,16 @@ var map = L.map("map", {
 });
 
 var clusterGroup = L.markerClusterGroup();
+// Clusters aggregated by the server at low zoom levels
+var aggregateLayer = L.layerGroup();
+var shipsLayer = L.layerGroup([clusterGroup, aggregateLayer]);
 
 var baseMaps = {
   GoogleSatelliteHybrid: googleHybrid,
   OpenStreetmap: osm,
 };
 
-var overlayMaps = { Ships: clusterGroup };
+var overlayMaps = { Ships: shipsLayer };
 
 var layerControl = L.control.layers(baseMaps, overlayMaps).addTo(map);
 
@@ -192,25 +195,111 @@ const url_ships = new URL(data_server_url + "ships.geojson");
 
 url_ships.search = createStringForURLParameters();
 
-function updateShips() {
+const url_clusters = new URL(data_server_url + "clusters.geojson");
+
+// Below this zoom level, the server aggregates the detections in clusters
+const SHIPS_MIN_ZOOM = 8;
+// Clusters are the tiles two zoom levels deeper, about 64 pixels wide
+const CLUSTER_ZOOM_OFFSET = 2;
+
+// Identifiers of the detections on the map, a delta never adds one twice
+var shownShips = new Set();
+
+function clearShips() {
+  clusterGroup.clearLayers();
+  aggregateLayer.clearLayers();
+  shownShips.clear();
+}
+
+function clusterIcon(count) {
+  // Same look as the clusters of Leaflet.markercluster
+  var size = "large";
+  if (count < 10) {
+    size = "small";
+  } else if (count < 100) {
+    size = "medium";
+  }
+  return L.divIcon({
+    html: "<div><span>" + addCommas(count) + "</span></div>",
+    className: "marker-cluster marker-cluster-" + size,
+    iconSize: L.point(40, 40),
+  });
+}
+
+function updateClusters() {
+  const url = new URL(url_clusters);
+  url.search = createStringForURLParameters();
+  url.searchParams.set("bbox", map.getBounds().toBBoxString());
+  url.searchParams.set(
+    "zoom",
+    (map.getZoom() + CLUSTER_ZOOM_OFFSET).toString(),
+  );
+
+  $.ajax({
+    url: url,
+    type: "GET",
+    dataType: "json",
+    success: function (data) {
+      clearShips();
+      L.geoJSON(data, {
+        pointToLayer: function (feature, latlng) {
+          const marker = L.marker(latlng, {
+            icon: clusterIcon(feature.properties.count),
+          });
+          marker.on("click", function () {
+            map.setView(latlng, map.getZoom() + CLUSTER_ZOOM_OFFSET);
+          });
+          aggregateLayer.addLayer(marker);
+          return marker;
+        },
+      });
+      map.addLayer(shipsLayer);
+    },
+    error: function (xhr, status, error) {
+      const message = JSON.parse(xhr.responseText).detail;
+      alert(message);
+    },
+  });
+}
+
+function updateShips(sinceId) {
+  // Clusters are cheap to fetch, they are always fetched whole
+  if (map.getZoom() < SHIPS_MIN_ZOOM) {
+    updateClusters();
+    return;
+  }
+
   const url = new URL(url_ships);
   url.search = createStringForURLParameters();
+  // Only query detections in the current viewport
+  url.searchParams.set("bbox", map.getBounds().toBBoxString());
+  url.searchParams.set("zoom", map.getZoom().toString());
+  // Only query detections ingested after the given one
+  if (sinceId !== undefined) {
+    url.searchParams.set("since_id", sinceId.toString());
+  }
 
   $.ajax({
     url: url,
     type: "GET",
     dataType: "json",
     success: function (data) {
-      clusterGroup.clearLayers();
+      if (sinceId === undefined) {
+        clearShips();
+      }
       L.geoJSON(data, {
+        filter: function (feature) {
+          return !shownShips.has(feature.properties.id);
+        },
         onEachFeature: onEachFeatureShips,
         pointToLayer: function (feature, latlng) {
           const marker = L.marker(latlng);
+          shownShips.add(feature.properties.id);
           clusterGroup.addLayer(marker);
           return marker;
         },
       });
-      map.addLayer(clusterGroup);
+      map.addLayer(shipsLayer);
     },
     error: function (xhr, status, error) {
       const message = JSON.parse(xhr.responseText).detail;
@@ -235,6 +324,10 @@ url_ports.search = searchString;
 
 updateShips();
 
+map.on("moveend", function () {
+  updateShips();
+});
+
 // Ports
 
 var maxOutflows = 0;
@@ -289,9 +382,12 @@ ws.onmessage = function (event) {
     return;
   }
 
-  if (event.data === "update_ships") {
-    updateShips();
-    return;
+  if (event.data.startsWith("{")) {
+    const message = JSON.parse(event.data);
+    if (message.type === "update_ships") {
+      updateShips(message.since_id);
+      return;
+    }
   }
 
   alert(event.data);
@@ -355,11 +451,10 @@ document.getElementById("export").onclick = function (e) {
     async: true,
     type: "get",
     dataType: "text",
-    data: "data_type=csv",
+    data: "data_type=csv&stream=true",
     success: function (result) {
       setButtonState(true);
-      result = result.slice(1, result.length - 1);
-      var lines = result.split("\\n");
+      var lines = result.split("\n");
       var items = [];
       var header = lines[0].split(",");
       for (var i = 1; i < lines.length; i++) {
@@ -0,0 +1,399 @@
+"""
+Micro-benchmarks of the server hot paths.
+They run on a temporary database, `detection.db` is never touched.
+
+Usage: python benchmarks.py {serialization,parsing,ingestion,concurrency}
+                             --detections 1000000
+"""
+import argparse
+import csv
+import datetime
+import json
+import random
+import statistics
+import tempfile
+import threading
+import time
+import xml.etree.ElementTree as ElementTree
+from pathlib import Path
+from typing import Callable
+from typing import Dict
+from typing import List
+
+import binary_formats
+import crud
+import numpy as np
+import result_parser
+from database import Base
+from database import create_reader_engine
+from database import create_writer_engine
+from database import STORAGE_PROFILES
+from fastapi.encoders import jsonable_encoder
+from geo_helper import BoundingBox
+from geojson import FeatureCollection
+from models import Detection
+from models import Tile
+from sqlalchemy import create_engine
+from sqlalchemy import insert
+from sqlalchemy.orm import Session
+from sqlalchemy.orm import sessionmaker
+
+DETECTIONS_PER_TILE = 5000
+START_DATE = datetime.date(2023, 1, 1)
+END_DATE = datetime.date(2023, 2, 1)
+
+
+def create_benchmark_session(directory: str) -> Session:
+    engine = create_engine("sqlite:///" + str(Path(directory) / "benchmark.db"))
+    Base.metadata.create_all(engine)
+    return sessionmaker(bind=engine)()
+
+
+def fill_detections(db: Session, number_of_detections: int):
+    random_generator = random.Random(0)
+    number_of_tiles = max(number_of_detections // DETECTIONS_PER_TILE, 1)
+
+    db.execute(
+        insert(Tile),
+        [
+            {
+                "dataset": f"TILE_{tile}",
+                "acquisition_time": datetime.datetime(2023, 1, 2)
+                + datetime.timedelta(minutes=tile),
+            }
+            for tile in range(number_of_tiles)
+        ],
+    )
+    db.execute(
+        insert(Detection),
+        [
+            {
+                "tile_dataset": f"TILE_{detection % number_of_tiles}",
+                "width": random_generator.uniform(5, 60),
+                "length": random_generator.uniform(30, 400),
+                "latitude": random_generator.uniform(-60, 60),
+                "longitude": random_generator.uniform(-180, 180),
+                "pixel_x": random_generator.randrange(25000),
+                "pixel_y": random_generator.randrange(17000),
+            }
+            for detection in range(number_of_detections)
+        ],
+    )
+    db.commit()
+
+
+def measure(
+    name: str, number_of_rows: int, function: Callable[[], object], unit: str = "rows"
+):
+    saved = time.perf_counter()
+    function()
+    elapsed = time.perf_counter() - saved
+    print(f"{name:<32} {elapsed:8.2f}s {number_of_rows / elapsed:12,.0f} {unit}/s")
+
+
+def orm_geojson(db: Session) -> str:
+    # Previous path: ORM objects, lazy-loaded tiles and FastAPI JSON encoding
+    detections = (
+        db.query(Detection)
+        .join(Tile)
+        .filter(Tile.acquisition_time > START_DATE, Tile.acquisition_time < END_DATE)
+        .all()
+    )
+    collection = FeatureCollection([det.to_geojson() for det in detections])
+    return json.dumps(jsonable_encoder(collection))
+
+
+def orm_csv(db: Session) -> str:
+    detections = (
+        db.query(Detection)
+        .join(Tile)
+        .filter(Tile.acquisition_time > START_DATE, Tile.acquisition_time < END_DATE)
+        .all()
+    )
+    lines = [detections[0].attributes_string()] + [det.to_csv() for det in detections]
+    return "\n".join(lines)
+
+
+def benchmark_serialization(number_of_detections: int):
+    with tempfile.TemporaryDirectory() as directory:
+        db = create_benchmark_session(directory)
+        fill_detections(db, number_of_detections)
+
+        for data_type, orm_function in (("geojson", orm_geojson), ("csv", orm_csv)):
+            db.expunge_all()
+            measure(
+                f"{data_type} ORM objects",
+                number_of_detections,
+                lambda: orm_function(db),
+            )
+            db.expunge_all()
+            measure(
+                f"{data_type} column projection",
+                number_of_detections,
+                lambda: crud.get_detections(db, START_DATE, END_DATE, data_type),
+            )
+
+        for data_type in binary_formats.ENCODERS:
+            if not binary_formats.is_available(data_type):
+                print(
+                    f"{data_type:<32} requires {binary_formats.REQUIRED_LIBRARIES[data_type]}"
+                )
+                continue
+            measure(
+                f"{data_type} columns",
+                number_of_detections,
+                lambda: binary_formats.encode_detections(
+                    crud.get_detection_columns(db, START_DATE, END_DATE), data_type
+                ),
+            )
+        db.close()
+
+
+def write_snap_result(directory: str, number_of_detections: int) -> Path:
+    """
+    Writes a `.dim` and a detections file shaped like the SNAP outputs.
+    """
+    random_generator = random.Random(0)
+    input_path = Path(directory) / "S1A_IW_GRDH_1SDV_BENCHMARK.zip"
+
+    metadata_attributes = {
+        "PRODUCT": "S1A_IW_GRDH_1SDV_BENCHMARK",
+        "SPH_DESCRIPTOR": "Sentinel-1 IW Level-1 GRD Product",
+        "PASS": "ASCENDING",
+        "num_output_lines": "16700",
+        "num_samples_per_line": "25500",
+        "first_line_time": "12-OCT-2022 22:48:16.866898",
+        "last_line_time": "12-OCT-2022 22:48:41.866012",
+        "PROC_TIME": "13-OCT-2022 00:12:52.000000",
+        "first_near_lat": "1.5",
+        "first_far_lat": "1.7",
+        "last_near_lat": "1.1",
+        "last_far_lat": "1.3",
+        "first_near_long": "103.2",
+        "first_far_long": "104.1",
+        "last_near_long": "103.3",
+        "last_far_long": "104.2",
+    }
+    # Real products carry thousands of other attributes
+    filler = "".join(
+        f'<MDATTR name="attribute_{index}" type="float64">{index}</MDATTR>'
+        for index in range(5000)
+    )
+    abstracted = "".join(
+        f'<MDATTR name="{name}" type="ascii">{value}</MDATTR>'
+        for name, value in metadata_attributes.items()
+    )
+    input_path.with_suffix(".dim").write_text(
+        '<Dimap_Document><Dataset_Sources><MDElem name="metadata">'
+        f'<MDElem name="Abstracted_Metadata">{abstracted}{filler}</MDElem>'
+        f'<MDElem name="Original_Product_Metadata">{filler}</MDElem>'
+        "</MDElem></Dataset_Sources></Dimap_Document>"
+    )
+
+    vector_data = input_path.with_suffix(".data") / "vector_data"
+    vector_data.mkdir(parents=True)
+    with open(vector_data / "ShipDetections.csv", "w") as csv_file:
+        csv_file.write("#defaultCSS=symbol:pin; fill:#0000ff\n")
+        csv_file.write(
+            "org.esa.snap.ShipDetections\tGeometry:Point\tstyle_css:String\t"
+            "Detected_x:Integer\tDetected_y:Integer\tDetected_lat:Double\t"
+            "Detected_lon:Double\tDetected_width:Double\tDetected_length:Double\n"
+        )
+        for index in range(number_of_detections):
+            x, y = random_generator.randrange(25500), random_generator.randrange(16700)
+            csv_file.write(
+                f"ship_{index}\tPOINT ({x} {y})\tsymbol:pin\t{x}\t{y}\t"
+                f"{random_generator.uniform(1.1, 1.7)}\t"
+                f"{random_generator.uniform(103.2, 104.2)}\t"
+                f"{random_generator.uniform(5, 60)}\t"
+                f"{random_generator.uniform(30, 400)}\n"
+            )
+
+    return input_path
+
+
+def dict_reader_positions(input_data: Path) -> List[Detection]:
+    # Previous path: DictReader over a filtered generator, one ORM object per row
+    result_path = input_data.with_suffix(".data") / "vector_data/ShipDetections.csv"
+    with open(result_path, newline="") as csvfile:
+        reader = csv.DictReader(
+            filter(lambda row: row[0] != "#", csvfile), delimiter="\t"
+        )
+        return [
+            Detection(
+                pixel_x=int(row["Detected_x:Integer"]),
+                pixel_y=int(row["Detected_y:Integer"]),
+                latitude=float(row["Detected_lat:Double"]),
+                longitude=float(row["Detected_lon:Double"]),
+                width=float(row["Detected_width:Double"]),
+                length=float(row["Detected_length:Double"]),
+            )
+            for row in reader
+        ]
+
+
+def element_tree_metadata(input_data: Path) -> Dict[str, str]:
+    # Previous path: whole tree in memory, every attribute compared
+    root = ElementTree.parse(input_data.with_suffix(".dim")).getroot()
+    attributes = {}
+    for type_tag in root.findall("Dataset_Sources/MDElem/MDElem/MDATTR"):
+        value = type_tag.get("name")
+        if value in result_parser.METADATA_ATTRIBUTES:
+            attributes[str(value)] = str(type_tag.text)
+    return attributes
+
+
+def benchmark_parsing(number_of_detections: int):
+    with tempfile.TemporaryDirectory() as directory:
+        input_path = write_snap_result(directory, number_of_detections)
+
+        measure(
+            "detections DictReader + ORM",
+            number_of_detections,
+            lambda: dict_reader_positions(input_path),
+        )
+        measure(
+            "detections columnar",
+            number_of_detections,
+            lambda: result_parser.parse_ship_positions_columns(input_path),
+        )
+
+        repetitions = 20
+        measure(
+            "metadata ElementTree",
+            repetitions,
+            lambda: [element_tree_metadata(input_path) for _ in range(repetitions)],
+            "files",
+        )
+        measure(
+            "metadata iterparse",
+            repetitions,
+            lambda: [
+                result_parser.parse_metadata(input_path) for _ in range(repetitions)
+            ],
+            "files",
+        )
+
+
+def benchmark_ingestion(number_of_detections: int):
+    with tempfile.TemporaryDirectory() as directory:
+        input_path = write_snap_result(directory, number_of_detections)
+
+        db = create_benchmark_session(directory)
+        tile = result_parser.parse_result(input_path)
+        measure(
+            "ORM unit of work",
+            number_of_detections,
+            lambda: (db.add(tile), db.commit()),
+        )
+        db.close()
+
+        Path(directory, "benchmark.db").unlink()
+        db = create_benchmark_session(directory)
+        tile = result_parser.parse_metadata(input_path)
+        columns = result_parser.parse_ship_positions_columns(input_path)
+        measure(
+            "Core executemany",
+            number_of_detections,
+            lambda: crud.ingest_tile(db, tile, columns),
+        )
+        db.close()
+
+
+def random_columns(number_of_detections: int) -> Dict[str, np.ndarray]:
+    random_generator = np.random.default_rng(0)
+    return {
+        "pixel_x": random_generator.integers(0, 25000, number_of_detections),
+        "pixel_y": random_generator.integers(0, 17000, number_of_detections),
+        "latitude": random_generator.uniform(-60, 60, number_of_detections),
+        "longitude": random_generator.uniform(-180, 180, number_of_detections),
+        "width": random_generator.uniform(5, 60, number_of_detections),
+        "length": random_generator.uniform(30, 400, number_of_detections),
+    }
+
+
+def read_latencies(
+    session_factory: sessionmaker, duration: float, bbox: BoundingBox
+) -> List[float]:
+    latencies = []
+    end = time.perf_counter() + duration
+    while time.perf_counter() < end:
+        db = session_factory()
+        saved = time.perf_counter()
+        crud.get_detections(db, START_DATE, END_DATE, "geojson", bbox)
+        latencies.append(time.perf_counter() - saved)
+        db.close()
+    return latencies
+
+
+def print_latencies(name: str, latencies: List[float]):
+    quantiles = statistics.quantiles(latencies, n=100, method="inclusive")
+    print(
+        f"{name:<32} {len(latencies):6} reads"
+        f"   p50 {quantiles[49] * 1000:8.1f}ms"
+        f"   p99 {quantiles[98] * 1000:8.1f}ms"
+        f"   max {max(latencies) * 1000:8.1f}ms"
+    )
+
+
+def benchmark_concurrency(number_of_detections: int, duration: float = 10.0):
+    """
+    Latency of the viewport reads, alone and while tiles are continuously ingested,
+    for every storage profile.
+    """
+    bbox = BoundingBox(0.0, 0.0, 20.0, 20.0)
+    columns = random_columns(DETECTIONS_PER_TILE)
+
+    for name, profile in STORAGE_PROFILES.items():
+        with tempfile.TemporaryDirectory() as directory:
+            path = str(Path(directory) / "benchmark.db")
+            writer_engine = create_writer_engine(path, profile)
+            Base.metadata.create_all(writer_engine)
+            WriterSession = sessionmaker(bind=writer_engine)
+            ReaderSession = sessionmaker(bind=create_reader_engine(path, profile))
+
+            db = WriterSession()
+            fill_detections(db, number_of_detections)
+            db.close()
+
+            print_latencies(
+                f"{name} reads alone", read_latencies(ReaderSession, duration, bbox)
+            )
+
+            stop = threading.Event()
+            ingested_tiles: List[str] = []
+
+            def ingest():
+                while not stop.is_set():
+                    tile = Tile(
+                        dataset=f"INGESTED_{len(ingested_tiles)}",
+                        acquisition_time=datetime.datetime(2023, 1, 15),
+                    )
+                    db = WriterSession()
+                    crud.ingest_tile(db, tile, columns)
+                    db.close()
+                    ingested_tiles.append(tile.dataset)
+
+            writer = threading.Thread(target=ingest)
+            writer.start()
+            latencies = read_latencies(ReaderSession, duration, bbox)
+            stop.set()
+            writer.join()
+            print_latencies(f"{name} reads during ingestion", latencies)
+            print(f"{name + ' tiles ingested':<32} {len(ingested_tiles):6}")
+
+
+BENCHMARKS: Dict[str, Callable[[int], None]] = {
+    "serialization": benchmark_serialization,
+    "parsing": benchmark_parsing,
+    "ingestion": benchmark_ingestion,
+    "concurrency": benchmark_concurrency,
+}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("benchmark", choices=BENCHMARKS.keys())
+    parser.add_argument("--detections", type=int, default=1_000_000)
+    arguments = parser.parse_args()
+
+    BENCHMARKS[arguments.benchmark](arguments.detections)
@@ -0,0 +1,197 @@
+"""
+Local cache of the catalogue of the Copernicus hub, and selection of the products to
+download for a request.
+Query results and product footprints are stored in the database and reused for
+`QUERY_TTL`, so that repeated and overlapping requests do not query the hub again.
+Among the products intersecting a request, only a few covering its polygons on each
+acquisition day are selected, greedily, preferring products already ingested.
+The hub is set by `BOATMAN_HUB_URL`, e.g. to a local stand-in.
+"""
+import hashlib
+import json
+import os
+from collections import OrderedDict
+from datetime import date
+from datetime import datetime
+from datetime import timedelta
+from typing import Collection
+from typing import Dict
+from typing import List
+from typing import Optional
+
+import numpy as np
+from geo_helper import points_in_rings
+from geo_helper import sample_geojson
+from geo_helper import wkt_rings
+from geojson import FeatureCollection
+from models import CatalogueProduct
+from models import CatalogueQuery
+from sentinel_extractor import query_sentinel_products
+from sentinelsat import geojson_to_wkt
+from sentinelsat import SentinelAPI
+from sqlalchemy.orm import Session
+
+HUB_URL = os.environ.get("BOATMAN_HUB_URL", "https://apihub.copernicus.eu/apihub/")
+QUERY_TTL = timedelta(hours=float(os.environ.get("BOATMAN_CATALOGUE_TTL_HOURS", "24")))
+
+# Properties of the products kept from the hub
+PROPERTIES = ("title", "footprint", "beginposition", "size")
+
+
+def connect() -> SentinelAPI:
+    # Credentials are read from the .netrc file, see the README
+    return SentinelAPI(None, None, api_url=HUB_URL)
+
+
+def query_key(
+    footprint: str,
+    start_date: date,
+    end_date: date,
+    platformname: str,
+    producttype: str,
+) -> str:
+    query = json.dumps(
+        [footprint, str(start_date), str(end_date), platformname, producttype]
+    )
+    return hashlib.sha256(query.encode()).hexdigest()
+
+
+def _to_properties(product: CatalogueProduct) -> Dict:
+    return {
+        "title": product.title,
+        "footprint": product.footprint,
+        "beginposition": product.acquisition_time,
+        "size": product.size,
+    }
+
+
+def cached_products(
+    db: Session, key: str, now: Optional[datetime] = None
+) -> Optional[OrderedDict]:
+    """
+    Returns the products of a query made less than `QUERY_TTL` ago, None otherwise.
+    """
+    now = now or datetime.now()
+    query = db.query(CatalogueQuery).get(key)
+    if query is None or query.queried_time < now - QUERY_TTL:
+        return None
+
+    product_ids = json.loads(query.product_ids)
+    rows = {
+        product.id: product
+        for product in db.query(CatalogueProduct).filter(
+            CatalogueProduct.id.in_(product_ids)
+        )
+    }
+    if len(rows) != len(product_ids):
+        return None
+    return OrderedDict(
+        (product_id, _to_properties(rows[product_id])) for product_id in product_ids
+    )
+
+
+def store_products(db: Session, key: str, products: OrderedDict):
+    for product_id, properties in products.items():
+        db.merge(
+            CatalogueProduct(
+                id=product_id,
+                title=properties["title"],
+                footprint=properties.get("footprint"),
+                acquisition_time=properties.get("beginposition"),
+                size=properties.get("size"),
+            )
+        )
+    db.merge(
+        CatalogueQuery(
+            key=key, queried_time=datetime.now(), product_ids=json.dumps(list(products))
+        )
+    )
+    db.commit()
+
+
+def query_products(
+    read_db: Session,
+    db: Session,
+    api: SentinelAPI,
+    geo_dict: FeatureCollection,
+    start_date: date,
+    end_date: date,
+    platformname: str = "Sentinel-1",
+    producttype: str = "GRD",
+) -> OrderedDict:
+    """
+    Returns the products intersecting the polygons of a geojson between two dates,
+    from the cache or from the hub. The cache is read with `read_db`, and the hub
+    queried outside of any transaction: `db` only stores its results.
+    """
+    key = query_key(
+        geojson_to_wkt(geo_dict), start_date, end_date, platformname, producttype
+    )
+    products = cached_products(read_db, key)
+    read_db.rollback()
+    if products is not None:
+        print(f"Found {len(products)} products in the catalogue cache")
+        return products
+
+    products = OrderedDict(
+        (product_id, {name: properties.get(name) for name in PROPERTIES})
+        for product_id, properties in query_sentinel_products(
+            api, geo_dict, start_date, end_date, platformname, producttype
+        ).items()
+    )
+    store_products(db, key, products)
+    return products
+
+
+def select_products(
+    products: OrderedDict,
+    geo_dict: FeatureCollection,
+    preferred: Collection[str] = (),
+) -> List[str]:
+    """
+    Returns the products to use for a request, in the order of the hub: for each
+    acquisition day, the `preferred` products and, greedily, those covering most of
+    the part of the polygons they leave uncovered, until no product adds coverage.
+    Polygons are compared on sample points, products without a footprint are always
+    selected.
+    """
+    longitudes, latitudes = sample_geojson(geo_dict)
+    order = {product_id: rank for rank, product_id in enumerate(products)}
+
+    days: Dict[Optional[date], List[str]] = {}
+    for product_id, properties in products.items():
+        acquisition_time = properties.get("beginposition")
+        day = acquisition_time.date() if acquisition_time else None
+        days.setdefault(day, []).append(product_id)
+
+    selected = []
+    for product_ids in days.values():
+        covers = {
+            product_id: points_in_rings(
+                longitudes, latitudes, wkt_rings(products[product_id]["footprint"])
+            )
+            for product_id in product_ids
+            if products[product_id].get("footprint")
+        }
+        covered = np.zeros(len(longitudes), dtype=bool)
+        for product_id in product_ids:
+            if product_id not in covers or product_id in preferred:
+                selected.append(product_id)
+                covered |= covers.get(product_id, False)
+
+        candidates = [
+            product_id for product_id in covers if product_id not in preferred
+        ]
+        while candidates:
+            # Ties go to the first product of the hub, the most recent one
+            gains = [
+                np.count_nonzero(covers[product_id] & ~covered)
+                for product_id in candidates
+            ]
+            best = int(np.argmax(gains))
+            if not gains[best]:
+                break
+            covered |= covers[candidates[best]]
+            selected.append(candidates.pop(best))
+
+    return sorted(selected, key=lambda product_id: order[product_id])
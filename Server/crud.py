@@ -4,62 +4,1008 @@ Note that pydantic models should be defined and used if the goal is to modify
 the database (only reading for now).
 """
 import datetime
-from typing import Union
+import math
+import time
+from typing import Callable
+from typing import Dict
+from typing import Iterator
+from typing import List
+from typing import Mapping
+from typing import NamedTuple
+from typing import Optional
+from typing import TypedDict
 
+import numpy as np
+import tracking
+from geo_helper import BoundingBox
+from geo_helper import lon_lat_to_tile
+from geo_helper import lon_lat_to_tiles
+from geo_helper import points_in_rings
+from geo_helper import sample_geojson
+from geo_helper import wkt_rings
+from geojson import Feature
 from geojson import FeatureCollection
+from geojson import LineString
+from geojson import Point
+from models import CatalogueProduct
 from models import Detection
-from models import Port
+from models import DetectionCluster
+from models import detections_rtree
 from models import Tile
-from sqlalchemy import desc
+from models import tiles_rtree
+from models import Track
+from models import TrackSegment
+from sqlalchemy import bindparam
+from sqlalchemy import delete
+from sqlalchemy import func
+from sqlalchemy import insert
+from sqlalchemy import select
+from sqlalchemy import update
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.engine import Row
+from sqlalchemy.orm import Query
 from sqlalchemy.orm import Session
+from sqlalchemy.sql import Select
 
 
-def get_detections(
-    db: Session, start_date: datetime.date, end_date: datetime.date, data_type: str
-) -> Union[str, FeatureCollection, None]:
-    detections = (
-        db.query(Detection)
-        .join(Tile)
+def select_tiles_in_bbox(bbox: BoundingBox) -> Select:
+    return select(tiles_rtree.c.dataset).where(
+        tiles_rtree.c.max_latitude >= bbox.min_latitude,
+        tiles_rtree.c.min_latitude <= bbox.max_latitude,
+        tiles_rtree.c.max_longitude >= bbox.min_longitude,
+        tiles_rtree.c.min_longitude <= bbox.max_longitude,
+    )
+
+
+def query_tiles_in_bbox(
+    db: Session,
+    bbox: BoundingBox,
+    start_date: datetime.date,
+    end_date: datetime.date,
+) -> Query:
+    """
+    Selects the dataset, acquisition time and footprint of the tiles acquired between
+    the two dates whose footprint intersects `bbox`.
+    """
+    return (
+        db.query(
+            Tile.dataset,
+            Tile.acquisition_time,
+            tiles_rtree.c.min_longitude,
+            tiles_rtree.c.min_latitude,
+            tiles_rtree.c.max_longitude,
+            tiles_rtree.c.max_latitude,
+        )
+        .join(tiles_rtree, tiles_rtree.c.dataset == Tile.dataset)
+        .filter(
+            Tile.dataset.in_(select_tiles_in_bbox(bbox)),
+            Tile.acquisition_time > start_date,
+            Tile.acquisition_time < end_date,
+        )
+        .order_by(Tile.acquisition_time)
+    )
+
+
+def filter_detections_in_bbox(query: Query, bbox: BoundingBox) -> Query:
+    # The R*Tree stores 32 bits floats rounded outward, it only selects candidates
+    # and the exact comparison is done on the detections themselves.
+    candidates = select(detections_rtree.c.id).where(
+        detections_rtree.c.max_latitude >= bbox.min_latitude,
+        detections_rtree.c.min_latitude <= bbox.max_latitude,
+        detections_rtree.c.max_longitude >= bbox.min_longitude,
+        detections_rtree.c.min_longitude <= bbox.max_longitude,
+    )
+    return query.filter(
+        Detection.id.in_(candidates),
+        Detection.latitude.between(bbox.min_latitude, bbox.max_latitude),
+        Detection.longitude.between(bbox.min_longitude, bbox.max_longitude),
+    )
+
+
+# Columns of the detection exports, in the order of `Detection.attributes_string`
+DETECTION_COLUMNS = (
+    Detection.id,
+    Detection.tile_dataset,
+    Detection.width,
+    Detection.length,
+    Detection.latitude,
+    Detection.longitude,
+    Detection.pixel_x,
+    Detection.pixel_y,
+)
+DETECTION_CSV_HEADER = ",".join(column.key for column in DETECTION_COLUMNS)
+
+
+def query_detection_rows(
+    db: Session,
+    start_date: datetime.date,
+    end_date: datetime.date,
+    bbox: Optional[BoundingBox] = None,
+    since_id: Optional[int] = None,
+) -> Query:
+    """
+    Selects the detection columns and their tile acquisition time as plain rows,
+    with a single join instead of one ORM object and one tile lazy-load per row.
+    With `since_id`, only the detections inserted after that one are selected.
+    """
+    query = (
+        db.query(*DETECTION_COLUMNS, Tile.acquisition_time)
+        .join(Tile, Detection.tile)
         .filter(Tile.acquisition_time > start_date, Tile.acquisition_time < end_date)
-        .all()
     )
+    if bbox is not None:
+        # Only the tiles whose footprint intersects the box can hold detections
+        query = filter_detections_in_bbox(
+            query.filter(Tile.dataset.in_(select_tiles_in_bbox(bbox))), bbox
+        )
+    if since_id is not None:
+        query = query.filter(Detection.id > since_id)
+    return query
+
+
+def get_last_detection_id(db: Session) -> int:
+    return db.query(func.max(Detection.id)).scalar() or 0
+
+
+def get_detections_bbox(db: Session, since_id: int) -> Optional[BoundingBox]:
+    """
+    Returns the bounding box of the detections inserted after `since_id`.
+    """
+    row = (
+        db.query(
+            func.min(Detection.longitude),
+            func.min(Detection.latitude),
+            func.max(Detection.longitude),
+            func.max(Detection.latitude),
+        )
+        .filter(Detection.id > since_id)
+        .one()
+    )
+    if row[0] is None:
+        return None
+    return BoundingBox(*row)
+
+
+def get_detection_columns(
+    db: Session,
+    start_date: datetime.date,
+    end_date: datetime.date,
+    bbox: Optional[BoundingBox] = None,
+    since_id: Optional[int] = None,
+) -> Dict[str, list]:
+    """
+    Reads the detections and their acquisition time column by column, as needed by
+    the binary formats.
+    """
+    names = [column.key for column in DETECTION_COLUMNS] + ["acquisition_time"]
+    rows = query_detection_rows(db, start_date, end_date, bbox, since_id).all()
+    if not rows:
+        return {name: [] for name in names}
+    return {name: list(values) for name, values in zip(names, zip(*rows))}
+
+
+def detection_row_to_csv(row: Row) -> str:
+    # Missing values, e.g. pixels of tiles merged from windows, are left empty
+    return ",".join("" if value is None else str(value) for value in row[:-1])
+
+
+def json_number(value: Optional[float]) -> str:
+    return "null" if value is None else repr(value)
+
+
+def make_detection_row_to_geojson() -> Callable[[Row], str]:
+    # Detections of a tile share their acquisition time, it is formatted once
+    acquisition_times: Dict[datetime.datetime, str] = {}
+
+    def detection_row_to_geojson(row: Row) -> str:
+        (identifier, _, width, length, latitude, longitude, _, _, time) = row
+        if time not in acquisition_times:
+            acquisition_times[time] = str(time.replace(microsecond=0))
+        # Coordinates are rounded like `geojson.Point` does
+        return (
+            '{"type":"Feature","geometry":{"type":"Point","coordinates":['
+            f"{json_number(round(longitude, 6))},{json_number(round(latitude, 6))}"
+            ']},"properties":{'
+            f'"id":{identifier},"width":{json_number(width)},'
+            f'"length":{json_number(length)},'
+            f'"acquisition_time":"{acquisition_times[time]}"'
+            "}}"
+        )
+
+    return detection_row_to_geojson
+
+
+DETECTION_DATA_TYPES = ("csv", "geojson")
+
+
+def get_detections(
+    db: Session,
+    start_date: datetime.date,
+    end_date: datetime.date,
+    data_type: str,
+    bbox: Optional[BoundingBox] = None,
+    since_id: Optional[int] = None,
+) -> Optional[str]:
+    if data_type not in DETECTION_DATA_TYPES:
+        return None
+    return "".join(
+        stream_detections(db, start_date, end_date, data_type, bbox, since_id=since_id)
+    )
+
+
+STREAM_BATCH_SIZE = 2000
+
+
+def stream_detections(
+    db: Session,
+    start_date: datetime.date,
+    end_date: datetime.date,
+    data_type: str,
+    bbox: Optional[BoundingBox] = None,
+    batch_size: int = STREAM_BATCH_SIZE,
+    since_id: Optional[int] = None,
+) -> Iterator[str]:
+    """
+    Encodes the detections by chunks of `batch_size` rows while they are read from
+    the database, the whole document is never held in memory.
+    """
+    encode: Callable[[Row], str]
     if data_type == "csv":
-        headers = detections[0].attributes_string()
-        dets_csv = [det.to_csv() for det in detections]
-        dets_csv.insert(0, headers)
-        return "\n".join(dets_csv)
-    if data_type == "geojson":
-        dets_geojson = [det.to_geojson() for det in detections]
-        return FeatureCollection(dets_geojson)
-    return None
+        # Header is the first line, rows are appended after a separator
+        prefix, separator, suffix = DETECTION_CSV_HEADER, "\n", ""
+        encode = detection_row_to_csv
+        leading_separator = separator
+    elif data_type == "geojson":
+        prefix, separator, suffix = (
+            '{"type":"FeatureCollection","features":[',
+            ",",
+            "]}",
+        )
+        encode = make_detection_row_to_geojson()
+        leading_separator = ""
+    else:
+        raise ValueError(f"Unsupported data type: {data_type}")
+
+    rows = (
+        query_detection_rows(db, start_date, end_date, bbox, since_id)
+        .execution_options(stream_results=True)
+        .yield_per(batch_size)
+    )
+
+    yield prefix
+    chunk: List[str] = []
+    for row in rows:
+        chunk.append(encode(row))
+        if len(chunk) >= batch_size:
+            yield leading_separator + separator.join(chunk)
+            leading_separator = separator
+            chunk = []
+    if chunk:
+        yield leading_separator + separator.join(chunk)
+    yield suffix
+
+
+def insert_detections(
+    db: Session, dataset: str, columns: Mapping[str, np.ndarray]
+) -> int:
+    """
+    Inserts the detections of a tile from one array per attribute, as returned by
+    `result_parser.parse_ship_positions_columns`, with a single executemany.
+    """
+    attributes = list(columns)
+    rows = zip(*(columns[attribute].tolist() for attribute in attributes))
+    values = [dict(zip(attributes, row), tile_dataset=dataset) for row in rows]
+    if values:
+        db.execute(insert(Detection.__table__), values)
+    return len(values)
+
+
+def get_tile_footprint(
+    tile: Tile, columns: Mapping[str, np.ndarray]
+) -> Optional[BoundingBox]:
+    """
+    Returns the bounding box of the corners of a tile and of its detections.
+    """
+    # Missing corners are None, which become NaN and are ignored like missing positions
+    latitudes = np.append(
+        np.array([tile.top_left_latitude, tile.bottom_right_latitude], dtype=float),
+        columns["latitude"],
+    )
+    longitudes = np.append(
+        np.array([tile.top_left_longitude, tile.bottom_right_longitude], dtype=float),
+        columns["longitude"],
+    )
+    if np.isnan(latitudes).all() or np.isnan(longitudes).all():
+        return None
+    return BoundingBox(
+        float(np.nanmin(longitudes)),
+        float(np.nanmin(latitudes)),
+        float(np.nanmax(longitudes)),
+        float(np.nanmax(latitudes)),
+    )
+
+
+def ingest_tile(
+    db: Session, tile: Tile, columns: Mapping[str, np.ndarray], commit: bool = True
+) -> int:
+    """
+    Inserts a tile and its detections with Core statements in a single transaction,
+    bypassing the ORM unit of work. With `commit` False, the transaction is left to
+    the caller.
+    """
+    saved = time.perf_counter()
+    try:
+        if db.query(Tile.dataset).filter_by(dataset=tile.dataset).scalar() is not None:
+            raise ValueError("Product already exists in database.")
+
+        db.execute(
+            insert(Tile.__table__).values(
+                {
+                    column.key: getattr(tile, column.key)
+                    for column in Tile.__table__.columns
+                }
+            )
+        )
+        number_of_detections = insert_detections(db, tile.dataset, columns)
+        footprint = get_tile_footprint(tile, columns)
+        if footprint is not None:
+            db.execute(
+                insert(tiles_rtree).values(
+                    min_latitude=footprint.min_latitude,
+                    max_latitude=footprint.max_latitude,
+                    min_longitude=footprint.min_longitude,
+                    max_longitude=footprint.max_longitude,
+                    dataset=tile.dataset,
+                )
+            )
+        if commit:
+            db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    elapsed = time.perf_counter() - saved
+
+    print(
+        f"Inserted {number_of_detections} detections of {tile.dataset} in"
+        f" {elapsed:.2f}s ({number_of_detections / elapsed:,.0f} rows/s)"
+    )
+    return number_of_detections
+
 
+# In degrees, about 11 meters at the equator, below the minimal target size
+DUPLICATE_TOLERANCE = 1e-4
+# Overlapping products of a pass are acquired within seconds of each other, a vessel
+# found at the same position in a later pass is a new detection of it
+DUPLICATE_TIME_WINDOW = datetime.timedelta(minutes=5)
+DELETE_BATCH_SIZE = 10000
 
-def get_ports(db: Session, number: int) -> FeatureCollection:
-    ports_db = db.query(Port).order_by(desc(Port.outflows)).limit(number).all()
-    ports_geojson = [port.to_geojson() for port in ports_db]
-    return FeatureCollection(ports_geojson)
 
+def remove_duplicates(
+    db: Session,
+    dataset: str,
+    tolerance: float = DUPLICATE_TOLERANCE,
+    commit: bool = True,
+) -> int:
+    """
+    Removes the detections of a newly ingested tile lying within `tolerance` degrees
+    of an older detection acquired within `DUPLICATE_TIME_WINDOW`, either from an
+    overlapping product or from the same one.
+    Only the neighbourhood of the new detections is looked at through the R*Tree,
+    so the cost does not depend on the size of the history.
+    """
+    detections = Detection.__table__
+    other = detections.alias("other")
+    candidates = detections_rtree.alias("candidates")
 
-def remove_duplicates(db: Session):
-    number_of_detections = db.query(Detection.latitude, Detection.longitude).count()
+    acquisition_time = (
+        db.query(Tile.acquisition_time).filter(Tile.dataset == dataset).scalar()
+    )
+    if acquisition_time is None:
+        same_acquisition = other.c.tile_dataset == dataset
+    else:
+        same_acquisition = other.c.tile_dataset.in_(
+            select(Tile.dataset).where(
+                Tile.acquisition_time.between(
+                    acquisition_time - DUPLICATE_TIME_WINDOW,
+                    acquisition_time + DUPLICATE_TIME_WINDOW,
+                )
+            )
+        )
 
-    duplicates = (
-        db.query(Detection)
+    duplicate_exists = (
+        select(other.c.id)
+        .join(candidates, candidates.c.id == other.c.id)
         .where(
-            Detection.id.not_in(
-                db.query(Detection.id).group_by(Detection.latitude, Detection.longitude)
+            candidates.c.max_latitude >= detections.c.latitude - tolerance,
+            candidates.c.min_latitude <= detections.c.latitude + tolerance,
+            candidates.c.max_longitude >= detections.c.longitude - tolerance,
+            candidates.c.min_longitude <= detections.c.longitude + tolerance,
+            func.abs(other.c.latitude - detections.c.latitude) <= tolerance,
+            func.abs(other.c.longitude - detections.c.longitude) <= tolerance,
+            other.c.id < detections.c.id,
+            same_acquisition,
+        )
+        .exists()
+    )
+
+    # The R*Tree cannot be read by the statement whose triggers delete from it
+    duplicate_ids = (
+        db.execute(
+            select(detections.c.id).where(
+                detections.c.tile_dataset == dataset, duplicate_exists
             )
         )
+        .scalars()
         .all()
     )
+    # Bounded by the number of variables of a SQLite statement
+    for start in range(0, len(duplicate_ids), DELETE_BATCH_SIZE):
+        batch = duplicate_ids[slice(start, start + DELETE_BATCH_SIZE)]
+        db.execute(
+            delete(detections)
+            .where(detections.c.id.in_(batch))
+            .execution_options(synchronize_session=False)
+        )
+    if commit:
+        db.commit()
 
-    for duplicate in duplicates:
-        db.delete(duplicate)
+    print(f"Removed {len(duplicate_ids)} duplicated detections from {dataset}")
+    return len(duplicate_ids)
 
-    db.commit()
 
-    new_number_of_detections = db.query(Detection.latitude, Detection.longitude).count()
+# Zoom levels aggregated at ingestion, detections are served one by one beyond it
+CLUSTER_MAX_ZOOM = 10
 
-    print(
-        f"Removed {number_of_detections - new_number_of_detections} out of {number_of_detections} detections"
+
+def add_detection_clusters(
+    db: Session, dataset: str, max_zoom: int = CLUSTER_MAX_ZOOM, commit: bool = True
+) -> int:
+    """
+    Adds the detections of a tile to the clusters of every zoom level up to
+    `max_zoom`. Called once the duplicates are removed, each detection is counted
+    once.
+    """
+    acquisition_time = (
+        db.query(Tile.acquisition_time).filter(Tile.dataset == dataset).scalar()
+    )
+    rows = (
+        db.query(Detection.longitude, Detection.latitude)
+        .filter(
+            Detection.tile_dataset == dataset,
+            Detection.longitude.isnot(None),
+            Detection.latitude.isnot(None),
+        )
+        .all()
     )
+    if acquisition_time is None or not rows:
+        return 0
+    positions = np.array(rows, dtype=np.float64)
+    longitudes, latitudes = positions[:, 0], positions[:, 1]
+
+    values = []
+    for zoom in range(max_zoom + 1):
+        xs, ys = lon_lat_to_tiles(longitudes, latitudes, zoom)
+        cells, inverse, counts = np.unique(
+            (xs << zoom) + ys, return_inverse=True, return_counts=True
+        )
+        inverse = inverse.ravel()
+        sum_latitudes = np.bincount(inverse, weights=latitudes)
+        sum_longitudes = np.bincount(inverse, weights=longitudes)
+        mask = (1 << zoom) - 1
+        values += [
+            {
+                "zoom": zoom,
+                "day": acquisition_time.date(),
+                "x": cell >> zoom,
+                "y": cell & mask,
+                "count": count,
+                "sum_latitude": sum_latitude,
+                "sum_longitude": sum_longitude,
+            }
+            for cell, count, sum_latitude, sum_longitude in zip(
+                cells.tolist(),
+                counts.tolist(),
+                sum_latitudes.tolist(),
+                sum_longitudes.tolist(),
+            )
+        ]
+
+    statement = sqlite_insert(DetectionCluster)
+    db.execute(
+        statement.on_conflict_do_update(
+            index_elements=["zoom", "day", "x", "y"],
+            set_={
+                "count": DetectionCluster.count + statement.excluded.count,
+                "sum_latitude": DetectionCluster.sum_latitude
+                + statement.excluded.sum_latitude,
+                "sum_longitude": DetectionCluster.sum_longitude
+                + statement.excluded.sum_longitude,
+            },
+        ),
+        values,
+    )
+    if commit:
+        db.commit()
+    return len(values)
+
+
+def get_clusters(
+    db: Session,
+    start_date: datetime.date,
+    end_date: datetime.date,
+    zoom: int,
+    bbox: Optional[BoundingBox] = None,
+) -> FeatureCollection:
+    """
+    Returns one point per tile of the zoom level holding detections, at their
+    centroid, with the number of detections it stands for.
+    """
+    count = func.sum(DetectionCluster.count)
+    sum_latitude = func.sum(DetectionCluster.sum_latitude)
+    sum_longitude = func.sum(DetectionCluster.sum_longitude)
+
+    # Same days as the detections, acquired after start and before end dates
+    query = db.query(
+        DetectionCluster.x, DetectionCluster.y, count, sum_latitude, sum_longitude
+    ).filter(
+        DetectionCluster.zoom == zoom,
+        DetectionCluster.day >= start_date,
+        DetectionCluster.day < end_date,
+    )
+    if bbox is not None:
+        min_x, max_y = lon_lat_to_tile(bbox.min_longitude, bbox.min_latitude, zoom)
+        max_x, min_y = lon_lat_to_tile(bbox.max_longitude, bbox.max_latitude, zoom)
+        query = query.filter(
+            DetectionCluster.x.between(min_x, max_x),
+            DetectionCluster.y.between(min_y, max_y),
+        )
+    query = query.group_by(DetectionCluster.x, DetectionCluster.y)
+
+    return FeatureCollection(
+        [
+            Feature(
+                geometry=Point((row[4] / row[2], row[3] / row[2])),
+                properties={"count": row[2], "zoom": zoom, "x": row[0], "y": row[1]},
+            )
+            for row in query
+        ]
+    )
+
+
+def get_density(
+    db: Session,
+    start_date: datetime.date,
+    end_date: datetime.date,
+    zoom: int,
+    min_x: int,
+    min_y: int,
+    max_x: int,
+    max_y: int,
+) -> Dict[str, np.ndarray]:
+    """
+    Returns the x, y and number of detections of the non-empty cells of the zoom
+    level between the two tile corners, summed over the days between the two dates.
+    """
+    rows = (
+        db.query(
+            DetectionCluster.x, DetectionCluster.y, func.sum(DetectionCluster.count)
+        )
+        .filter(
+            DetectionCluster.zoom == zoom,
+            DetectionCluster.day >= start_date,
+            DetectionCluster.day < end_date,
+            DetectionCluster.x.between(min_x, max_x),
+            DetectionCluster.y.between(min_y, max_y),
+        )
+        .group_by(DetectionCluster.x, DetectionCluster.y)
+        .all()
+    )
+    values = np.array(rows, dtype=np.int64).reshape(-1, 3)
+    return {"x": values[:, 0], "y": values[:, 1], "count": values[:, 2]}
+
+
+class DayCoverage(TypedDict):
+    date: str
+    covered_fraction: float
+    tiles: List[str]
+
+
+class Coverage(TypedDict):
+    covered_fraction: float
+    days: List[DayCoverage]
+
+
+def get_product_rings(db: Session, datasets: List[str]) -> Dict[str, List[np.ndarray]]:
+    """
+    Returns the exterior rings of the catalogue footprint of the product of each
+    tile, for the tiles whose product is in the catalogue.
+    """
+    # Tiles of a region of a product are named after the product and the region
+    titles = {dataset: (dataset, dataset.rsplit("_", 1)[0]) for dataset in datasets}
+    footprints = dict(
+        db.query(CatalogueProduct.title, CatalogueProduct.footprint).filter(
+            CatalogueProduct.title.in_(
+                sorted(
+                    {title for candidates in titles.values() for title in candidates}
+                )
+            ),
+            CatalogueProduct.footprint.isnot(None),
+        )
+    )
+    rings = {}
+    for dataset, candidates in titles.items():
+        title = next((title for title in candidates if title in footprints), None)
+        if title is not None:
+            rings[dataset] = wkt_rings(footprints[title])
+    return rings
+
+
+def get_coverage(
+    db: Session, geo_dict: dict, start_date: datetime.date, end_date: datetime.date
+) -> Coverage:
+    """
+    Returns the fraction of the polygons of a FeatureCollection covered by the
+    footprints of the tiles acquired between the two dates, overall and per
+    acquisition day. Polygons are sampled on a grid.
+    The footprint of a tile is its bounding box, clipped to the footprint of its
+    product when the catalogue holds it: swaths are tilted.
+    """
+    longitudes, latitudes = sample_geojson(geo_dict)
+    if not len(longitudes):
+        return {"covered_fraction": 0.0, "days": []}
+
+    bbox = BoundingBox(
+        longitudes.min(), latitudes.min(), longitudes.max(), latitudes.max()
+    )
+    rows = query_tiles_in_bbox(db, bbox, start_date, end_date).all()
+    product_rings = get_product_rings(db, [row.dataset for row in rows])
+    covered = np.zeros(len(longitudes), dtype=bool)
+    covered_per_day: Dict[datetime.date, np.ndarray] = {}
+    tiles_per_day: Dict[datetime.date, List[str]] = {}
+    for row in rows:
+        in_footprint = (
+            (longitudes >= row.min_longitude)
+            & (longitudes <= row.max_longitude)
+            & (latitudes >= row.min_latitude)
+            & (latitudes <= row.max_latitude)
+        )
+        rings = product_rings.get(row.dataset)
+        if rings:
+            in_footprint[in_footprint] = points_in_rings(
+                longitudes[in_footprint], latitudes[in_footprint], rings
+            )
+        covered |= in_footprint
+        day = row.acquisition_time.date()
+        day_covered = covered_per_day.setdefault(
+            day, np.zeros(len(longitudes), dtype=bool)
+        )
+        day_covered |= in_footprint
+        tiles_per_day.setdefault(day, []).append(row.dataset)
+
+    return {
+        "covered_fraction": float(covered.mean()),
+        "days": [
+            {
+                "date": str(day),
+                "covered_fraction": float(day_covered.mean()),
+                "tiles": tiles_per_day[day],
+            }
+            for day, day_covered in covered_per_day.items()
+        ],
+    }
+
+
+class TileTracks(NamedTuple):
+    acquisition_time: datetime.datetime
+    # Identifier, position and size of the detections of the tile
+    detections: List[Row]
+    # Tracks ending around the tile
+    tracks: List[Row]
+
+
+class TrackUpdates(NamedTuple):
+    # Rows of the tracks started by detections of the tile, without their id
+    new_tracks: List[Dict]
+    # Last state of the extended tracks, with the detection they ended at
+    extended_tracks: List[Dict]
+
+
+def read_tile_tracks(db: Session, dataset: str) -> Optional[TileTracks]:
+    """
+    Reads the detections of a tile and the tracks ending around it during the
+    previous `tracking.TIME_WINDOW`. Returns None when the tile has no detection.
+    """
+    acquisition_time = (
+        db.query(Tile.acquisition_time).filter(Tile.dataset == dataset).scalar()
+    )
+    rows = (
+        db.query(
+            Detection.id,
+            Detection.longitude,
+            Detection.latitude,
+            Detection.length,
+            Detection.width,
+        )
+        .filter(
+            Detection.tile_dataset == dataset,
+            Detection.longitude.isnot(None),
+            Detection.latitude.isnot(None),
+        )
+        .order_by(Detection.id)
+        .all()
+    )
+    if acquisition_time is None or not rows:
+        return None
+    latitudes = np.array([row.latitude for row in rows])
+    longitudes = np.array([row.longitude for row in rows])
+
+    # Tracks ending around the tile: a predicted position and its gate are both
+    # within the distance travelled at the maximal speed
+    margin = (
+        2
+        * tracking.max_gate(tracking.TIME_WINDOW.total_seconds() / 3600)
+        / tracking.KM_PER_DEGREE
+    )
+    longitude_margin = margin / math.cos(
+        math.radians(min(np.abs(latitudes).max() + margin, 85.0))
+    )
+    track_rows = (
+        db.query(
+            Track.id,
+            Track.last_detection_id,
+            Track.end_time,
+            Track.last_longitude,
+            Track.last_latitude,
+            Track.last_length,
+            Track.last_width,
+            Track.velocity_east,
+            Track.velocity_north,
+        )
+        .filter(
+            Track.end_time >= acquisition_time - tracking.TIME_WINDOW,
+            Track.end_time < acquisition_time,
+            Track.last_latitude.between(
+                latitudes.min() - margin, latitudes.max() + margin
+            ),
+            Track.last_longitude.between(
+                longitudes.min() - longitude_margin,
+                longitudes.max() + longitude_margin,
+            ),
+        )
+        .all()
+    )
+    return TileTracks(acquisition_time, rows, track_rows)
+
+
+def match_tracks(tile_tracks: TileTracks) -> TrackUpdates:
+    """
+    Links the detections of a tile to the tracks, or starts new tracks with them.
+    Tiles are expected in chronological order, tracks are only extended forward.
+    """
+    acquisition_time, rows, track_rows = tile_tracks
+    detections = tracking.Points(
+        *np.array([row[1:] for row in rows], dtype=np.float64).T
+    )
+    track_values = np.array([row[3:] for row in track_rows], dtype=np.float64).reshape(
+        -1, 6
+    )
+    elapsed_hours = np.array(
+        [(acquisition_time - row.end_time).total_seconds() / 3600 for row in track_rows]
+    )
+    predicted, gates = tracking.predict(
+        tracking.Points(*track_values[:, :4].T),
+        track_values[:, 4],
+        track_values[:, 5],
+        elapsed_hours,
+    )
+    matches, _ = tracking.associate(detections, predicted, gates)
+
+    updates = TrackUpdates([], [])
+    for row, match in zip(rows, matches.tolist()):
+        last_state = {
+            "last_detection_id": row.id,
+            "last_longitude": row.longitude,
+            "last_latitude": row.latitude,
+            "last_length": row.length,
+            "last_width": row.width,
+            "end_time": acquisition_time,
+        }
+        if match == -1:
+            updates.new_tracks.append(
+                dict(last_state, start_time=acquisition_time, number_of_detections=1)
+            )
+            continue
+        track = track_rows[match]
+        velocity_east, velocity_north = tracking.velocity(
+            row.longitude,
+            row.latitude,
+            track.last_longitude,
+            track.last_latitude,
+            elapsed_hours[match],
+        )
+        updates.extended_tracks.append(
+            dict(
+                last_state,
+                track_id=track.id,
+                previous_detection_id=track.last_detection_id,
+                velocity_east=velocity_east,
+                velocity_north=velocity_north,
+            )
+        )
+    return updates
+
+
+def apply_track_updates(db: Session, updates: TrackUpdates) -> bool:
+    """
+    Writes the tracks and segments of `match_tracks` in one short
+    transaction. Returns False, and writes nothing, when one of the extended tracks
+    was extended by another ingestion since it was read.
+    """
+    tracks_table = Track.__table__
+    try:
+        if updates.extended_tracks:
+            # Tracks are only extended from the detection they were read at
+            extended = db.execute(
+                update(tracks_table)
+                .where(
+                    tracks_table.c.id == bindparam("track_id"),
+                    tracks_table.c.last_detection_id
+                    == bindparam("previous_detection_id"),
+                )
+                .values(
+                    number_of_detections=tracks_table.c.number_of_detections + 1,
+                    last_detection_id=bindparam("last_detection_id"),
+                    last_longitude=bindparam("last_longitude"),
+                    last_latitude=bindparam("last_latitude"),
+                    last_length=bindparam("last_length"),
+                    last_width=bindparam("last_width"),
+                    end_time=bindparam("end_time"),
+                    velocity_east=bindparam("velocity_east"),
+                    velocity_north=bindparam("velocity_north"),
+                ),
+                updates.extended_tracks,
+            ).rowcount
+            if extended != len(updates.extended_tracks):
+                db.rollback()
+                return False
+
+        # Writes are serialized, the next identifiers are free until the commit
+        next_track_id = (db.query(func.max(Track.id)).scalar() or 0) + 1
+        new_tracks = [
+            dict(track, id=track_id)
+            for track_id, track in enumerate(updates.new_tracks, start=next_track_id)
+        ]
+        if new_tracks:
+            db.execute(insert(tracks_table), new_tracks)
+        segments = [
+            {
+                "detection_id": track["last_detection_id"],
+                "track_id": track["id"],
+                "previous_detection_id": None,
+                "acquisition_time": track["end_time"],
+                "speed": None,
+            }
+            for track in new_tracks
+        ] + [
+            {
+                "detection_id": track["last_detection_id"],
+                "track_id": track["track_id"],
+                "previous_detection_id": track["previous_detection_id"],
+                "acquisition_time": track["end_time"],
+                "speed": math.hypot(track["velocity_east"], track["velocity_north"])
+                / tracking.KNOT,
+            }
+            for track in updates.extended_tracks
+        ]
+        if segments:
+            db.execute(insert(TrackSegment.__table__), segments)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    return True
+
+
+# Attempts to link the detections of a tile while other ingestions extend its tracks
+TRACKING_ATTEMPTS = 3
+
+
+def add_detections_to_tracks(read_db: Session, db: Session, dataset: str) -> int:
+    """
+    Links the detections of a tile to the tracks, see `match_tracks`. Tracks are
+    read with `read_db` and matched outside of any transaction, `db` only writes
+    the result. Returns the number of extended tracks.
+    """
+    for _ in range(TRACKING_ATTEMPTS):
+        tile_tracks = read_tile_tracks(read_db, dataset)
+        # The next attempt reads the tracks committed in between
+        read_db.rollback()
+        if tile_tracks is None:
+            return 0
+        updates = match_tracks(tile_tracks)
+        if apply_track_updates(db, updates):
+            return len(updates.extended_tracks)
+    raise RuntimeError(f"Tracks around {dataset} kept changing during its tracking.")
+
+
+def get_tracks(
+    db: Session,
+    start_date: datetime.date,
+    end_date: datetime.date,
+    bbox: Optional[BoundingBox] = None,
+    min_detections: int = 2,
+    detection_id: Optional[int] = None,
+) -> FeatureCollection:
+    """
+    Returns the tracks overlapping the two dates, with at least `min_detections`
+    detections, as lines through their detections in chronological order. With
+    `bbox`, only the tracks with a detection inside it are returned, and with
+    `detection_id`, only the track of that detection.
+    """
+    query = db.query(
+        Track.id, Track.start_time, Track.end_time, Track.number_of_detections
+    ).filter(
+        Track.start_time < end_date,
+        Track.end_time > start_date,
+        Track.number_of_detections >= min_detections,
+    )
+    if bbox is not None:
+        in_bbox = filter_detections_in_bbox(db.query(Detection.id), bbox)
+        query = query.filter(
+            Track.id.in_(
+                select(TrackSegment.track_id).where(
+                    TrackSegment.detection_id.in_(in_bbox)
+                )
+            )
+        )
+    if detection_id is not None:
+        query = query.filter(
+            Track.id
+            == select(TrackSegment.track_id)
+            .where(TrackSegment.detection_id == detection_id)
+            .scalar_subquery()
+        )
+    tracks = query.all()
+    if not tracks:
+        return FeatureCollection([])
+
+    points: Dict[int, List[Row]] = {}
+    for point in (
+        db.query(
+            TrackSegment.track_id,
+            TrackSegment.detection_id,
+            TrackSegment.acquisition_time,
+            TrackSegment.speed,
+            Detection.longitude,
+            Detection.latitude,
+        )
+        .join(Detection, Detection.id == TrackSegment.detection_id)
+        .filter(TrackSegment.track_id.in_([track.id for track in tracks]))
+        .order_by(TrackSegment.track_id, TrackSegment.acquisition_time)
+    ):
+        points.setdefault(point.track_id, []).append(point)
+
+    features = []
+    for track in tracks:
+        track_points = points.get(track.id, [])
+        positions = [(point.longitude, point.latitude) for point in track_points]
+        features.append(
+            Feature(
+                geometry=LineString(positions)
+                if len(positions) > 1
+                else Point(positions[0]),
+                properties={
+                    "id": track.id,
+                    "start_time": str(track.start_time.replace(microsecond=0)),
+                    "end_time": str(track.end_time.replace(microsecond=0)),
+                    "number_of_detections": track.number_of_detections,
+                    "detection_ids": [point.detection_id for point in track_points],
+                    "times": [
+                        str(point.acquisition_time.replace(microsecond=0))
+                        for point in track_points
+                    ],
+                    "speeds": [point.speed for point in track_points],
+                },
+            )
+        )
+    return FeatureCollection(features)
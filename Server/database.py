@@ -1,16 +1,124 @@
+import os
+from dataclasses import dataclass
+
 from sqlalchemy import create_engine
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool
 
 PATH_DB = "detection.db"
 
-engine = create_engine(
-    "sqlite:///" + PATH_DB,
-    connect_args={"check_same_thread": False},
-    encoding="utf-8",
-    echo=False,
-)
 
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+@dataclass(frozen=True)
+class StorageProfile:
+    journal_mode: str
+    synchronous: str
+    # Negative values are in KiB, positive ones in pages
+    cache_size: int
+    mmap_size: int
+    # Milliseconds a connection waits for a lock held by another one
+    busy_timeout: int
+    read_pool_size: int
+
+
+STORAGE_PROFILES = {
+    # Readers never wait for the writer, and commits only sync at checkpoints
+    "wal": StorageProfile(
+        journal_mode="WAL",
+        synchronous="NORMAL",
+        cache_size=-65536,
+        mmap_size=256 * 1024**2,
+        busy_timeout=30000,
+        read_pool_size=8,
+    ),
+    # SQLite defaults, every commit blocks the readers
+    "legacy": StorageProfile(
+        journal_mode="DELETE",
+        synchronous="FULL",
+        cache_size=-2000,
+        mmap_size=0,
+        busy_timeout=5000,
+        read_pool_size=8,
+    ),
+}
+
+STORAGE_PROFILE = STORAGE_PROFILES[os.environ.get("BOATMAN_STORAGE_PROFILE", "wal")]
+
+
+def apply_pragmas(dbapi_connection, profile: StorageProfile, read_only: bool):
+    cursor = dbapi_connection.cursor()
+    if not read_only:
+        cursor.execute(f"PRAGMA journal_mode = {profile.journal_mode}")
+        cursor.execute(f"PRAGMA synchronous = {profile.synchronous}")
+    cursor.execute(f"PRAGMA cache_size = {profile.cache_size}")
+    cursor.execute(f"PRAGMA mmap_size = {profile.mmap_size}")
+    cursor.execute(f"PRAGMA busy_timeout = {profile.busy_timeout}")
+    cursor.execute("PRAGMA temp_store = MEMORY")
+    if read_only:
+        cursor.execute("PRAGMA query_only = ON")
+    cursor.close()
+
+
+def create_writer_engine(path: str, profile: StorageProfile) -> Engine:
+    """
+    Single connection shared by the writes of a process. Its transactions take the
+    database write lock as soon as they begin, so that concurrent writers of other
+    processes wait for each other instead of failing on a lock upgrade.
+    """
+    writer_engine = create_engine(
+        "sqlite:///" + path,
+        connect_args={"check_same_thread": False},
+        encoding="utf-8",
+        echo=False,
+        poolclass=QueuePool,
+        pool_size=1,
+        max_overflow=0,
+        pool_timeout=profile.busy_timeout / 1000,
+    )
+
+    @event.listens_for(writer_engine, "connect")
+    def on_connect(dbapi_connection, _):
+        # Transactions are started by the "begin" event instead of pysqlite
+        dbapi_connection.isolation_level = None
+        apply_pragmas(dbapi_connection, profile, read_only=False)
+
+    @event.listens_for(writer_engine, "begin")
+    def on_begin(connection):
+        connection.exec_driver_sql("BEGIN IMMEDIATE")
+
+    return writer_engine
+
+
+def create_reader_engine(path: str, profile: StorageProfile) -> Engine:
+    """
+    Pool of read-only connections for the endpoints only reading data.
+    """
+    reader_engine = create_engine(
+        "sqlite:///" + path,
+        connect_args={"check_same_thread": False},
+        encoding="utf-8",
+        echo=False,
+        poolclass=QueuePool,
+        pool_size=profile.read_pool_size,
+        max_overflow=profile.read_pool_size,
+    )
+
+    @event.listens_for(reader_engine, "connect")
+    def on_connect(dbapi_connection, _):
+        apply_pragmas(dbapi_connection, profile, read_only=True)
+
+    return reader_engine
+
+
+engine = create_writer_engine(PATH_DB, STORAGE_PROFILE)
+read_engine = create_reader_engine(PATH_DB, STORAGE_PROFILE)
+
+# Loaded attributes stay readable after a commit without opening a new transaction
+SessionLocal = sessionmaker(
+    autocommit=False, autoflush=False, expire_on_commit=False, bind=engine
+)
+ReadSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=read_engine)
 
 Base = declarative_base()
@@ -0,0 +1,93 @@
+"""
+Density of detections rendered from the detection clusters, as PNG map tiles.
+Each pixel of a tile is a cluster cell, of the zoom level 8 levels deeper than the
+tile, or of the deepest aggregated level.
+PNG images are encoded directly with zlib, see https://www.w3.org/TR/png/
+"""
+import math
+import struct
+import zlib
+
+import numpy as np
+
+TILE_SIZE = 256
+MEDIA_TYPE = "image/png"
+# Count of detections per cell and day range rendered with the strongest colour
+DEFAULT_MAX_COUNT = 100
+
+_PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+_RGBA = 6
+
+
+def density_grid(
+    xs: np.ndarray,
+    ys: np.ndarray,
+    counts: np.ndarray,
+    min_x: int,
+    min_y: int,
+    size: int,
+) -> np.ndarray:
+    """
+    Returns the `size` x `size` grid of counts of the cells starting at (min_x, min_y),
+    rows going south.
+    """
+    grid = np.zeros((size, size), dtype=np.int64)
+    np.add.at(grid, (ys - min_y, xs - min_x), counts)
+    return grid
+
+
+def colorize(grid: np.ndarray, max_count: int = DEFAULT_MAX_COUNT) -> np.ndarray:
+    """
+    Maps counts to RGBA pixels, from transparent through yellow to red, on a
+    logarithmic scale saturating at `max_count`.
+    """
+    intensity = np.clip(np.log1p(grid) / math.log1p(max(max_count, 1)), 0.0, 1.0)
+    pixels = np.zeros((*grid.shape, 4), dtype=np.uint8)
+    pixels[..., 0] = 255
+    pixels[..., 1] = np.round(255 * (1.0 - intensity))
+    pixels[..., 3] = np.where(grid > 0, np.round(96 + 159 * intensity), 0)
+    return pixels
+
+
+def _chunk(kind: bytes, data: bytes) -> bytes:
+    return (
+        struct.pack(">I", len(data))
+        + kind
+        + data
+        + struct.pack(">I", zlib.crc32(kind + data))
+    )
+
+
+def encode_png(pixels: np.ndarray) -> bytes:
+    """
+    Encodes an RGBA image of shape (height, width, 4).
+    """
+    height, width = np.shape(pixels)[:2]
+    # Each scanline starts with its filter type, 0 for none
+    scanlines = np.zeros((height, width * 4 + 1), dtype=np.uint8)
+    scanlines[:, 1:] = pixels.reshape(height, width * 4)
+    return (
+        _PNG_SIGNATURE
+        + _chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, _RGBA, 0, 0, 0))
+        + _chunk(b"IDAT", zlib.compress(scanlines.tobytes(), 6))
+        + _chunk(b"IEND", b"")
+    )
+
+
+def render_tile(
+    xs: np.ndarray,
+    ys: np.ndarray,
+    counts: np.ndarray,
+    min_x: int,
+    min_y: int,
+    size: int,
+    max_count: int = DEFAULT_MAX_COUNT,
+) -> bytes:
+    """
+    Renders the `size` x `size` cells starting at (min_x, min_y) as a PNG tile of
+    `TILE_SIZE` pixels.
+    """
+    grid = density_grid(xs, ys, counts, min_x, min_y, size)
+    scale = TILE_SIZE // size
+    grid = np.repeat(np.repeat(grid, scale, axis=0), scale, axis=1)
+    return encode_png(colorize(grid, max_count))
@@ -0,0 +1,289 @@
+"""
+Geographic helpers shared by the queries and the endpoints.
+Bounding boxes follow the Leaflet `toBBoxString` order: west, south, east, north.
+"""
+import math
+import re
+from typing import Iterator
+from typing import List
+from typing import NamedTuple
+from typing import Optional
+from typing import Tuple
+
+import numpy as np
+
+MAX_MERCATOR_LATITUDE = 85.0511287798
+MAX_ZOOM = 22
+
+
+class BoundingBox(NamedTuple):
+    min_longitude: float
+    min_latitude: float
+    max_longitude: float
+    max_latitude: float
+
+
+def parse_bbox(bbox: str) -> BoundingBox:
+    try:
+        min_lon, min_lat, max_lon, max_lat = (float(value) for value in bbox.split(","))
+    except ValueError:
+        raise ValueError(
+            "Bounding box should be formatted as 'min_lon,min_lat,max_lon,max_lat'."
+        )
+
+    if min_lon > max_lon or min_lat > max_lat:
+        raise ValueError("Bounding box minimum should be lower than its maximum.")
+
+    return BoundingBox(
+        max(min_lon, -180.0),
+        max(min_lat, -90.0),
+        min(max_lon, 180.0),
+        min(max_lat, 90.0),
+    )
+
+
+def lon_lat_to_tile(longitude: float, latitude: float, zoom: int) -> Tuple[int, int]:
+    """
+    Returns the slippy map tile (x, y) containing the given position at a zoom level.
+    """
+    number_of_tiles = 1 << zoom
+    latitude = max(min(latitude, MAX_MERCATOR_LATITUDE), -MAX_MERCATOR_LATITUDE)
+    lat_rad = math.radians(latitude)
+
+    x = int((longitude + 180.0) / 360.0 * number_of_tiles)
+    y = int((1.0 - math.asinh(math.tan(lat_rad)) / math.pi) / 2.0 * number_of_tiles)
+    return min(max(x, 0), number_of_tiles - 1), min(max(y, 0), number_of_tiles - 1)
+
+
+def lon_lat_to_tiles(
+    longitudes: np.ndarray, latitudes: np.ndarray, zoom: int
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Vectorized `lon_lat_to_tile`.
+    """
+    number_of_tiles = 1 << zoom
+    lat_rad = np.radians(
+        np.clip(latitudes, -MAX_MERCATOR_LATITUDE, MAX_MERCATOR_LATITUDE)
+    )
+
+    x = ((longitudes + 180.0) / 360.0 * number_of_tiles).astype(np.int64)
+    y = ((1.0 - np.arcsinh(np.tan(lat_rad)) / np.pi) / 2.0 * number_of_tiles).astype(
+        np.int64
+    )
+    return np.clip(x, 0, number_of_tiles - 1), np.clip(y, 0, number_of_tiles - 1)
+
+
+def tile_to_bbox(x: int, y: int, zoom: int) -> BoundingBox:
+    number_of_tiles = 1 << zoom
+
+    def tile_latitude(tile_y: int) -> float:
+        return math.degrees(
+            math.atan(math.sinh(math.pi * (1 - 2 * tile_y / number_of_tiles)))
+        )
+
+    return BoundingBox(
+        x / number_of_tiles * 360.0 - 180.0,
+        tile_latitude(y + 1),
+        (x + 1) / number_of_tiles * 360.0 - 180.0,
+        tile_latitude(y),
+    )
+
+
+def snap_bbox_to_tiles(bbox: BoundingBox, zoom: int) -> BoundingBox:
+    """
+    Extends a bounding box to the slippy map tiles covering it, so that small pans
+    inside the same tiles produce the same query.
+    """
+    min_x, max_y = lon_lat_to_tile(bbox.min_longitude, bbox.min_latitude, zoom)
+    max_x, min_y = lon_lat_to_tile(bbox.max_longitude, bbox.max_latitude, zoom)
+
+    top_left = tile_to_bbox(min_x, min_y, zoom)
+    bottom_right = tile_to_bbox(max_x, max_y, zoom)
+
+    # Tiles stop at the Mercator limit, keep the poles reachable
+    min_latitude = bottom_right.min_latitude
+    max_latitude = top_left.max_latitude
+    if max_y == (1 << zoom) - 1:
+        min_latitude = -90.0
+    if min_y == 0:
+        max_latitude = 90.0
+
+    return BoundingBox(
+        top_left.min_longitude,
+        min(min_latitude, bbox.min_latitude),
+        bottom_right.max_longitude,
+        max(max_latitude, bbox.max_latitude),
+    )
+
+
+def geojson_rings(geo_dict: dict) -> List[np.ndarray]:
+    """
+    Returns the exterior rings of the polygons of a FeatureCollection, as arrays of
+    (longitude, latitude) vertices. Holes are ignored.
+    """
+    rings = []
+    for feature in geo_dict.get("features", []):
+        geometry = feature.get("geometry") or {}
+        if geometry.get("type") == "Polygon":
+            polygons = [geometry["coordinates"]]
+        elif geometry.get("type") == "MultiPolygon":
+            polygons = geometry["coordinates"]
+        else:
+            continue
+        rings += [np.array(polygon[0], dtype=float)[:, :2] for polygon in polygons]
+    return rings
+
+
+def geojson_vertices(geo_dict: dict) -> np.ndarray:
+    """
+    Returns every (longitude, latitude) position of the geometries of a
+    FeatureCollection, whatever their type.
+    """
+
+    def positions(coordinates) -> Iterator[List[float]]:
+        if coordinates and isinstance(coordinates[0], (int, float)):
+            yield coordinates[:2]
+        else:
+            for child in coordinates:
+                yield from positions(child)
+
+    vertices = [
+        position
+        for feature in geo_dict.get("features", [])
+        for position in positions(
+            (feature.get("geometry") or {}).get("coordinates", [])
+        )
+    ]
+    return np.array(vertices, dtype=float).reshape(-1, 2)
+
+
+def points_near_segment(
+    longitudes: np.ndarray,
+    latitudes: np.ndarray,
+    start: Tuple[float, float],
+    end: Tuple[float, float],
+    tolerance: float,
+) -> np.ndarray:
+    """
+    Returns whether each point lies within `tolerance` degrees of a segment.
+    """
+    (x1, y1), (x2, y2) = start, end
+    dx, dy = x2 - x1, y2 - y1
+    squared_length = dx * dx + dy * dy
+    position = np.zeros(len(longitudes))
+    if squared_length:
+        position = np.clip(
+            ((longitudes - x1) * dx + (latitudes - y1) * dy) / squared_length, 0, 1
+        )
+    return (
+        np.hypot(longitudes - x1 - position * dx, latitudes - y1 - position * dy)
+        <= tolerance
+    )
+
+
+def points_in_rings(
+    longitudes: np.ndarray,
+    latitudes: np.ndarray,
+    rings: List[np.ndarray],
+    tolerance: Optional[float] = None,
+) -> np.ndarray:
+    """
+    Returns whether each point lies inside any of the rings, by ray casting.
+    Points on the edges are inside or outside depending on the edge, unless a
+    `tolerance` is given: points within `tolerance` degrees of an edge are inside.
+    """
+    inside = np.zeros(len(longitudes), dtype=bool)
+    for ring in rings:
+        in_ring = np.zeros(len(longitudes), dtype=bool)
+        for (x1, y1), (x2, y2) in zip(ring, np.roll(ring, -1, axis=0)):
+            if tolerance is not None:
+                inside |= points_near_segment(
+                    longitudes, latitudes, (x1, y1), (x2, y2), tolerance
+                )
+            if y1 == y2:
+                continue
+            crosses = (y1 > latitudes) != (y2 > latitudes)
+            crossing_longitudes = x1 + (latitudes - y1) * (x2 - x1) / (y2 - y1)
+            in_ring ^= crosses & (longitudes < crossing_longitudes)
+        inside |= in_ring
+    return inside
+
+
+def sample_geojson(geo_dict: dict, resolution: int = 32) -> Tuple[np.ndarray, ...]:
+    """
+    Returns the longitudes and latitudes of the vertices of the geometries of a
+    FeatureCollection, and of the points of a `resolution` x `resolution` grid over
+    their bounding box lying inside their polygons.
+    """
+    vertices = geojson_vertices(geo_dict)
+    rings = geojson_rings(geo_dict)
+    if not len(vertices):
+        return np.array([]), np.array([])
+
+    longitudes, latitudes = np.meshgrid(
+        np.linspace(vertices[:, 0].min(), vertices[:, 0].max(), resolution),
+        np.linspace(vertices[:, 1].min(), vertices[:, 1].max(), resolution),
+    )
+    longitudes, latitudes = longitudes.ravel(), latitudes.ravel()
+    inside = points_in_rings(longitudes, latitudes, rings)
+    return (
+        np.concatenate((vertices[:, 0], longitudes[inside])),
+        np.concatenate((vertices[:, 1], latitudes[inside])),
+    )
+
+
+def geojson_bbox(geo_dict: dict) -> Optional[BoundingBox]:
+    vertices = geojson_vertices(geo_dict)
+    if not len(vertices):
+        return None
+    return BoundingBox(*vertices.min(axis=0).tolist(), *vertices.max(axis=0).tolist())
+
+
+def wkt_bbox(wkt: str) -> Optional[BoundingBox]:
+    """
+    Returns the bounding box of the positions of a WKT geometry.
+    """
+    values = [
+        float(value) for value in re.findall(r"-?\d+(?:\.\d+)?(?:[eE]-?\d+)?", wkt)
+    ]
+    if len(values) < 2 or len(values) % 2:
+        return None
+    longitudes, latitudes = values[::2], values[1::2]
+    return BoundingBox(min(longitudes), min(latitudes), max(longitudes), max(latitudes))
+
+
+def wkt_rings(wkt: str) -> List[np.ndarray]:
+    """
+    Returns the exterior rings of a WKT Polygon or MultiPolygon, as arrays of
+    (longitude, latitude) vertices. Holes are ignored.
+    """
+    rings = []
+    # Exterior rings are the first ones of each polygon, right after two parentheses
+    for ring in re.findall(r"\(\(([^()]*)\)", wkt):
+        vertices = [position.split()[:2] for position in ring.split(",")]
+        rings.append(np.array(vertices, dtype=float).reshape(-1, 2))
+    return rings
+
+
+def intersect_bboxes(first: BoundingBox, second: BoundingBox) -> Optional[BoundingBox]:
+    intersection = BoundingBox(
+        max(first.min_longitude, second.min_longitude),
+        max(first.min_latitude, second.min_latitude),
+        min(first.max_longitude, second.max_longitude),
+        min(first.max_latitude, second.max_latitude),
+    )
+    if (
+        intersection.min_longitude > intersection.max_longitude
+        or intersection.min_latitude > intersection.max_latitude
+    ):
+        return None
+    return intersection
+
+
+def bbox_area(bbox: BoundingBox) -> float:
+    """
+    Area in square degrees, only meant to compare boxes at the same latitudes.
+    """
+    return (bbox.max_longitude - bbox.min_longitude) * (
+        bbox.max_latitude - bbox.min_latitude
+    )
@@ -0,0 +1,477 @@
+"""
+Pipelined ingestion of every product found for a request.
+Downloads run on a thread pool, SNAP graphs on a bounded process pool and the results
+are parsed and committed by a single writer. Stages are connected by bounded queues:
+a slow stage fills its input queue and holds back the previous ones.
+When the request only covers a part of a product, only that region is processed, as
+windows run in parallel.
+"""
+import hashlib
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from dataclasses import field
+from datetime import date
+from multiprocessing import get_context
+from pathlib import Path
+from queue import Queue
+from typing import Any
+from typing import Callable
+from typing import Dict
+from typing import Iterable
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+import catalogue
+import crud
+import metrics
+import numpy as np
+from database import ReadSessionLocal
+from database import SessionLocal
+from geo_helper import bbox_area
+from geo_helper import BoundingBox
+from geo_helper import geojson_bbox
+from geo_helper import intersect_bboxes
+from geo_helper import wkt_bbox
+from geojson import FeatureCollection
+from models import Tile
+from product_cache import ingested_products
+from product_cache import is_complete
+from product_cache import mark_complete
+from product_cache import ProductCache
+from product_cache import remove_output
+from result_parser import parse_metadata
+from result_parser import parse_ship_positions_columns
+from sentinel_extractor import download_sentinel_product
+from ship_detection import process
+from ship_detection import split_region
+from ship_detection import Window
+
+DOWNLOAD_WORKERS = 2
+PROCESSING_WORKERS = 2
+# Products waiting between two stages, bounds the disk used by downloaded products
+QUEUE_SIZE = 2
+# Regions covering more of a product are not worth a subset, the whole product is
+# processed and can be reused by any later request
+SUBSET_MAX_FRACTION = 0.8
+
+# Pixel positions are relative to the subset of each window, which do not share a
+# frame, merged tiles leave them out
+PIXEL_COLUMNS = ("pixel_x", "pixel_y")
+
+_DONE = object()
+
+# Output of each SNAP graph run on a product, with the window it processes, or None
+# for the whole product
+ProcessingTasks = List[Tuple[Path, Optional[Window]]]
+
+
+@dataclass
+class IngestionReport:
+    ingested: List[str] = field(default_factory=list)
+    failed: Dict[str, str] = field(default_factory=dict)
+    # Products already in the database
+    cached: List[str] = field(default_factory=list)
+    # Products adding no coverage to the selected ones
+    skipped: List[str] = field(default_factory=list)
+    # Total duration of each stage in seconds, and the metrics events of the job
+    timings: Dict[str, float] = field(default_factory=dict)
+    events: List[metrics.Event] = field(default_factory=list)
+
+
+def _run_stage(
+    function: Callable[[str, Any], Any],
+    inputs: Queue,
+    outputs: Queue,
+    workers: int,
+    report: IngestionReport,
+) -> List[threading.Thread]:
+    """
+    Starts `workers` threads applying `function` to the (product_id, value) items of
+    `inputs` and putting the results in `outputs`. A failing product is reported and
+    dropped. `outputs` receives `_DONE` once every worker is done.
+    """
+
+    def worker():
+        while True:
+            item = inputs.get()
+            if item is _DONE:
+                # Let the other workers of the stage see the end too
+                inputs.put(_DONE)
+                return
+            product_id, value = item
+            try:
+                outputs.put((product_id, function(product_id, value)))
+            except Exception as exception:
+                report.failed[product_id] = str(exception)
+
+    threads = [
+        threading.Thread(target=worker, daemon=True, name=f"ingestion-{index}")
+        for index in range(workers)
+    ]
+    for thread in threads:
+        thread.start()
+
+    def close():
+        for thread in threads:
+            thread.join()
+        outputs.put(_DONE)
+
+    closer = threading.Thread(target=close, daemon=True)
+    closer.start()
+    return threads + [closer]
+
+
+def region_key(region: BoundingBox) -> str:
+    rounded = ",".join(f"{value:.4f}" for value in region)
+    return hashlib.sha256(rounded.encode()).hexdigest()[:8]
+
+
+def dataset_name(title: str, region: Optional[BoundingBox]) -> str:
+    # Tiles of a region of a product are named after the product and the region
+    return title if region is None else f"{title}_{region_key(region)}"
+
+
+def product_region(
+    request_bbox: Optional[BoundingBox], footprint: Optional[str]
+) -> Optional[BoundingBox]:
+    """
+    Returns the region of a product to process for a request, or None to process
+    the whole product.
+    """
+    product_bbox = wkt_bbox(footprint) if footprint else None
+    if request_bbox is None or product_bbox is None:
+        return None
+    region = intersect_bboxes(request_bbox, product_bbox)
+    if region is None:
+        return None
+    if bbox_area(region) >= SUBSET_MAX_FRACTION * bbox_area(product_bbox):
+        return None
+    return region
+
+
+def processing_tasks(
+    product_path: Path, region: Optional[BoundingBox]
+) -> ProcessingTasks:
+    whole_product = product_path.with_suffix(".dim")
+    # Outputs of the whole product hold every region
+    if region is None or is_complete(whole_product):
+        return [(whole_product, None)]
+    key = region_key(region)
+    return [
+        (product_path.with_name(f"{product_path.stem}_{key}_{index}.dim"), window)
+        for index, window in enumerate(split_region(region))
+    ]
+
+
+def ingest_products(
+    product_ids: Iterable[str],
+    download: Callable[[str], Path],
+    store: Callable[[str, ProcessingTasks], None],
+    regions: Optional[Dict[str, Optional[BoundingBox]]] = None,
+    download_workers: int = DOWNLOAD_WORKERS,
+    processing_workers: int = PROCESSING_WORKERS,
+    queue_size: int = QUEUE_SIZE,
+) -> IngestionReport:
+    """
+    Downloads, processes and stores every product.
+    `download` returns the path of the downloaded product and `store` parses and
+    commits the processed outputs, it is only ever called from the calling thread.
+    Products with a region in `regions` are only processed in that region.
+    """
+    report = IngestionReport()
+    product_regions = regions or {}
+
+    to_download: Queue = Queue()
+    downloaded: Queue = Queue(maxsize=queue_size)
+    processed: Queue = Queue(maxsize=queue_size)
+
+    for product_id in product_ids:
+        to_download.put((product_id, None))
+    to_download.put(_DONE)
+
+    # Forked workers would inherit the threads and database connections of the job
+    with ProcessPoolExecutor(
+        max_workers=processing_workers, mp_context=get_context("spawn")
+    ) as process_pool:
+
+        def run_graph(product_id: str, downloaded_file: Path) -> ProcessingTasks:
+            tasks = processing_tasks(downloaded_file, product_regions.get(product_id))
+            # Windows of a product run in parallel, complete outputs of a previous
+            # run are reused
+            incomplete = [
+                (output_path, window)
+                for output_path, window in tasks
+                if not is_complete(output_path)
+            ]
+            with metrics.stage("graph"):
+                futures = []
+                for output_path, window in incomplete:
+                    remove_output(output_path)
+                    futures.append(
+                        process_pool.submit(
+                            process,
+                            downloaded_file,
+                            output_path,
+                            window.region if window is not None else None,
+                        )
+                    )
+                for (output_path, _), future in zip(incomplete, futures):
+                    future.result()
+                    mark_complete(output_path)
+            return tasks
+
+        threads = _run_stage(
+            lambda product_id, _: download(product_id),
+            to_download,
+            downloaded,
+            download_workers,
+            report,
+        )
+        threads += _run_stage(
+            run_graph, downloaded, processed, processing_workers, report
+        )
+
+        while True:
+            item = processed.get()
+            if item is _DONE:
+                break
+            product_id, tasks = item
+            try:
+                store(product_id, tasks)
+            except Exception as exception:
+                report.failed[product_id] = str(exception)
+            else:
+                report.ingested.append(product_id)
+
+        for thread in threads:
+            thread.join()
+
+    for product_id, error in report.failed.items():
+        print(f"Unable to ingest product {product_id}: {error}")
+
+    return report
+
+
+def merge_windows(
+    outputs: List[Tuple[Tile, Dict[str, np.ndarray], Window]], dataset: str
+) -> Tuple[Tile, Dict[str, np.ndarray]]:
+    """
+    Merges the outputs of the windows of a region in a single tile.
+    Detections are only kept in the core of their window, those of the overlaps are
+    found again by the neighbouring window, away from its edges.
+    """
+    tile = outputs[0][0]
+    tile.dataset = dataset
+    # Corners of the subsets are those of their own extent, None become NaN
+    latitudes = np.array(
+        [
+            (window_tile.top_left_latitude, window_tile.bottom_right_latitude)
+            for window_tile, _, _ in outputs
+        ],
+        dtype=float,
+    )
+    longitudes = np.array(
+        [
+            (window_tile.top_left_longitude, window_tile.bottom_right_longitude)
+            for window_tile, _, _ in outputs
+        ],
+        dtype=float,
+    )
+    if not np.isnan(latitudes).all() and not np.isnan(longitudes).all():
+        tile.top_left_latitude = float(np.nanmax(latitudes))
+        tile.bottom_right_latitude = float(np.nanmin(latitudes))
+        tile.top_left_longitude = float(np.nanmin(longitudes))
+        tile.bottom_right_longitude = float(np.nanmax(longitudes))
+
+    kept = []
+    for _, columns, window in outputs:
+        core = window.core
+        kept.append(
+            {
+                name: values[
+                    (columns["longitude"] >= core.min_longitude)
+                    & (columns["longitude"] < core.max_longitude)
+                    & (columns["latitude"] >= core.min_latitude)
+                    & (columns["latitude"] < core.max_latitude)
+                ]
+                for name, values in columns.items()
+                if name not in PIXEL_COLUMNS
+            }
+        )
+    columns = {
+        name: np.concatenate([window_columns[name] for window_columns in kept])
+        for name in kept[0]
+    }
+    return tile, columns
+
+
+def store_result(tasks: ProcessingTasks, dataset: str) -> str:
+    """
+    Parses and commits the outputs of a product, `dataset` names the tile of a
+    region of it. Returns the dataset of the stored tile.
+    """
+    with metrics.stage("parse"):
+        if tasks[0][1] is None:
+            processed_file = tasks[0][0]
+            tile = parse_metadata(processed_file)
+            columns = parse_ship_positions_columns(processed_file)
+        else:
+            tile, columns = merge_windows(
+                [
+                    (
+                        parse_metadata(processed_file),
+                        parse_ship_positions_columns(processed_file),
+                        window,
+                    )
+                    for processed_file, window in tasks
+                    if window is not None
+                ],
+                dataset,
+            )
+    metrics.count_rows("parse", len(columns["latitude"]))
+
+    # The tile is only visible with its duplicates removed and its clusters added
+    session = SessionLocal()
+    try:
+        with metrics.stage("insert"):
+            inserted = crud.ingest_tile(session, tile, columns, commit=False)
+        with metrics.stage("dedup"):
+            removed = crud.remove_duplicates(session, tile.dataset, commit=False)
+        with metrics.stage("clusters"):
+            clusters = crud.add_detection_clusters(session, tile.dataset, commit=False)
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+    metrics.count_rows("insert", inserted)
+    metrics.count_rows("dedup", removed)
+    metrics.count_rows("clusters", clusters)
+    return tile.dataset
+
+
+def track_tiles(datasets: Iterable[str]):
+    """
+    Links the detections of newly stored tiles to the tracks, in chronological order
+    whatever the order they were stored in.
+    """
+    read_session = ReadSessionLocal()
+    session = SessionLocal()
+    try:
+        tiles = (
+            read_session.query(Tile.dataset)
+            .filter(Tile.dataset.in_(list(datasets)))
+            .order_by(Tile.acquisition_time)
+            .all()
+        )
+        for (dataset,) in tiles:
+            with metrics.stage("tracks"):
+                metrics.count_rows(
+                    "tracks",
+                    crud.add_detections_to_tracks(read_session, session, dataset),
+                )
+    finally:
+        session.close()
+        read_session.close()
+
+
+def detect_ships_in_area(
+    geo_dict: FeatureCollection, start_time: date, end_time: date
+) -> IngestionReport:
+    api = catalogue.connect()
+    read_session = ReadSessionLocal()
+    session = SessionLocal()
+    try:
+        with metrics.stage("catalogue"):
+            products = catalogue.query_products(
+                read_session, session, api, geo_dict, start_time, end_time
+            )
+    finally:
+        session.close()
+        read_session.close()
+    metrics.count_rows("catalogue", len(products))
+    titles = {product_id: products[product_id]["title"] for product_id in products}
+
+    request_bbox = geojson_bbox(geo_dict)
+    regions = {
+        product_id: product_region(request_bbox, products[product_id].get("footprint"))
+        for product_id in products
+    }
+    datasets = {
+        product_id: dataset_name(titles[product_id], regions[product_id])
+        for product_id in products
+    }
+
+    session = ReadSessionLocal()
+    cached_datasets = ingested_products(
+        session, set(titles.values()) | set(datasets.values())
+    )
+    session.close()
+
+    cached = [
+        product_id
+        for product_id in products
+        if titles[product_id] in cached_datasets
+        or datasets[product_id] in cached_datasets
+    ]
+    selected = catalogue.select_products(products, geo_dict, preferred=cached)
+    skipped = [product_id for product_id in products if product_id not in selected]
+    to_ingest = [product_id for product_id in selected if product_id not in cached]
+
+    cache = ProductCache()
+
+    def download(product_id: str) -> Path:
+        tasks = processing_tasks(
+            cache.product_path(titles[product_id]), regions[product_id]
+        )
+        cache.acquire(titles[product_id])
+        with metrics.stage("download"):
+            return cache.fetch(
+                titles[product_id],
+                lambda: download_sentinel_product(
+                    api, product_id, str(cache.directory)
+                ),
+                [output_path for output_path, _ in tasks],
+            )
+
+    stored = []
+
+    def store(product_id: str, tasks: ProcessingTasks):
+        stored.append(store_result(tasks, datasets[product_id]))
+        cache.release(titles[product_id])
+        cache.evict()
+
+    try:
+        report = (
+            ingest_products(to_ingest, download, store, regions)
+            if to_ingest
+            else IngestionReport()
+        )
+    finally:
+        # Products which failed are not in use anymore either
+        for product_id in to_ingest:
+            cache.release(titles[product_id])
+    if stored:
+        # The detections are stored, tracks are only missing them on failure
+        try:
+            track_tiles(stored)
+        except Exception as exception:
+            print(f"Unable to track the detections of {', '.join(stored)}: {exception}")
+    report.cached = cached
+    report.skipped = skipped
+
+    if not report.ingested and not report.cached:
+        raise ValueError(
+            "\n".join(sorted(set(report.failed.values())))
+            or "Products only touch the edges of the requested area."
+        )
+
+    print(
+        f"Ingested {len(report.ingested)} out of {len(products)} products"
+        f" ({len(report.cached)} already ingested, {len(report.skipped)} skipped,"
+        f" {len(report.failed)} failed)"
+    )
+    return report
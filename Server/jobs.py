@@ -0,0 +1,272 @@
+"""
+Persistent queue of analysis jobs.
+Jobs are stored in the `jobs` table by the web process and executed by a pool of
+worker processes, so that analyses run concurrently and outside of the web process.
+"""
+import dataclasses
+import hashlib
+import json
+import multiprocessing
+import os
+from datetime import date
+from datetime import datetime
+from datetime import time
+from multiprocessing.synchronize import Event
+from typing import List
+from typing import Optional
+
+import metrics
+from database import SessionLocal
+from geo_helper import geojson_rings
+from geo_helper import points_in_rings
+from geo_helper import sample_geojson
+from geojson import FeatureCollection
+from ingestion import detect_ships_in_area
+from ingestion import IngestionReport
+from models import Job
+from sqlalchemy.orm import Session
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+ACTIVE_STATUSES = (QUEUED, RUNNING)
+FINISHED_STATUSES = (DONE, FAILED)
+
+NUMBER_OF_WORKERS = int(os.environ.get("BOATMAN_WORKERS", "2"))
+POLL_INTERVAL = 1.0  # seconds
+# Degrees, points of a request this close to the edges of a job polygon are covered
+COVERAGE_TOLERANCE = 1e-6
+
+
+def request_key(geo_dict: FeatureCollection, start_date: date, end_date: date) -> str:
+    request = json.dumps(
+        [geo_dict, str(start_date), str(end_date)], sort_keys=True, default=str
+    )
+    return hashlib.sha256(request.encode()).hexdigest()
+
+
+def submit_job(
+    db: Session,
+    geo_dict: FeatureCollection,
+    start_date: date,
+    end_date: date,
+    client_id: int,
+) -> Job:
+    """
+    Queues a job, or returns the active job already handling the same request.
+    """
+    key = request_key(geo_dict, start_date, end_date)
+
+    active_job = (
+        db.query(Job)
+        .filter(Job.request_key == key, Job.status.in_(ACTIVE_STATUSES))
+        .first()
+    )
+    if active_job is not None:
+        # Ends the transaction, which holds the write lock since its first query
+        db.commit()
+        return active_job
+
+    job = Job(
+        request_key=key,
+        request=json.dumps(geo_dict),
+        start_date=start_date,
+        end_date=end_date,
+        client_id=client_id,
+        status=QUEUED,
+        notified=False,
+        submitted_time=datetime.now(),
+    )
+    db.add(job)
+    db.commit()
+    return job
+
+
+def find_covering_job(
+    db: Session, geo_dict: FeatureCollection, start_date: date, end_date: date
+) -> Optional[Job]:
+    """
+    Returns a finished job which ingested every product of the request: submitted
+    after its end date, over a range of dates and polygons containing its own, and
+    without any failed product.
+    """
+    key = request_key(geo_dict, start_date, end_date)
+    candidates = (
+        db.query(Job)
+        .filter(
+            Job.status == DONE,
+            Job.start_date <= start_date,
+            Job.end_date >= end_date,
+            # Products acquired before the end date may still be published later
+            Job.submitted_time >= datetime.combine(end_date, time()),
+        )
+        .order_by(Job.finished_time.desc())
+    )
+
+    longitudes, latitudes = sample_geojson(geo_dict)
+    for job in candidates:
+        if json.loads(job.result)["failed"]:
+            continue
+        if job.request_key == key:
+            return job
+        rings = geojson_rings(json.loads(job.request))
+        if (
+            len(longitudes)
+            and points_in_rings(
+                longitudes, latitudes, rings, tolerance=COVERAGE_TOLERANCE
+            ).all()
+        ):
+            return job
+    return None
+
+
+def claim_job(db: Session, worker: str) -> Optional[Job]:
+    """
+    Marks the oldest queued job as running for `worker`.
+    The status is checked again by the update, so that two workers never run the
+    same job.
+    """
+    while True:
+        candidate = (
+            db.query(Job.id).filter(Job.status == QUEUED).order_by(Job.id).first()
+        )
+        if candidate is None:
+            return None
+
+        claimed = (
+            db.query(Job)
+            .filter(Job.id == candidate.id, Job.status == QUEUED)
+            .update(
+                {"status": RUNNING, "worker": worker, "started_time": datetime.now()},
+                synchronize_session=False,
+            )
+        )
+        db.commit()
+        if claimed == 1:
+            return db.get(Job, candidate.id)
+
+
+def run_job(db: Session, job: Job):
+    request = json.loads(job.request)
+    start_date, end_date = job.start_date, job.end_date
+    # Writer transactions hold the database lock, the ingestion commits on its own
+    db.commit()
+    report = IngestionReport()
+    metrics.registry.start_recording()
+    try:
+        report = detect_ships_in_area(request, start_date, end_date)
+        job.status = DONE
+    except Exception as exception:
+        job.status = FAILED
+        job.error = str(exception)
+    finally:
+        # Replayed by the web process, which serves the metrics, whatever the outcome
+        report.events = metrics.label_stage_durations(
+            metrics.registry.stop_recording(), outcome=job.status
+        )
+        report.timings = metrics.stage_durations(report.events)
+    job.result = json.dumps(dataclasses.asdict(report))
+    job.finished_time = datetime.now()
+    db.commit()
+
+
+def requeue_interrupted_jobs(db: Session):
+    """
+    Jobs still running when the server starts were interrupted by its shutdown.
+    """
+    db.query(Job).filter(Job.status == RUNNING).update(
+        {"status": QUEUED, "worker": None}, synchronize_session=False
+    )
+    db.commit()
+
+
+def pop_finished_jobs(db: Session) -> List[Job]:
+    """
+    Returns the finished jobs whose completion was not notified yet, and marks them
+    as notified.
+    """
+    jobs = (
+        db.query(Job)
+        .filter(Job.status.in_(FINISHED_STATUSES), Job.notified.is_(False))
+        .all()
+    )
+    # Detached, they are read once the session is closed
+    for job in jobs:
+        db.expunge(job)
+    db.query(Job).filter(Job.id.in_([job.id for job in jobs])).update(
+        {"notified": True}, synchronize_session=False
+    )
+    db.commit()
+    return jobs
+
+
+def fail_job(job_id: int, error: str):
+    """
+    Marks a running job as failed, after an error outside of its analysis.
+    """
+    session = SessionLocal()
+    try:
+        session.query(Job).filter(Job.id == job_id, Job.status == RUNNING).update(
+            {"status": FAILED, "error": error, "finished_time": datetime.now()},
+            synchronize_session=False,
+        )
+        session.commit()
+    except Exception as exception:
+        # Left running, it is queued again when the server restarts
+        print(f"Unable to mark job {job_id} as failed: {exception}")
+        session.rollback()
+    finally:
+        session.close()
+
+
+def run_worker(worker: str, stop: Event, poll_interval: float = POLL_INTERVAL):
+    print(f"Worker {worker} started")
+    while not stop.is_set():
+        job_id = None
+        session = SessionLocal()
+        try:
+            job = claim_job(session, worker)
+            if job is not None:
+                job_id = job.id
+                print(f"Worker {worker} runs job {job_id}")
+                run_job(session, job)
+        except Exception as exception:
+            # A database error must not stop the worker, nor leave the job running
+            print(f"Worker {worker} failed: {exception}")
+            session.close()
+            if job_id is not None:
+                fail_job(job_id, str(exception))
+        finally:
+            session.close()
+        if job_id is None:
+            stop.wait(poll_interval)
+
+
+class WorkerPool:
+    def __init__(self, number_of_workers: int = NUMBER_OF_WORKERS):
+        # Workers are not forked, SQLite connections must not be shared
+        self.context = multiprocessing.get_context("spawn")
+        self.stop = self.context.Event()
+        self.number_of_workers = number_of_workers
+        self.processes: List[multiprocessing.process.BaseProcess] = []
+
+    def start(self):
+        for index in range(self.number_of_workers):
+            process = self.context.Process(
+                target=run_worker,
+                args=(f"worker-{index}", self.stop),
+                name=f"boatman-worker-{index}",
+            )
+            process.start()
+            self.processes.append(process)
+
+    def shutdown(self, timeout: float = 5.0):
+        self.stop.set()
+        for process in self.processes:
+            process.join(timeout)
+            # A running analysis is interrupted, it will be queued again at startup
+            if process.is_alive():
+                process.terminate()
+        self.processes.clear()
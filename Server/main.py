@@ -1,36 +1,82 @@
+import asyncio
+import contextlib
 import json
+import time
 from datetime import date
-from datetime import timedelta
-from pathlib import Path
-from threading import Lock
+from typing import Dict
+from typing import Optional
+from typing import Set
+from typing import Tuple
 
+import binary_formats
 import crud
+import density
+import jobs
+import metrics
+import migrations
+import ports_index
+import response_cache
 import uvicorn
-from database import Base
+import vector_tiles
 from database import engine
-from database import PATH_DB
+from database import ReadSessionLocal
 from database import SessionLocal
-from fastapi import BackgroundTasks
+from fastapi import Body
 from fastapi import Depends
 from fastapi import FastAPI
 from fastapi import HTTPException
 from fastapi import Request
+from fastapi import Response
 from fastapi import WebSocket
 from fastapi import WebSocketDisconnect
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
-from geojson import FeatureCollection
-from models import Port
-from models import Tile
-from result_parser import parse_result
-from sentinel_extractor import download_sentinel_data
-from ship_detection import process
-from sqlalchemy import inspect
+from fastapi.responses import JSONResponse
+from fastapi.responses import PlainTextResponse
+from fastapi.responses import StreamingResponse
+from geo_helper import BoundingBox
+from geo_helper import lon_lat_to_tile
+from geo_helper import MAX_ZOOM
+from geo_helper import parse_bbox
+from geo_helper import snap_bbox_to_tiles
+from geo_helper import tile_to_bbox
+from models import Job
 from sqlalchemy.orm import Session
 from web_sockets import ConnectionManager
 
 ws_manager = ConnectionManager()
+worker_pool = jobs.WorkerPool()
+# Clients waiting for each job, identical requests share the same job
+job_subscribers: Dict[int, Set[int]] = {}
+tile_cache = vector_tiles.TileCache()
+# Detection queries, invalidated by bumping its version on each ingestion
+ships_cache = response_cache.ResponseCache()
+# Loaded once the database is migrated, ports never change afterwards
+ports: ports_index.PortsIndex = ports_index.PortsIndex([])
+# Detections up to this one were notified to the clients
+last_detection_id = 0
+
+
+@contextlib.asynccontextmanager
+async def lifespan(_: FastAPI):
+    global ports, last_detection_id
+
+    migrations.migrate(engine)
+    session = SessionLocal()
+    jobs.requeue_interrupted_jobs(session)
+    ports = ports_index.PortsIndex.load(session)
+    last_detection_id = crud.get_last_detection_id(session)
+    session.close()
+
+    worker_pool.start()
+    notifier = asyncio.create_task(notify_finished_jobs())
+    yield
+    notifier.cancel()
+    worker_pool.shutdown()
+    await ws_manager.shutdown()
+
 
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -41,137 +87,613 @@ app.add_middleware(
 )
 
 
-def ensure_ports_table():
-    session = SessionLocal()
+@app.middleware("http")
+async def measure_latency(request: Request, call_next):
+    saved = time.perf_counter()
+    response = await call_next(request)
+    # Routes are labelled by their template, whatever their parameters
+    route = request.scope.get("route")
+    metrics.registry.observe(
+        "boatman_request_duration_seconds",
+        time.perf_counter() - saved,
+        path=route.path if route is not None else "unmatched",
+        method=request.method,
+        status=str(response.status_code),
+    )
+    return response
+
+
+def get_read_db():
+    """
+    Session on the pool of read-only connections, which never wait for the writer.
+    """
+    db = ReadSessionLocal()
+    try:
+        yield db
+    finally:
+        db.close()
 
-    if inspect(engine).has_table("ports") and len(session.query(Port).all()) != 0:
-        return
-
-    print("Adding ports to the database...")
-
-    if not inspect(engine).has_table("ports"):
-        Base.metadata.create_all(engine, checkfirst=True)
-
-    with open("../Meta/ports_unique.json", "rb") as geo_f:
-        geojson = json.load(geo_f)
-    for feature in geojson["features"]:
-        session.add(
-            Port(
-                locode=feature["properties"]["LOCODE"],
-                country=feature["properties"]["Country"],
-                name=feature["properties"]["NameWoDiac"],
-                outflows=feature["properties"]["outflows"],
-                latitude=feature["geometry"]["coordinates"][1],
-                longitude=feature["geometry"]["coordinates"][0],
-            )
+
+def invalidate_ingested_tiles(since_id: int) -> int:
+    """
+    Drops the cached tiles around the detections inserted after `since_id`, returns
+    the id of the last detection.
+    """
+    session = ReadSessionLocal()
+    try:
+        last_id = crud.get_last_detection_id(session)
+        bbox = (
+            crud.get_detections_bbox(session, since_id) if last_id > since_id else None
         )
-    session.commit()
-    session.close()
+    finally:
+        session.close()
+    if bbox is not None:
+        tile_cache.invalidate("ships", bbox)
+        tile_cache.invalidate("density", bbox)
+    return last_id
+
+
+async def notify_finished_job(job: Job):
+    global last_detection_id
+
+    clients = job_subscribers.pop(job.id, {job.client_id})
+    metrics.registry.inc("boatman_jobs_total", status=job.status)
+    # Stages of failed jobs are recorded too
+    if job.result:
+        metrics.registry.replay(json.loads(job.result).get("events", []))
+
+    # Failed jobs may have stored some of their products, the last detection tells
+    since_id = last_detection_id
+    last_detection_id = await run_in_threadpool(invalidate_ingested_tiles, since_id)
+    if last_detection_id > since_id:
+        ships_cache.bump_version()
+        # Clients only fetch the detections inserted after `since_id`
+        with metrics.stage("broadcast"):
+            await ws_manager.send_to_all(
+                json.dumps({"type": "update_ships", "since_id": since_id})
+            )
+    for client_id in clients:
+        if job.status == jobs.FAILED:
+            if not await ws_manager.send_to_client(client_id, job.error):
+                print(f"Error for client with ID({client_id}): {job.error}")
+        await ws_manager.send_to_client(client_id, "unblock")
 
 
-db_creation_lock = Lock()
+async def notify_finished_jobs():
+    """
+    Forwards the completion of the jobs run by the workers to the clients.
+    """
+    while True:
+        session = SessionLocal()
+        try:
+            finished_jobs = await run_in_threadpool(jobs.pop_finished_jobs, session)
+        except Exception as exception:
+            print(f"Unable to read finished jobs: {exception}")
+            finished_jobs = []
+        finally:
+            session.close()
 
+        for job in finished_jobs:
+            try:
+                await notify_finished_job(job)
+            except Exception as exception:
+                print(f"Unable to notify completion of job {job.id}: {exception}")
 
-def get_db():
-    global db_creation_lock
-    with db_creation_lock:
-        if not Path(PATH_DB).exists():
-            Base.metadata.create_all(engine)
-        ensure_ports_table()
+        await asyncio.sleep(jobs.POLL_INTERVAL)
 
-    db = SessionLocal()
+
+MEDIA_TYPES = {"csv": "text/csv", "geojson": "application/geo+json"}
+
+
+def stream_ships(
+    start_date: date,
+    end_date: date,
+    data_type: str,
+    bounding_box: Optional[BoundingBox],
+    since_id: Optional[int],
+):
+    # The request session is closed when the endpoint returns, before the body is
+    # sent, so the stream owns its session.
+    session = ReadSessionLocal()
     try:
-        yield db
+        yield from crud.stream_detections(
+            session, start_date, end_date, data_type, bounding_box, since_id=since_id
+        )
     finally:
-        db.close()
+        session.close()
+
+
+def encode_ships(
+    db: Session,
+    start_date: date,
+    end_date: date,
+    data_type: str,
+    bounding_box: Optional[BoundingBox],
+    since_id: Optional[int],
+) -> response_cache.CachedResponse:
+    if data_type in binary_formats.MEDIA_TYPES:
+        columns = crud.get_detection_columns(
+            db, start_date, end_date, bounding_box, since_id
+        )
+        content = binary_formats.encode_detections(columns, data_type)
+        media_type = binary_formats.MEDIA_TYPES[data_type]
+    else:
+        detections = crud.get_detections(
+            db, start_date, end_date, data_type, bounding_box, since_id
+        )
+        if data_type == "geojson" and detections is not None:
+            # Already encoded, skip FastAPI JSON encoding
+            content = detections.encode()
+            media_type = MEDIA_TYPES[data_type]
+        else:
+            response = JSONResponse(detections)
+            content, media_type = response.body, response.media_type
+    return response_cache.CachedResponse(
+        content, response_cache.make_etag(content), media_type
+    )
+
+
+def conditional_response(
+    request: Request, cached: response_cache.CachedResponse
+) -> Response:
+    # Clients revalidate with the ETag, responses change when products are ingested
+    headers = {"ETag": cached.etag, "Cache-Control": "no-cache"}
+    if response_cache.etag_matches(cached.etag, request.headers.get("if-none-match")):
+        return Response(status_code=304, headers=headers)
+    return Response(cached.content, media_type=cached.media_type, headers=headers)
 
 
-def detect_ships_in_area(
-    geo_dict: FeatureCollection,
-    start_time: date = date.today() - timedelta(days=5),
-    end_time: date = date.today(),
+@app.get("/ships.geojson")
+def get_ships(
+    request: Request,
+    start_date: date,
+    end_date: date,
+    data_type: str = "geojson",
+    bbox: Optional[str] = None,
+    zoom: Optional[int] = None,
+    stream: bool = False,
+    since_id: Optional[int] = None,
+    db: Session = Depends(get_read_db),
 ):
+    if end_date < start_date:
+        raise HTTPException(
+            status_code=406, detail="End date should be later than start date."
+        )
 
-    downloaded_file = download_sentinel_data(geo_dict, start_time, end_time)
+    bounding_box = None
+    if bbox is not None:
+        try:
+            bounding_box = parse_bbox(bbox)
+        except ValueError as error:
+            raise HTTPException(status_code=406, detail=str(error))
+        if zoom is not None:
+            bounding_box = snap_bbox_to_tiles(bounding_box, min(max(zoom, 0), MAX_ZOOM))
+    elif zoom is not None:
+        raise HTTPException(
+            status_code=406, detail="A zoom level requires a bounding box."
+        )
 
-    if downloaded_file is None:
-        raise FileNotFoundError("Error while downloading the file.")
+    if stream:
+        if data_type not in MEDIA_TYPES:
+            raise HTTPException(
+                status_code=406, detail=f"Unable to stream data type: {data_type}."
+            )
+        return StreamingResponse(
+            stream_ships(start_date, end_date, data_type, bounding_box, since_id),
+            media_type=MEDIA_TYPES[data_type],
+        )
 
-    process(downloaded_file)
-    db_result = parse_result(downloaded_file)
+    if data_type in binary_formats.MEDIA_TYPES:
+        if not binary_formats.is_available(data_type):
+            raise HTTPException(
+                status_code=406,
+                detail=f"Data type {data_type} requires"
+                f" {binary_formats.REQUIRED_LIBRARIES[data_type]} on the server.",
+            )
 
-    session = next(get_db())
+    # Read before querying: a response racing an ingestion is cached under the
+    # version it is outdated by
+    key = (
+        ships_cache.version,
+        start_date,
+        end_date,
+        data_type,
+        bounding_box,
+        since_id,
+    )
+    cached = ships_cache.get(key)
+    if cached is None:
+        cached = encode_ships(
+            db, start_date, end_date, data_type, bounding_box, since_id
+        )
+        ships_cache.put(key, cached)
+    return conditional_response(request, cached)
 
-    if (
-        session.query(Tile.dataset).filter_by(dataset=db_result.dataset).scalar()
-        is not None
-    ):
-        raise ValueError("Product already exists in database.")
-    else:
-        session.add(db_result)
-        session.commit()
 
-    crud.remove_duplicates(session)
+@app.get("/clusters.geojson")
+def get_clusters(
+    start_date: date,
+    end_date: date,
+    zoom: int,
+    bbox: Optional[str] = None,
+    db: Session = Depends(get_read_db),
+):
+    if end_date < start_date:
+        raise HTTPException(
+            status_code=406, detail="End date should be later than start date."
+        )
+    if not 0 <= zoom <= crud.CLUSTER_MAX_ZOOM:
+        raise HTTPException(
+            status_code=406,
+            detail=f"Clusters are only available up to zoom {crud.CLUSTER_MAX_ZOOM}.",
+        )
+
+    bounding_box = None
+    if bbox is not None:
+        try:
+            bounding_box = parse_bbox(bbox)
+        except ValueError as error:
+            raise HTTPException(status_code=406, detail=str(error))
+
+    return crud.get_clusters(db, start_date, end_date, zoom, bounding_box)
+
+
+@app.get("/density.json")
+def get_density(
+    start_date: date,
+    end_date: date,
+    zoom: int,
+    bbox: Optional[str] = None,
+    db: Session = Depends(get_read_db),
+):
+    if end_date < start_date:
+        raise HTTPException(
+            status_code=406, detail="End date should be later than start date."
+        )
+    if not 0 <= zoom <= crud.CLUSTER_MAX_ZOOM:
+        raise HTTPException(
+            status_code=406,
+            detail=f"Density is only available up to zoom {crud.CLUSTER_MAX_ZOOM}.",
+        )
+
+    min_x, min_y, max_x, max_y = 0, 0, (1 << zoom) - 1, (1 << zoom) - 1
+    if bbox is not None:
+        try:
+            bounding_box = parse_bbox(bbox)
+        except ValueError as error:
+            raise HTTPException(status_code=406, detail=str(error))
+        min_x, max_y = lon_lat_to_tile(
+            bounding_box.min_longitude, bounding_box.min_latitude, zoom
+        )
+        max_x, min_y = lon_lat_to_tile(
+            bounding_box.max_longitude, bounding_box.max_latitude, zoom
+        )
+
+    cells = crud.get_density(db, start_date, end_date, zoom, min_x, min_y, max_x, max_y)
+    # Columns of the non-empty slippy map cells
+    return {"zoom": zoom, **{name: values.tolist() for name, values in cells.items()}}
 
 
-def error_handler(
-    geo_dict: FeatureCollection, client_id: int, start_time: date, end_time: date
+@app.get("/density/{z}/{x}/{y}.png")
+def get_density_tile(
+    request: Request,
+    z: int,
+    x: int,
+    y: int,
+    start_date: date,
+    end_date: date,
+    max_count: int = density.DEFAULT_MAX_COUNT,
+    db: Session = Depends(get_read_db),
 ):
-    def logger_for_unidentified_clients(local_client_id: int, message: str):
-        print(f"Error for client with ID({local_client_id}): {message}")
+    if not 0 <= z <= MAX_ZOOM or not (0 <= x < 1 << z and 0 <= y < 1 << z):
+        raise HTTPException(status_code=404, detail=f"Unknown tile: {z}/{x}/{y}.")
+    if end_date < start_date:
+        raise HTTPException(
+            status_code=406, detail="End date should be later than start date."
+        )
 
-    try:
-        detect_ships_in_area(geo_dict, start_time, end_time)
-    except Exception as exception:
-        ws_manager.send_text_to_client(
-            client_id, str(exception), logger_for_unidentified_clients
+    key = vector_tiles.TileKey("density", z, x, y, (start_date, end_date, max_count))
+    tile = tile_cache.get(key)
+    if tile is None:
+        version = tile_cache.version
+        # Cells as small as a pixel, down to the deepest aggregated zoom level
+        cell_zoom = min(z + 8, crud.CLUSTER_MAX_ZOOM)
+        if cell_zoom >= z:
+            size = 1 << (cell_zoom - z)
+            min_x, min_y = x * size, y * size
+        else:
+            size = 1
+            min_x, min_y = x >> (z - cell_zoom), y >> (z - cell_zoom)
+        cells = crud.get_density(
+            db,
+            start_date,
+            end_date,
+            cell_zoom,
+            min_x,
+            min_y,
+            min_x + size - 1,
+            min_y + size - 1,
         )
-    else:
-        ws_manager.broadcast("update_ships")
-    finally:
-        ws_manager.unblock_clients()
+        tile = vector_tiles.make_cached_tile(
+            density.render_tile(
+                cells["x"], cells["y"], cells["count"], min_x, min_y, size, max_count
+            )
+        )
+        tile_cache.put(key, tile, version)
 
+    return conditional_response(
+        request,
+        response_cache.CachedResponse(tile.content, tile.etag, density.MEDIA_TYPE),
+    )
 
-@app.get("/ships.geojson")
-def get_ships(
+
+@app.get("/tracks.geojson")
+def get_tracks(
     start_date: date,
     end_date: date,
-    data_type: str = "geojson",
-    db: Session = Depends(get_db),
+    bbox: Optional[str] = None,
+    min_detections: int = 2,
+    detection_id: Optional[int] = None,
+    db: Session = Depends(get_read_db),
 ):
     if end_date < start_date:
         raise HTTPException(
             status_code=406, detail="End date should be later than start date."
         )
-    return crud.get_detections(db, start_date, end_date, data_type)
+
+    bounding_box = None
+    if bbox is not None:
+        try:
+            bounding_box = parse_bbox(bbox)
+        except ValueError as error:
+            raise HTTPException(status_code=406, detail=str(error))
+
+    return crud.get_tracks(
+        db, start_date, end_date, bounding_box, min_detections, detection_id
+    )
 
 
 @app.get("/ports.geojson")
-def get_ports(
-    number: int = 50,
-    db: Session = Depends(get_db),
+def get_ports(number: int = 50, bbox: Optional[str] = None):
+    if bbox is None:
+        return Response(ports.top(number), media_type=MEDIA_TYPES["geojson"])
+
+    try:
+        bounding_box = parse_bbox(bbox)
+    except ValueError as error:
+        raise HTTPException(status_code=406, detail=str(error))
+    ranks = ports.in_bbox(bounding_box)
+    # Negative numbers select every port, like a SQLite LIMIT
+    if number >= 0:
+        ranks = ranks[:number]
+    return Response(ports.encode(ranks.tolist()), media_type=MEDIA_TYPES["geojson"])
+
+
+@app.get("/ports/nearest")
+def get_nearest_port(longitude: float, latitude: float):
+    if not (-180 <= longitude <= 180 and -90 <= latitude <= 90):
+        raise HTTPException(
+            status_code=406, detail=f"Invalid position: {longitude}, {latitude}."
+        )
+    nearest = ports.nearest_port(longitude, latitude)
+    if nearest is None:
+        raise HTTPException(status_code=404, detail="No port available.")
+    feature, distance = nearest
+    return Response(
+        f'{{"port":{feature},"distance":{distance:.3f}}}',
+        media_type="application/json",
+    )
+
+
+VECTOR_TILE_LAYERS = ("ships", "ports")
+# Below this zoom level, ships tiles hold the clusters of the detections
+SHIPS_TILES_MIN_ZOOM = 8
+# Clusters of about 64 x 64 cells per tile
+SHIPS_CLUSTER_ZOOM_OFFSET = 6
+MAX_TILE_FEATURES = 20000
+
+
+def encode_vector_tile(
+    db: Session,
+    layer: str,
+    z: int,
+    x: int,
+    y: int,
+    start_date: Optional[date],
+    end_date: Optional[date],
+) -> bytes:
+    bbox = tile_to_bbox(x, y, z)
+    if layer == "ports":
+        features = (
+            vector_tiles.PointFeature(
+                ports.longitudes[rank], ports.latitudes[rank], ports.properties[rank]
+            )
+            for rank in ports.in_bbox(bbox).tolist()
+        )
+    elif start_date is None or end_date is None:
+        raise ValueError("Ships tiles require a start and end date.")
+    elif z < SHIPS_TILES_MIN_ZOOM:
+        # Too many detections to list, one point per cluster of the rollups instead
+        cluster_zoom = min(z + SHIPS_CLUSTER_ZOOM_OFFSET, crud.CLUSTER_MAX_ZOOM)
+        shift = cluster_zoom - z
+        clusters = crud.get_clusters(db, start_date, end_date, cluster_zoom, bbox)
+        features = (
+            vector_tiles.PointFeature(
+                feature["geometry"]["coordinates"][0],
+                feature["geometry"]["coordinates"][1],
+                {"count": feature["properties"]["count"]},
+            )
+            for feature in clusters["features"]
+            # The bounding box also reaches the cells along the edges of the tile
+            if feature["properties"]["x"] >> shift == x
+            and feature["properties"]["y"] >> shift == y
+        )
+    else:
+        rows = crud.query_detection_rows(db, start_date, end_date, bbox)
+        features = (
+            vector_tiles.PointFeature(
+                row.longitude,
+                row.latitude,
+                {
+                    "width": row.width,
+                    "length": row.length,
+                    "acquisition_time": str(
+                        row.acquisition_time.replace(microsecond=0)
+                    ),
+                },
+                row.id,
+            )
+            for row in rows.limit(MAX_TILE_FEATURES)
+        )
+    return vector_tiles.encode_tile(
+        [vector_tiles.encode_layer(layer, features, z, x, y)]
+    )
+
+
+@app.get("/tiles/{layer}/{z}/{x}/{y}.pbf")
+def get_vector_tile(
+    request: Request,
+    layer: str,
+    z: int,
+    x: int,
+    y: int,
+    start_date: Optional[date] = None,
+    end_date: Optional[date] = None,
+    db: Session = Depends(get_read_db),
 ):
-    return crud.get_ports(db, number)
+    if layer not in VECTOR_TILE_LAYERS:
+        raise HTTPException(status_code=404, detail=f"Unknown layer: {layer}.")
+    if not 0 <= z <= MAX_ZOOM or not (0 <= x < 1 << z and 0 <= y < 1 << z):
+        raise HTTPException(status_code=404, detail=f"Unknown tile: {z}/{x}/{y}.")
+    if layer == "ships":
+        if start_date is None or end_date is None:
+            raise HTTPException(
+                status_code=406, detail="Ships tiles require a start and end date."
+            )
+        if end_date < start_date:
+            raise HTTPException(
+                status_code=406, detail="End date should be later than start date."
+            )
+    else:
+        # Ports do not depend on dates, tiles are shared by every request
+        start_date = end_date = None
+
+    key = vector_tiles.TileKey(layer, z, x, y, (start_date, end_date))
+    tile = tile_cache.get(key)
+    if tile is None:
+        version = tile_cache.version
+        tile = vector_tiles.make_cached_tile(
+            encode_vector_tile(db, layer, z, x, y, start_date, end_date)
+        )
+        tile_cache.put(key, tile, version)
+
+    return conditional_response(
+        request,
+        response_cache.CachedResponse(tile.content, tile.etag, vector_tiles.MEDIA_TYPE),
+    )
+
+
+def find_or_submit_job(
+    geo_dict: dict, start_date: date, end_date: date, client_id: int
+) -> Tuple[Job, bool]:
+    """
+    Returns the job handling a request and whether it is an already finished one.
+    Only the submission of a new job takes the write lock.
+    """
+    read_db = ReadSessionLocal()
+    try:
+        covering_job = jobs.find_covering_job(read_db, geo_dict, start_date, end_date)
+    finally:
+        read_db.close()
+    if covering_job is not None:
+        return covering_job, True
+
+    db = SessionLocal()
+    try:
+        return jobs.submit_job(db, geo_dict, start_date, end_date, client_id), False
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+
+def read_job(job_id: int) -> Job:
+    read_db = ReadSessionLocal()
+    try:
+        return read_db.get(Job, job_id)
+    finally:
+        read_db.close()
 
 
 @app.post("/polygon")
 async def get_polygon_data(
-    background_tasks: BackgroundTasks,
     req: Request,
     start_date: date,
     end_date: date,
     client_id: int = 0,
 ):
     geo_dict = await req.json()
-    await ws_manager.awaitable_block_clients()
-    background_tasks.add_task(error_handler, geo_dict, client_id, start_date, end_date)
+    job, finished = await run_in_threadpool(
+        find_or_submit_job, geo_dict, start_date, end_date, client_id
+    )
+    if finished:
+        # Every product was already ingested, there is nothing to wait for
+        await ws_manager.send_to_client(client_id, "unblock")
+        return {"job_id": job.id, "status": job.status}
+
+    job_subscribers.setdefault(job.id, set()).add(client_id)
+    await ws_manager.send_to_client(client_id, "block")
+
+    # The job may have finished, and its subscribers been notified, before the client
+    # subscribed to it
+    job = await run_in_threadpool(read_job, job.id)
+    if job.status in jobs.FINISHED_STATUSES:
+        subscribers = job_subscribers.get(job.id, set())
+        subscribers.discard(client_id)
+        if not subscribers:
+            job_subscribers.pop(job.id, None)
+        if job.status == jobs.FAILED:
+            await ws_manager.send_to_client(client_id, job.error)
+        await ws_manager.send_to_client(client_id, "unblock")
+    return {"job_id": job.id, "status": job.status}
+
+
+@app.post("/coverage")
+def get_coverage(
+    start_date: date,
+    end_date: date,
+    geo_dict: dict = Body(...),
+    db: Session = Depends(get_read_db),
+):
+    if end_date < start_date:
+        raise HTTPException(
+            status_code=406, detail="End date should be later than start date."
+        )
+    coverage = crud.get_coverage(db, geo_dict, start_date, end_date)
+    covering_job = jobs.find_covering_job(db, geo_dict, start_date, end_date)
+    return {**coverage, "covering_job_id": covering_job.id if covering_job else None}
+
+
+@app.get("/jobs/{job_id}")
+def get_job(job_id: int, db: Session = Depends(get_read_db)):
+    job = db.get(Job, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Unknown job: {job_id}.")
+    return job.to_dict()
+
+
+@app.get("/metrics")
+def get_metrics():
+    return PlainTextResponse(
+        metrics.registry.render(),
+        media_type="text/plain; version=0.0.4; charset=utf-8",
+    )
 
 
 @app.websocket("/ws/{client_id}")
 async def websocket_endpoint(websocket: WebSocket, client_id: int):
     await ws_manager.connect(websocket, client_id)
-    if ws_manager.is_blocking:
-        await ws_manager.awaitable_block_clients()
     try:
         while True:
             data = await websocket.receive_text()
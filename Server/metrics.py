@@ -0,0 +1,214 @@
+"""
+Counters and histograms of the server, exposed in the Prometheus text format by
+`/metrics`, see https://prometheus.io/docs/instrumenting/exposition_formats/
+Analysis jobs run in the worker processes: the metrics they record are kept as a
+list of events, returned with the result of the job and replayed in the web process
+when it is notified of the completion.
+"""
+import contextlib
+import math
+import threading
+import time
+from typing import Dict
+from typing import Iterator
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+COUNTER = "counter"
+HISTOGRAM = "histogram"
+
+# Type and help of every metric
+METRICS = {
+    "boatman_stage_duration_seconds": (
+        HISTOGRAM,
+        "Duration of the stages of the analysis jobs, per product.",
+    ),
+    "boatman_stage_bytes_total": (COUNTER, "Bytes transferred by the stages."),
+    "boatman_stage_rows_total": (COUNTER, "Rows produced by the stages."),
+    "boatman_jobs_total": (COUNTER, "Finished analysis jobs."),
+    "boatman_request_duration_seconds": (
+        HISTOGRAM,
+        "Latency of the HTTP requests, until the response starts.",
+    ),
+}
+
+BUCKETS = {
+    # Stages last from milliseconds for cached products to tens of minutes
+    "boatman_stage_duration_seconds": (
+        0.01,
+        0.1,
+        0.5,
+        1.0,
+        5.0,
+        10.0,
+        30.0,
+        60.0,
+        120.0,
+        300.0,
+        600.0,
+        1800.0,
+    ),
+    "boatman_request_duration_seconds": (
+        0.001,
+        0.005,
+        0.01,
+        0.025,
+        0.05,
+        0.1,
+        0.25,
+        0.5,
+        1.0,
+        2.5,
+        5.0,
+        10.0,
+    ),
+}
+
+Labels = Tuple[Tuple[str, str], ...]
+# Metric name, labels and value, of a counter increment or a histogram observation
+Event = Tuple[str, Dict[str, str], float]
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels: Labels) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in labels) + "}"
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value))
+
+
+class Registry:
+    def __init__(self):
+        self.counters: Dict[Tuple[str, Labels], float] = {}
+        # Count of each bucket, then sum and count of the observations
+        self.histograms: Dict[Tuple[str, Labels], List[float]] = {}
+        self.events: Optional[List[Event]] = None
+        self.lock = threading.Lock()
+
+    def start_recording(self):
+        """
+        Keeps the events recorded from now on, until `stop_recording`.
+        """
+        with self.lock:
+            self.events = []
+
+    def stop_recording(self) -> List[Event]:
+        with self.lock:
+            events, self.events = self.events or [], None
+        return events
+
+    def inc(self, name: str, value: float = 1.0, **labels: str):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0.0) + value
+            if self.events is not None:
+                self.events.append((name, labels, value))
+
+    def observe(self, name: str, value: float, **labels: str):
+        key = (name, tuple(sorted(labels.items())))
+        buckets = BUCKETS[name]
+        with self.lock:
+            histogram = self.histograms.setdefault(key, [0.0] * (len(buckets) + 2))
+            for index, bound in enumerate(buckets):
+                if value <= bound:
+                    histogram[index] += 1
+            histogram[-2] += value
+            histogram[-1] += 1
+            if self.events is not None:
+                self.events.append((name, labels, value))
+
+    def replay(self, events: List[Event]):
+        for name, labels, value in events:
+            if METRICS[name][0] == HISTOGRAM:
+                self.observe(name, value, **labels)
+            else:
+                self.inc(name, value, **labels)
+
+    def render(self) -> str:
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted(self.histograms.items())
+
+        lines = []
+        for name, (kind, description) in METRICS.items():
+            lines += [f"# HELP {name} {description}", f"# TYPE {name} {kind}"]
+            if kind == COUNTER:
+                lines += [
+                    f"{name}{_format_labels(labels)} {_format_value(value)}"
+                    for (metric, labels), value in counters
+                    if metric == name
+                ]
+                continue
+            for (metric, labels), histogram in histograms:
+                if metric != name:
+                    continue
+                bounds = BUCKETS[name] + (math.inf,)
+                counts = histogram[: len(BUCKETS[name])] + [histogram[-1]]
+                lines += [
+                    f"{name}_bucket{_format_labels(labels + (('le', _format_value(bound)),))}"
+                    f" {_format_value(count)}"
+                    for bound, count in zip(bounds, counts)
+                ]
+                lines += [
+                    f"{name}_sum{_format_labels(labels)} {_format_value(histogram[-2])}",
+                    f"{name}_count{_format_labels(labels)} {_format_value(histogram[-1])}",
+                ]
+        return "\n".join(lines) + "\n"
+
+
+# Metrics of the current process
+registry = Registry()
+
+
+@contextlib.contextmanager
+def stage(name: str) -> Iterator[None]:
+    """
+    Records the duration of a stage of an analysis job, even when it fails.
+    """
+    saved = time.perf_counter()
+    try:
+        yield
+    finally:
+        registry.observe(
+            "boatman_stage_duration_seconds", time.perf_counter() - saved, stage=name
+        )
+
+
+def count_bytes(stage_name: str, value: int):
+    registry.inc("boatman_stage_bytes_total", value, stage=stage_name)
+
+
+def count_rows(stage_name: str, value: int):
+    registry.inc("boatman_stage_rows_total", value, stage=stage_name)
+
+
+def label_stage_durations(events: List[Event], **labels: str) -> List[Event]:
+    """
+    Adds labels to the stage durations of the events, e.g. the outcome of their job.
+    """
+    return [
+        (name, {**event_labels, **labels}, value)
+        if name == "boatman_stage_duration_seconds"
+        else (name, event_labels, value)
+        for name, event_labels, value in events
+    ]
+
+
+def stage_durations(events: List[Event]) -> Dict[str, float]:
+    """
+    Returns the total duration of each stage of the events, in seconds.
+    """
+    durations: Dict[str, float] = {}
+    for name, labels, value in events:
+        if name == "boatman_stage_duration_seconds":
+            durations[labels["stage"]] = durations.get(labels["stage"], 0.0) + value
+    return durations
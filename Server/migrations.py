@@ -0,0 +1,139 @@
+"""
+Versioned schema of the database.
+The version of a database is stored in its `user_version` pragma, and the migrations
+it misses are applied once, when the server starts. Databases created before the
+schema was versioned are at version 0, so every migration must be idempotent.
+"""
+import json
+from pathlib import Path
+from typing import Callable
+from typing import List
+
+import crud
+from models import CatalogueProduct
+from models import CatalogueQuery
+from models import create_spatial_index
+from models import create_tiles_footprint_index
+from models import Detection
+from models import DetectionCluster
+from models import Job
+from models import Port
+from models import Tile
+from models import Track
+from models import TrackSegment
+from sqlalchemy import func
+from sqlalchemy import insert
+from sqlalchemy import select
+from sqlalchemy.engine import Connection
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+
+PORTS_FILE = Path("../Meta/ports_unique.json")
+
+
+def create_tables(connection: Connection):
+    for table in (Tile.__table__, Detection.__table__, Port.__table__, Job.__table__):
+        table.create(connection, checkfirst=True)
+
+
+def create_indexes(connection: Connection):
+    for table in (Detection.__table__, Tile.__table__):
+        for index in table.indexes:
+            index.create(connection, checkfirst=True)
+    create_spatial_index(connection)
+
+
+def seed_ports(connection: Connection):
+    if connection.execute(select(func.count()).select_from(Port)).scalar():
+        return
+
+    print("Adding ports to the database...")
+    with open(PORTS_FILE, "rb") as geo_f:
+        geojson = json.load(geo_f)
+    connection.execute(
+        insert(Port),
+        [
+            {
+                "locode": feature["properties"]["LOCODE"],
+                "country": feature["properties"]["Country"],
+                "name": feature["properties"]["NameWoDiac"],
+                "outflows": feature["properties"]["outflows"],
+                "latitude": feature["geometry"]["coordinates"][1],
+                "longitude": feature["geometry"]["coordinates"][0],
+            }
+            for feature in geojson["features"]
+        ],
+    )
+
+
+def create_detection_clusters(connection: Connection):
+    DetectionCluster.__table__.create(connection, checkfirst=True)
+
+    # Session joining the migration transaction, its commits do not end it
+    session = Session(bind=connection)
+    for (dataset,) in session.query(Tile.dataset).all():
+        crud.add_detection_clusters(session, dataset)
+    session.close()
+
+
+def create_tracks(connection: Connection):
+    for table in (Track.__table__, TrackSegment.__table__):
+        table.create(connection, checkfirst=True)
+
+
+def track_stored_tiles(engine: Engine):
+    """
+    Links the detections of the tiles stored before the tracks existed, once the
+    migration is committed: tracks are matched between the short write transactions
+    of each tile instead of within the migration one.
+    """
+    with Session(bind=engine) as session:
+        tiles = session.query(Tile.dataset).order_by(Tile.acquisition_time).all()
+        session.commit()
+        for (dataset,) in tiles:
+            crud.add_detections_to_tracks(session, session, dataset)
+
+
+def create_catalogue(connection: Connection):
+    for table in (CatalogueProduct.__table__, CatalogueQuery.__table__):
+        table.create(connection, checkfirst=True)
+
+
+# Append only, the position of a migration is the version it upgrades to
+MIGRATIONS: List[Callable[[Connection], None]] = [
+    create_tables,
+    create_indexes,
+    seed_ports,
+    create_detection_clusters,
+    create_tiles_footprint_index,
+    create_tracks,
+    create_catalogue,
+]
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+def get_schema_version(connection: Connection) -> int:
+    return connection.exec_driver_sql("PRAGMA user_version").scalar()
+
+
+def migrate(engine: Engine) -> int:
+    """
+    Upgrades the database to `SCHEMA_VERSION` in a single transaction and returns
+    the version it was at.
+    """
+    with engine.begin() as connection:
+        version = get_schema_version(connection)
+        if version > SCHEMA_VERSION:
+            raise RuntimeError(
+                f"Database schema version {version} is newer than the server"
+                f" ({SCHEMA_VERSION})."
+            )
+
+        for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+            print(f"Migrating database to version {number}: {migration.__name__}")
+            migration(connection)
+        connection.exec_driver_sql(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
+    if version < MIGRATIONS.index(create_tracks) + 1:
+        track_stored_tiles(engine)
+    return version
@@ -1,12 +1,21 @@
+import json
+
 from database import Base
 from geojson import Feature
 from geojson import Point
+from sqlalchemy import Boolean
 from sqlalchemy import Column
+from sqlalchemy import column
+from sqlalchemy import Date
 from sqlalchemy import DateTime
+from sqlalchemy import DDL
+from sqlalchemy import event
 from sqlalchemy import Float
 from sqlalchemy import ForeignKey
 from sqlalchemy import Integer
 from sqlalchemy import String
+from sqlalchemy import table
+from sqlalchemy.engine import Connection
 from sqlalchemy.orm import relationship
 
 
@@ -15,7 +24,7 @@ class Detection(Base):
 
     id = Column(Integer, primary_key=True, index=True)
 
-    tile_dataset = Column(String, ForeignKey("tiles.dataset"))
+    tile_dataset = Column(String, ForeignKey("tiles.dataset"), index=True)
     tile = relationship("Tile", back_populates="detections")
 
     width = Column(Float)
@@ -80,7 +89,7 @@ class Tile(Base):
     image_width = Column(Integer)
     image_height = Column(Integer)
 
-    acquisition_time = Column(DateTime)
+    acquisition_time = Column(DateTime, index=True)
     esa_processed_time = Column(DateTime)
     processed_time = Column(DateTime)
 
@@ -101,6 +110,120 @@ class Tile(Base):
         )
 
 
+# R*Tree over detection positions, kept in sync with `detections` by triggers.
+# It is not part of the ORM metadata as SQLAlchemy can't create virtual tables.
+detections_rtree = table(
+    "detections_rtree",
+    column("id"),
+    column("min_latitude"),
+    column("max_latitude"),
+    column("min_longitude"),
+    column("max_longitude"),
+)
+
+SPATIAL_INDEX_STATEMENTS = (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS detections_rtree USING rtree("
+    "id, min_latitude, max_latitude, min_longitude, max_longitude)",
+    "CREATE TRIGGER IF NOT EXISTS detections_rtree_insert AFTER INSERT ON detections"
+    " WHEN new.latitude IS NOT NULL AND new.longitude IS NOT NULL BEGIN"
+    " INSERT INTO detections_rtree VALUES"
+    " (new.id, new.latitude, new.latitude, new.longitude, new.longitude);"
+    " END",
+    "CREATE TRIGGER IF NOT EXISTS detections_rtree_update"
+    " AFTER UPDATE OF latitude, longitude ON detections BEGIN"
+    " DELETE FROM detections_rtree WHERE id = old.id;"
+    " INSERT INTO detections_rtree SELECT"
+    " new.id, new.latitude, new.latitude, new.longitude, new.longitude"
+    " WHERE new.latitude IS NOT NULL AND new.longitude IS NOT NULL;"
+    " END",
+    "CREATE TRIGGER IF NOT EXISTS detections_rtree_delete AFTER DELETE ON detections"
+    " BEGIN DELETE FROM detections_rtree WHERE id = old.id; END",
+)
+
+for spatial_index_statement in SPATIAL_INDEX_STATEMENTS:
+    event.listen(Detection.__table__, "after_create", DDL(spatial_index_statement))
+
+
+def create_spatial_index(connection: Connection):
+    """
+    Creates the detections R*Tree on an existing database and fills it with the
+    detections inserted before it existed.
+    """
+    for statement in SPATIAL_INDEX_STATEMENTS:
+        connection.exec_driver_sql(statement)
+    connection.exec_driver_sql(
+        "INSERT INTO detections_rtree"
+        " SELECT id, latitude, latitude, longitude, longitude FROM detections"
+        " WHERE latitude IS NOT NULL AND longitude IS NOT NULL"
+        " AND id NOT IN (SELECT id FROM detections_rtree)"
+    )
+
+
+# R*Tree over the footprints of the tiles: the bounding box of their corners and of
+# their detections, which the corners of a tilted swath do not always enclose.
+# Filled at ingestion, tiles are never updated.
+tiles_rtree = table(
+    "tiles_rtree",
+    column("id"),
+    column("min_latitude"),
+    column("max_latitude"),
+    column("min_longitude"),
+    column("max_longitude"),
+    column("dataset"),
+)
+
+TILES_RTREE_STATEMENT = (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS tiles_rtree USING rtree("
+    "id, min_latitude, max_latitude, min_longitude, max_longitude, +dataset)"
+)
+
+event.listen(Tile.__table__, "after_create", DDL(TILES_RTREE_STATEMENT))
+
+
+def create_tiles_footprint_index(connection: Connection):
+    """
+    Creates the tiles R*Tree on an existing database and fills it with the
+    footprints of the tiles ingested before it existed.
+    """
+    connection.exec_driver_sql(TILES_RTREE_STATEMENT)
+    connection.exec_driver_sql(
+        "INSERT INTO tiles_rtree"
+        " (min_latitude, max_latitude, min_longitude, max_longitude, dataset)"
+        " SELECT min(min_latitude), max(max_latitude),"
+        " min(min_longitude), max(max_longitude), dataset FROM ("
+        "  SELECT min(top_left_latitude, bottom_right_latitude) AS min_latitude,"
+        "  max(top_left_latitude, bottom_right_latitude) AS max_latitude,"
+        "  min(top_left_longitude, bottom_right_longitude) AS min_longitude,"
+        "  max(top_left_longitude, bottom_right_longitude) AS max_longitude,"
+        "  dataset FROM tiles"
+        "  UNION ALL"
+        "  SELECT min(latitude), max(latitude), min(longitude), max(longitude),"
+        "  tile_dataset FROM detections GROUP BY tile_dataset"
+        " )"
+        " WHERE dataset NOT IN (SELECT dataset FROM tiles_rtree)"
+        " GROUP BY dataset HAVING min(min_latitude) IS NOT NULL"
+    )
+
+
+class DetectionCluster(Base):
+    """
+    Number of detections and sum of their positions per slippy map tile, zoom level
+    and acquisition day. Maintained at ingestion, so that low zoom levels never read
+    the detections.
+    """
+
+    __tablename__ = "detection_clusters"
+
+    zoom = Column(Integer, primary_key=True)
+    day = Column(Date, primary_key=True)
+    x = Column(Integer, primary_key=True)
+    y = Column(Integer, primary_key=True)
+
+    count = Column(Integer)
+    sum_latitude = Column(Float)
+    sum_longitude = Column(Float)
+
+
 class Port(Base):
     __tablename__ = "ports"
 
@@ -123,3 +246,111 @@ class Port(Base):
                 "outflows": self.outflows,
             },
         )
+
+
+class Job(Base):
+    __tablename__ = "jobs"
+
+    id = Column(Integer, primary_key=True, index=True)
+
+    # Identical polygon and dates requests share the same key
+    request_key = Column(String, index=True)
+    request = Column(String)
+    start_date = Column(Date)
+    end_date = Column(Date)
+    client_id = Column(Integer)
+
+    status = Column(String, index=True)
+    worker = Column(String)
+    result = Column(String)
+    error = Column(String)
+    # Whether the web process has notified the clients of the job completion
+    notified = Column(Boolean, default=False)
+
+    submitted_time = Column(DateTime)
+    started_time = Column(DateTime)
+    finished_time = Column(DateTime)
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "status": self.status,
+            "start_date": str(self.start_date),
+            "end_date": str(self.end_date),
+            "submitted_time": str(self.submitted_time),
+            "started_time": str(self.started_time) if self.started_time else None,
+            "finished_time": str(self.finished_time) if self.finished_time else None,
+            "result": json.loads(self.result) if self.result else None,
+            "error": self.error,
+        }
+
+
+class Track(Base):
+    """
+    Trajectory of a vessel, detections linked across tiles at ingestion.
+    The last detection and velocity are kept to extend the track with the next tiles.
+    """
+
+    __tablename__ = "tracks"
+
+    id = Column(Integer, primary_key=True)
+
+    start_time = Column(DateTime)
+    end_time = Column(DateTime, index=True)
+    number_of_detections = Column(Integer)
+
+    last_detection_id = Column(Integer)
+    last_latitude = Column(Float)
+    last_longitude = Column(Float)
+    last_length = Column(Float)
+    last_width = Column(Float)
+    # km/h, from the two last detections
+    velocity_east = Column(Float)
+    velocity_north = Column(Float)
+
+
+class TrackSegment(Base):
+    """
+    Link from a detection to the previous detection of its track, None for the first
+    one. Every detection with a position belongs to a track.
+    """
+
+    __tablename__ = "track_segments"
+
+    detection_id = Column(Integer, ForeignKey("detections.id"), primary_key=True)
+    track_id = Column(Integer, ForeignKey("tracks.id"), index=True)
+    previous_detection_id = Column(Integer)
+
+    acquisition_time = Column(DateTime)
+    # Knots, from the previous detection
+    speed = Column(Float)
+
+
+class CatalogueProduct(Base):
+    """
+    Product found in the catalogue of the Copernicus hub, with its footprint.
+    """
+
+    __tablename__ = "catalogue_products"
+
+    # Identifier of the product on the hub
+    id = Column(String, primary_key=True)
+    title = Column(String)
+    # WKT, in longitude latitude order
+    footprint = Column(String)
+    acquisition_time = Column(DateTime)
+    size = Column(String)
+
+
+class CatalogueQuery(Base):
+    """
+    Products returned by the hub for a footprint and a date range, reused for
+    `catalogue.QUERY_TTL`.
+    """
+
+    __tablename__ = "catalogue_queries"
+
+    key = Column(String, primary_key=True)
+    queried_time = Column(DateTime)
+    # JSON list of the product identifiers, in the order of the hub
+    product_ids = Column(String)
@@ -0,0 +1,157 @@
+"""
+In-memory index of the ports, which never change once seeded.
+Ports are held in arrays sorted by decreasing outflows, with their GeoJSON features
+encoded once. A grid of cells serves the bounding box queries and nearest ports are
+found on unit vectors, by a single matrix product.
+"""
+import json
+import math
+import threading
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Sequence
+from typing import Tuple
+
+import numpy as np
+from geo_helper import BoundingBox
+from models import Port
+from sqlalchemy.orm import Session
+
+GRID_CELL_SIZE = 5.0  # degrees
+EARTH_RADIUS = 6371.0  # km
+# Detections compared to every port at once, bounds the size of the matrix product
+NEAREST_BATCH_SIZE = 4096
+
+
+def _unit_vectors(longitudes: np.ndarray, latitudes: np.ndarray) -> np.ndarray:
+    longitudes, latitudes = np.radians(longitudes), np.radians(latitudes)
+    return np.stack(
+        (
+            np.cos(latitudes) * np.cos(longitudes),
+            np.cos(latitudes) * np.sin(longitudes),
+            np.sin(latitudes),
+        ),
+        axis=-1,
+    )
+
+
+def _cell(longitude: float, latitude: float) -> Tuple[int, int]:
+    return (
+        math.floor((longitude + 180.0) / GRID_CELL_SIZE),
+        math.floor((latitude + 90.0) / GRID_CELL_SIZE),
+    )
+
+
+class PortsIndex:
+    def __init__(self, ports: Sequence[Port]):
+        ports = sorted(
+            (
+                port
+                for port in ports
+                if port.longitude is not None and port.latitude is not None
+            ),
+            key=lambda port: -(port.outflows or 0.0),
+        )
+        self.locodes = [port.locode for port in ports]
+        self.longitudes = np.array([port.longitude for port in ports], dtype=float)
+        self.latitudes = np.array([port.latitude for port in ports], dtype=float)
+        features = [port.to_geojson() for port in ports]
+        self.properties = [feature["properties"] for feature in features]
+        self.features = [
+            json.dumps(feature, separators=(",", ":")) for feature in features
+        ]
+        self.vectors = _unit_vectors(self.longitudes, self.latitudes)
+
+        # Ranks of the ports of each cell, in increasing order hence by outflows
+        grid: Dict[Tuple[int, int], List[int]] = {}
+        for rank, (longitude, latitude) in enumerate(
+            zip(self.longitudes.tolist(), self.latitudes.tolist())
+        ):
+            grid.setdefault(_cell(longitude, latitude), []).append(rank)
+        self.grid = {cell: np.array(ranks) for cell, ranks in grid.items()}
+
+        self.encoded_top: Dict[int, bytes] = {}
+        self.lock = threading.Lock()
+
+    @classmethod
+    def load(cls, db: Session) -> "PortsIndex":
+        return cls(db.query(Port).all())
+
+    def __len__(self) -> int:
+        return len(self.locodes)
+
+    def encode(self, ranks: Sequence[int]) -> bytes:
+        features = ",".join(self.features[rank] for rank in ranks)
+        return f'{{"type":"FeatureCollection","features":[{features}]}}'.encode()
+
+    def top(self, number: int) -> bytes:
+        """
+        Returns the encoded collection of the `number` ports with most outflows, or of
+        every port when `number` is negative, like a SQLite LIMIT.
+        """
+        number = len(self) if number < 0 else min(number, len(self))
+        encoded = self.encoded_top.get(number)
+        if encoded is None:
+            encoded = self.encode(range(number))
+            with self.lock:
+                self.encoded_top[number] = encoded
+        return encoded
+
+    def in_bbox(self, bbox: BoundingBox) -> np.ndarray:
+        """
+        Returns the ranks of the ports inside `bbox`, by decreasing outflows.
+        """
+        min_x, min_y = _cell(bbox.min_longitude, bbox.min_latitude)
+        max_x, max_y = _cell(bbox.max_longitude, bbox.max_latitude)
+        candidates = [
+            self.grid[(x, y)]
+            for x in range(min_x, max_x + 1)
+            for y in range(min_y, max_y + 1)
+            if (x, y) in self.grid
+        ]
+        if not candidates:
+            return np.array([], dtype=int)
+
+        ranks = np.sort(np.concatenate(candidates))
+        inside = (
+            (self.longitudes[ranks] >= bbox.min_longitude)
+            & (self.longitudes[ranks] <= bbox.max_longitude)
+            & (self.latitudes[ranks] >= bbox.min_latitude)
+            & (self.latitudes[ranks] <= bbox.max_latitude)
+        )
+        return ranks[inside]
+
+    def nearest(
+        self, longitudes: np.ndarray, latitudes: np.ndarray
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Returns the rank of the nearest port of each position, and its great circle
+        distance in kilometres.
+        """
+        positions = _unit_vectors(
+            np.asarray(longitudes, dtype=float), np.asarray(latitudes, dtype=float)
+        ).reshape(-1, 3)
+        ranks = np.empty(len(positions), dtype=int)
+        cosines = np.empty(len(positions))
+        for start in range(0, len(positions), NEAREST_BATCH_SIZE):
+            batch = slice(start, start + NEAREST_BATCH_SIZE)
+            # The nearest port has the largest cosine with the position
+            products = positions[batch] @ self.vectors.T
+            ranks[batch] = products.argmax(axis=1)
+            cosines[batch] = np.take_along_axis(
+                products, ranks[batch, np.newaxis], axis=1
+            )[:, 0]
+        return ranks, np.arccos(np.clip(cosines, -1.0, 1.0)) * EARTH_RADIUS
+
+    def nearest_port(
+        self, longitude: float, latitude: float
+    ) -> Optional[Tuple[str, float]]:
+        """
+        Returns the encoded feature of the port nearest to a position, and its
+        distance in kilometres.
+        """
+        if not len(self):
+            return None
+        ranks, distances = self.nearest(np.array([longitude]), np.array([latitude]))
+        return self.features[ranks[0]], float(distances[0])
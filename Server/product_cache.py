@@ -0,0 +1,156 @@
+"""
+Cache of the Sentinel products, on disk and in the database.
+A product already in the `tiles` table is never downloaded nor processed again, and a
+product whose complete SNAP outputs are on disk is only parsed. Raw `.zip` inputs of
+processed products are evicted, least recently used first, to stay under a disk
+quota, except those still used by an ingestion of any worker process.
+"""
+import os
+import shutil
+from pathlib import Path
+from typing import Callable
+from typing import Iterable
+from typing import Sequence
+from typing import Set
+
+from models import Tile
+from sqlalchemy.orm import Session
+
+DATA_DIRECTORY = Path("Data")
+DISK_QUOTA = int(float(os.environ.get("BOATMAN_DISK_QUOTA_GB", "50")) * 1024**3)
+
+
+def ingested_products(db: Session, titles: Iterable[str]) -> Set[str]:
+    """
+    Returns the product titles already stored as tiles.
+    """
+    titles = list(titles)
+    if not titles:
+        return set()
+    rows = db.query(Tile.dataset).filter(Tile.dataset.in_(titles)).all()
+    return {row.dataset for row in rows}
+
+
+def is_complete(output: Path) -> bool:
+    """
+    Whether the SNAP graph writing `output` succeeded. A graph killed while running
+    leaves its outputs without the completion marker.
+    """
+    return output.with_suffix(".done").exists()
+
+
+def mark_complete(output: Path):
+    output.with_suffix(".done").touch()
+
+
+def remove_output(output: Path):
+    """
+    Removes the outputs of an incomplete run of a graph, before running it again.
+    """
+    output.with_suffix(".done").unlink(missing_ok=True)
+    output.unlink(missing_ok=True)
+    shutil.rmtree(output.with_suffix(".data"), ignore_errors=True)
+
+
+def _is_running(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class ProductCache:
+    def __init__(self, directory: Path = DATA_DIRECTORY, quota: int = DISK_QUOTA):
+        self.directory = Path(directory)
+        self.quota = quota
+
+    def product_path(self, title: str) -> Path:
+        # Name given by sentinelsat to downloaded products
+        return self.directory / f"{title}.zip"
+
+    def _in_use_marker(self, title: str) -> Path:
+        return self.directory / f"{title}.{os.getpid()}.inuse"
+
+    def acquire(self, title: str):
+        """
+        Protects the raw product from eviction until `release`, or until the end of
+        the process.
+        """
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._in_use_marker(title).touch()
+
+    def release(self, title: str):
+        self._in_use_marker(title).unlink(missing_ok=True)
+
+    def in_use(self) -> Set[str]:
+        """
+        Returns the titles of the products acquired by running processes, and removes
+        the markers left by processes which did not release them.
+        """
+        titles = set()
+        for marker in self.directory.glob("*.inuse"):
+            title, _, pid = marker.name[: -len(".inuse")].rpartition(".")
+            if pid.isdigit() and _is_running(int(pid)):
+                titles.add(title)
+            else:
+                marker.unlink(missing_ok=True)
+        return titles
+
+    def is_processed(self, title: str) -> bool:
+        return is_complete(self.product_path(title).with_suffix(".dim"))
+
+    def fetch(
+        self,
+        title: str,
+        download: Callable[[], Path],
+        outputs: Sequence[Path] = (),
+    ) -> Path:
+        """
+        Returns the path of a product, only calling `download` when neither the raw
+        product nor its complete processed outputs are on disk. `outputs` are the
+        outputs of the regions of the product to process, when it is not processed
+        whole.
+        """
+        product_path = self.product_path(title)
+        if self.is_processed(title):
+            return product_path
+        if outputs and all(is_complete(output) for output in outputs):
+            return product_path
+        if product_path.exists():
+            # Access time is not reliable on every mount, mtime tracks the last use
+            os.utime(product_path)
+            return product_path
+        return download()
+
+    def evict(self):
+        """
+        Deletes the raw inputs of processed products which are not in use, least
+        recently used first, until they fit in the quota.
+        """
+        in_use = self.in_use()
+        evictable = [
+            path
+            for path in self.directory.glob("*.zip")
+            if path.stem not in in_use
+            and (
+                is_complete(path.with_suffix(".dim"))
+                # Outputs of regions of the product
+                or any(
+                    is_complete(output)
+                    for output in path.parent.glob(f"{path.stem}_*.dim")
+                )
+            )
+        ]
+        used = sum(path.stat().st_size for path in evictable)
+        if used <= self.quota:
+            return
+
+        for path in sorted(evictable, key=lambda path: path.stat().st_mtime):
+            if used <= self.quota:
+                break
+            used -= path.stat().st_size
+            path.unlink()
+            print(f"Evicted {path.name} from the products cache")
@@ -0,0 +1,75 @@
+"""
+In-memory cache of encoded responses, with their ETag.
+Entries are keyed by the query parameters and the data version, which is bumped
+whenever products are ingested: entries of older versions are never read again and
+leave the cache as the least recently used ones.
+"""
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from typing import Hashable
+from typing import NamedTuple
+from typing import Optional
+from typing import Tuple
+
+MAX_SIZE = int(float(os.environ.get("BOATMAN_RESPONSE_CACHE_MB", "256")) * 1024**2)
+
+
+class CachedResponse(NamedTuple):
+    content: bytes
+    etag: str
+    media_type: str
+
+
+def make_etag(content: bytes) -> str:
+    # Strong validator, quoted as required by the ETag header
+    digest = hashlib.blake2b(content, digest_size=16).hexdigest()
+    return f'"{digest}"'
+
+
+def etag_matches(etag: str, if_none_match: Optional[str]) -> bool:
+    if not if_none_match:
+        return False
+    return etag in (tag.strip() for tag in if_none_match.split(","))
+
+
+class ResponseCache:
+    """
+    Least recently used cache of responses, bounded by the size of their content.
+    A `max_size` of 0 disables the cache.
+    """
+
+    def __init__(self, max_size: int = MAX_SIZE):
+        self.max_size = max_size
+        self.size = 0
+        self.version = 0
+        self.responses: "OrderedDict[Tuple[Hashable, ...], CachedResponse]" = (
+            OrderedDict()
+        )
+        self.lock = threading.Lock()
+
+    def bump_version(self) -> int:
+        with self.lock:
+            self.version += 1
+            return self.version
+
+    def get(self, key: Tuple[Hashable, ...]) -> Optional[CachedResponse]:
+        with self.lock:
+            response = self.responses.get(key)
+            if response is not None:
+                self.responses.move_to_end(key)
+            return response
+
+    def put(self, key: Tuple[Hashable, ...], response: CachedResponse):
+        if len(response.content) > self.max_size:
+            return
+        with self.lock:
+            previous = self.responses.pop(key, None)
+            if previous is not None:
+                self.size -= len(previous.content)
+            self.responses[key] = response
+            self.size += len(response.content)
+            while self.size > self.max_size:
+                _, evicted = self.responses.popitem(last=False)
+                self.size -= len(evicted.content)
@@ -2,19 +2,37 @@
 A function to parse `gpt` results.
 Result files are simple CSV with boat positions.
 """
-import csv
+import warnings
 import xml.etree.ElementTree as ElementTree
 from datetime import datetime
 from pathlib import Path
+from typing import Any
+from typing import Callable
+from typing import Dict
 from typing import List
 from typing import Optional
 
-from locale_helper import locale_context
+import numpy as np
 from models import Detection
 from models import Tile
 
 
-def parse_ship_positions(input_data: Path):
+# Columns of the SNAP detections file for each detection attribute
+DETECTION_COLUMNS = {
+    "pixel_x": "Detected_x:Integer",
+    "pixel_y": "Detected_y:Integer",
+    "latitude": "Detected_lat:Double",
+    "longitude": "Detected_lon:Double",
+    "width": "Detected_width:Double",
+    "length": "Detected_length:Double",
+}
+INTEGER_COLUMNS = ("pixel_x", "pixel_y")
+
+
+def parse_ship_positions_columns(input_data: Path) -> Dict[str, np.ndarray]:
+    """
+    Reads the detections file in one pass into one array per detection attribute.
+    """
     expected_result_path = (
         input_data.with_suffix(".data") / "vector_data/ShipDetections.csv"
     )
@@ -22,25 +40,135 @@ def parse_ship_positions(input_data: Path):
     if not expected_result_path.exists():
         raise FileNotFoundError(f"Unable to open: {expected_result_path}")
 
-    positions: List[Detection] = []
-
     with open(expected_result_path, newline="") as csvfile:
-        filtered_file = filter(lambda row: row[0] != "#", csvfile)
-
-        reader = csv.DictReader(filtered_file, delimiter="\t")
-
-        for row in reader:
-            positions.append(
-                Detection(
-                    pixel_x=int(row["Detected_x:Integer"]),
-                    pixel_y=int(row["Detected_y:Integer"]),
-                    latitude=float(row["Detected_lat:Double"]),
-                    longitude=float(row["Detected_lon:Double"]),
-                    width=float(row["Detected_width:Double"]),
-                    length=float(row["Detected_length:Double"]),
-                )
+        header: List[str] = []
+        for line in csvfile:
+            if line[0] != "#":
+                header = line.rstrip("\r\n").split("\t")
+                break
+
+        try:
+            columns = [header.index(name) for name in DETECTION_COLUMNS.values()]
+        except ValueError:
+            raise ValueError(f"Unexpected detections header in {expected_result_path}")
+
+        with warnings.catch_warnings():
+            # A scene without any detection is not an error
+            warnings.simplefilter("ignore", UserWarning)
+            # Only whole lines are comments, values such as style_css colours hold
+            # a "#"
+            values = np.loadtxt(
+                (line for line in csvfile if not line.startswith("#")),
+                delimiter="\t",
+                comments=None,
+                usecols=columns,
+                ndmin=2,
+                dtype=np.float64,
             )
-    return positions
+
+    return {
+        attribute: values[:, index].astype(np.int64)
+        if attribute in INTEGER_COLUMNS
+        else values[:, index]
+        for index, attribute in enumerate(DETECTION_COLUMNS)
+    }
+
+
+def parse_ship_positions(input_data: Path) -> List[Detection]:
+    columns = parse_ship_positions_columns(input_data)
+    rows = zip(*(columns[attribute].tolist() for attribute in DETECTION_COLUMNS))
+    return [Detection(**dict(zip(DETECTION_COLUMNS, row))) for row in rows]
+
+
+MONTHS = {
+    month: index + 1
+    for index, month in enumerate(
+        (
+            "JAN",
+            "FEB",
+            "MAR",
+            "APR",
+            "MAY",
+            "JUN",
+            "JUL",
+            "AUG",
+            "SEP",
+            "OCT",
+            "NOV",
+            "DEC",
+        )
+    )
+}
+
+
+def parse_snap_time(text: str) -> datetime:
+    """
+    Parses SNAP dates such as 12-OCT-2022 22:48:41.866898 without depending on the
+    process locale, which `strptime` does for month names.
+    """
+    try:
+        day, month, rest = text.split("-", 2)
+        year, clock = rest.split(" ")
+        hours, minutes, seconds = clock.split(":")
+        seconds, _, fraction = seconds.partition(".")
+        return datetime(
+            int(year),
+            MONTHS[month.upper()],
+            int(day),
+            int(hours),
+            int(minutes),
+            int(seconds),
+            int(fraction[:6].ljust(6, "0")),
+        )
+    except (KeyError, ValueError):
+        raise ValueError(f"Unable to parse date: {text}")
+
+
+# Abstracted metadata attributes read from the `.dim` file, with their parser
+METADATA_ATTRIBUTES: Dict[str, Callable[[str], Any]] = {
+    "PRODUCT": str,
+    "SPH_DESCRIPTOR": str,
+    "PASS": str,
+    "num_output_lines": int,
+    "num_samples_per_line": int,
+    "first_line_time": parse_snap_time,
+    "last_line_time": parse_snap_time,
+    "PROC_TIME": parse_snap_time,
+    "first_near_lat": float,
+    "first_near_long": float,
+    "first_far_lat": float,
+    "first_far_long": float,
+    "last_near_lat": float,
+    "last_near_long": float,
+    "last_far_lat": float,
+    "last_far_long": float,
+}
+METADATA_PATH = ["Dataset_Sources", "MDElem", "MDElem", "MDATTR"]
+
+
+def parse_metadata_attributes(dim_path: Path) -> Dict[str, Any]:
+    attributes: Dict[str, Any] = {}
+    path: List[str] = []
+
+    for event, element in ElementTree.iterparse(dim_path, events=("start", "end")):
+        if event == "start":
+            path.append(element.tag)
+            continue
+
+        # The root element is not part of the searched path
+        if path[1:] == METADATA_PATH:
+            name = element.get("name")
+            if name in METADATA_ATTRIBUTES:
+                attributes[name] = METADATA_ATTRIBUTES[name](str(element.text))
+                # Abstracted metadata come first, the rest of the file is skipped
+                if len(attributes) == len(METADATA_ATTRIBUTES):
+                    break
+        path.pop()
+        # Only a few attributes are needed, the tree is not kept in memory
+        if element.tag in ("MDATTR", "MDElem") and len(path) > 1:
+            element.clear()
+
+    return attributes
 
 
 def parse_metadata(input_data: Path):
@@ -49,60 +177,20 @@ def parse_metadata(input_data: Path):
     if not expected_result_path.exists():
         raise FileNotFoundError(f"Unable to open: {expected_result_path}")
 
+    attributes = parse_metadata_attributes(expected_result_path)
+
     result: Tile = Tile()
 
     result.input_path = str(input_data)
+    result.dataset = attributes.get("PRODUCT")
+    result.descriptor = attributes.get("SPH_DESCRIPTOR")
+    result.orbit_type = attributes.get("PASS")
+    result.image_height = attributes.get("num_output_lines")
+    result.image_width = attributes.get("num_samples_per_line")
+    result.esa_processed_time = attributes.get("PROC_TIME")
 
-    first_line_time: Optional[datetime] = None
-    last_line_time: Optional[datetime] = None
-
-    positions = {
-        "first_near_lat": Optional[float],
-        "first_near_long": Optional[float],
-        "first_far_lat": Optional[float],
-        "first_far_long": Optional[float],
-        "last_near_lat": Optional[float],
-        "last_near_long": Optional[float],
-        "last_far_lat": Optional[float],
-        "last_far_long": Optional[float],
-    }
-
-    root = ElementTree.parse(expected_result_path).getroot()
-
-    # FIXME: Somehow we are still changing something here, abbreviated
-    #  months will loose their final points after this
-    with locale_context("C"):
-        for type_tag in root.findall("Dataset_Sources/MDElem/MDElem/MDATTR"):
-            value = type_tag.get("name")
-            if value == "PRODUCT":
-                result.dataset = type_tag.text
-            if value == "SPH_DESCRIPTOR":
-                result.descriptor = type_tag.text
-
-            if value == "PASS":
-                result.orbit_type = type_tag.text
-
-            if value == "num_output_lines":
-                result.image_height = int(str(type_tag.text))
-            if value == "num_samples_per_line":
-                result.image_width = int(str(type_tag.text))
-
-            if value == "first_line_time":
-                # Format should match 12-OCT-2022 22:48:41.866898
-                first_line_time = datetime.strptime(
-                    str(type_tag.text), "%d-%b-%Y %H:%M:%S.%f"
-                )
-            if value == "last_line_time":
-                last_line_time = datetime.strptime(
-                    str(type_tag.text), "%d-%b-%Y %H:%M:%S.%f"
-                )
-            if value == "PROC_TIME":
-                result.esa_processed_time = datetime.strptime(
-                    str(type_tag.text), "%d-%b-%Y %H:%M:%S.%f"
-                )
-
-            if value in positions.keys():
-                positions[str(value)] = float(str(type_tag.text))
+    first_line_time: Optional[datetime] = attributes.get("first_line_time")
+    last_line_time: Optional[datetime] = attributes.get("last_line_time")
 
     if first_line_time is not None and last_line_time is not None:
         delta = last_line_time - first_line_time
@@ -113,15 +201,15 @@ def parse_metadata(input_data: Path):
     result.processed_time = datetime.now()
 
     if result.orbit_type == "DESCENDING":
-        result.top_left_latitude = positions["first_far_lat"]
-        result.top_left_longitude = positions["first_near_long"]
-        result.bottom_right_latitude = positions["last_near_lat"]
-        result.bottom_right_longitude = positions["last_far_long"]
+        result.top_left_latitude = attributes.get("first_far_lat")
+        result.top_left_longitude = attributes.get("first_near_long")
+        result.bottom_right_latitude = attributes.get("last_near_lat")
+        result.bottom_right_longitude = attributes.get("last_far_long")
     else:  # "ASCENDING"
-        result.top_left_latitude = positions["first_near_lat"]
-        result.top_left_longitude = positions["first_far_long"]
-        result.bottom_right_latitude = positions["last_far_lat"]
-        result.bottom_right_longitude = positions["last_near_long"]
+        result.top_left_latitude = attributes.get("first_near_lat")
+        result.top_left_longitude = attributes.get("first_far_long")
+        result.bottom_right_latitude = attributes.get("last_far_lat")
+        result.bottom_right_longitude = attributes.get("last_near_long")
 
     return result
 
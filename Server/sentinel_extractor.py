@@ -1,39 +1,67 @@
 """
 This module handles everything related to the download of files from the Copernicus Open Access Hub.
+Products are downloaded in chunks fetched in parallel with HTTP range requests. The
+chunks already written are recorded next to the partial file, so that an
+interrupted download resumes where it stopped, and the file is checked against the
+MD5 checksum of the catalogue before being renamed.
 """
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import date
 from pathlib import Path
+from typing import Optional
+from typing import Set
 
+import metrics
+import requests
 from geojson import FeatureCollection
 from sentinelsat import geojson_to_wkt
 from sentinelsat import SentinelAPI
+from sentinelsat.exceptions import InvalidChecksumError
 
+CHUNK_SIZE = 32 * 1024**2
+READ_SIZE = 1024**2
+# Connections opened per product, and products downloaded at once by a process
+CONNECTIONS = int(os.environ.get("BOATMAN_DOWNLOAD_CONNECTIONS", "4"))
+MAX_CONCURRENT_DOWNLOADS = int(os.environ.get("BOATMAN_CONCURRENT_DOWNLOADS", "2"))
+CHUNK_RETRIES = 3
+TIMEOUT = 60  # seconds without data before a connection is dropped
 
-def download_sentinel_data(
+_RETRIED_ERRORS = (
+    requests.ConnectionError,
+    requests.Timeout,
+    requests.exceptions.ChunkedEncodingError,
+)
+
+_download_slots = threading.BoundedSemaphore(MAX_CONCURRENT_DOWNLOADS)
+
+
+def query_sentinel_products(
+    api: SentinelAPI,
     request_geojson: FeatureCollection,
     start_date: date,
     end_date: date,
-    directory_path: str = "Data/",
     platformname: str = "Sentinel-1",
     producttype: str = "GRD",
-) -> Path:
+) -> OrderedDict:
     """
-    This function download data from the Copernicus Open Access Hub based on a geojson.
-    The geojson specifies the region of interest in which data is queried.
-
-    Note that you need to put your login credentials in a file to use this code, see the README
-    for more information.
+    Queries the products intersecting the polygons of a geojson between two dates.
+    Products are returned in antichronological order, as given by the hub.
 
     Parameters
     ----------
+    api: SentinelAPI
+        Connection to the Copernicus Open Access Hub.
     request_geojson: FeatureCollection
         Geojson object containing polygon in which data in queried.
     start_date: :obj:`date`
         Start date at which data is queried.
     end_date: :obj:`date`
         End date at which data is queried.
-    directory_path: str
-        Indicates the path where the data will be downloaded (default to '.').
     platformname: str
         Indicates the platform used (default to 'Sentinel-1').
     producttype: str
@@ -46,7 +74,6 @@ def download_sentinel_data(
     if len(request_geojson["features"]) == 0:
         raise ValueError("No polygon provided.")
 
-    api = SentinelAPI(None, None)
     footprint = geojson_to_wkt(request_geojson)
 
     products = api.query(
@@ -61,11 +88,170 @@ def download_sentinel_data(
             "Unable to find a product with corresponding dates or positions."
         )
 
-    # Usually, products are added to the OrderedDict in antichronological order,
-    # it means that popping the first entered item should return us the last product.
-    latest_product_id = products.popitem(last=False)[0]
-    result = api.download_all([latest_product_id], directory_path=directory_path)
+    return products
+
+
+def _read_done_chunks(chunks_path: Path) -> Set[int]:
+    try:
+        return set(json.loads(chunks_path.read_text()))
+    except (OSError, ValueError):
+        return set()
+
+
+def _supports_ranges(session: requests.Session, url: str) -> bool:
+    response = session.get(
+        url, headers={"Range": "bytes=0-0"}, stream=True, timeout=TIMEOUT
+    )
+    with response:
+        response.raise_for_status()
+        return response.status_code == 206
+
+
+def _download_chunk(
+    session: requests.Session, url: str, part_path: Path, start: int, end: int
+):
+    """
+    Writes the bytes from `start` to `end` included of `url` at the same offsets of
+    the partial file, retrying on connection errors.
+    """
+    for attempt in range(CHUNK_RETRIES):
+        try:
+            response = session.get(
+                url,
+                headers={"Range": f"bytes={start}-{end}"},
+                stream=True,
+                timeout=TIMEOUT,
+            )
+            with response:
+                response.raise_for_status()
+                if response.status_code != 206:
+                    raise requests.HTTPError(
+                        f"Range request not honoured for {url}", response=response
+                    )
+                with open(part_path, "r+b") as part_file:
+                    part_file.seek(start)
+                    written = 0
+                    for data in response.iter_content(READ_SIZE):
+                        part_file.write(data)
+                        written += len(data)
+            metrics.count_bytes("download", written)
+            if written != end - start + 1:
+                raise requests.ConnectionError(
+                    f"Chunk {start}-{end} of {url} truncated after {written} bytes"
+                )
+            return
+        except _RETRIED_ERRORS:
+            if attempt == CHUNK_RETRIES - 1:
+                raise
+
+
+def _download_stream(session: requests.Session, url: str, part_path: Path):
+    response = session.get(url, stream=True, timeout=TIMEOUT)
+    with response:
+        response.raise_for_status()
+        with open(part_path, "wb") as part_file:
+            for data in response.iter_content(READ_SIZE):
+                part_file.write(data)
+                metrics.count_bytes("download", len(data))
+
 
-    downloaded_file_path = result.downloaded[latest_product_id]["path"]
+def file_md5(path: Path) -> str:
+    md5 = hashlib.md5()
+    with open(path, "rb") as file:
+        for data in iter(lambda: file.read(READ_SIZE), b""):
+            md5.update(data)
+    return md5.hexdigest()
 
-    return Path(downloaded_file_path)
+
+def download_file(
+    session: requests.Session,
+    url: str,
+    path: Path,
+    size: int,
+    md5: Optional[str] = None,
+    connections: int = CONNECTIONS,
+    chunk_size: int = CHUNK_SIZE,
+) -> Path:
+    """
+    Downloads `url` to `path`, resuming from a previous partial download.
+
+    Parameters
+    ----------
+    session: requests.Session
+        Session holding the credentials of the server.
+    url: str
+        URL of the file, its server should support range requests.
+    path: Path
+        Path of the downloaded file, written to `path.part` until it is complete.
+    size: int
+        Size of the file in bytes.
+    md5: str
+        MD5 checksum of the file, not checked when None.
+    connections: int
+        Number of chunks downloaded at once.
+    chunk_size: int
+        Size of the chunks in bytes.
+    """
+    part_path = path.with_name(path.name + ".part")
+    chunks_path = path.with_name(path.name + ".chunks")
+    chunks = [
+        (start, min(start + chunk_size, size) - 1)
+        for start in range(0, size, chunk_size)
+    ]
+
+    if chunks and _supports_ranges(session, url):
+        done = _read_done_chunks(chunks_path) if part_path.exists() else set()
+        if not part_path.exists() or part_path.stat().st_size != size:
+            done = set()
+            with open(part_path, "wb") as part_file:
+                part_file.truncate(size)
+        lock = threading.Lock()
+
+        def download_chunk(index: int):
+            _download_chunk(session, url, part_path, *chunks[index])
+            with lock:
+                done.add(index)
+                chunks_path.write_text(json.dumps(sorted(done)))
+
+        remaining = [index for index in range(len(chunks)) if index not in done]
+        if len(remaining) < len(chunks):
+            print(f"Resuming download of {path.name}, {len(done)} chunks done")
+        with ThreadPoolExecutor(max_workers=max(connections, 1)) as executor:
+            # Consumes the results to raise the first error
+            list(executor.map(download_chunk, remaining))
+    else:
+        _download_stream(session, url, part_path)
+
+    if md5 is not None and file_md5(part_path).lower() != md5.lower():
+        part_path.unlink()
+        chunks_path.unlink(missing_ok=True)
+        raise InvalidChecksumError(f"File {path.name} does not match its checksum.")
+
+    os.replace(part_path, path)
+    chunks_path.unlink(missing_ok=True)
+    return path
+
+
+def download_sentinel_product(
+    api: SentinelAPI, product_id: str, directory_path: str = "Data/"
+) -> Path:
+    with _download_slots:
+        product = api.get_product_odata(product_id)
+        if not product.get("Online", True):
+            # Archived products are first retrieved by the hub, sentinelsat waits for
+            # them
+            result = api.download_all([product_id], directory_path=directory_path)
+            if product_id not in result.downloaded:
+                raise FileNotFoundError(
+                    f"Error while downloading product {product_id}."
+                )
+            return Path(result.downloaded[product_id]["path"])
+
+        path = Path(directory_path) / f"{product['title']}.zip"
+        if path.exists():
+            return path
+        path.parent.mkdir(parents=True, exist_ok=True)
+        print(f"Downloading {path.name} ({product['size'] / 1024**2:.0f} MB)")
+        return download_file(
+            api.session, product["url"], path, product["size"], product.get("md5")
+        )
@@ -2,12 +2,30 @@
 Extract ship coordinates from SENTINEL-1 data files
 """
 import contextlib
+import math
 import time
 from pathlib import Path
+from typing import List
+from typing import NamedTuple
+from typing import Optional
 
+from geo_helper import BoundingBox
 from snapista import Graph
 from snapista import Operator
 
+# Areas larger than a window are split, windows are processed in parallel
+WINDOW_SIZE = 1.0  # degrees
+# Margin around each window, wider than the background window of the thresholding
+# and the largest target, so that detections of the window core are not affected by
+# its edges
+WINDOW_OVERLAP = 0.02  # degrees
+
+
+class Window(NamedTuple):
+    # Detections are only kept inside the core, cores of a region do not overlap
+    core: BoundingBox
+    region: BoundingBox
+
 
 @contextlib.contextmanager
 def timer(operation_name: str):
@@ -43,7 +61,33 @@ def add_write_node(graph_l: Graph, output_filename: Path):
     )
 
 
-def add_land_sea_mask(graph_l: Graph):
+def bbox_to_wkt(bbox: BoundingBox) -> str:
+    corners = [
+        (bbox.min_longitude, bbox.min_latitude),
+        (bbox.max_longitude, bbox.min_latitude),
+        (bbox.max_longitude, bbox.max_latitude),
+        (bbox.min_longitude, bbox.max_latitude),
+        (bbox.min_longitude, bbox.min_latitude),
+    ]
+    return f"POLYGON(({', '.join(f'{lon} {lat}' for lon, lat in corners)}))"
+
+
+def add_subset_node(graph_l: Graph, region: BoundingBox):
+    graph_l.add_node(
+        operator=Operator(
+            "Subset",
+            geoRegion=bbox_to_wkt(region),
+            subSamplingX=1,
+            subSamplingY=1,
+            fullSwath="false",
+            copyMetadata="true",
+        ),
+        node_id="subset",
+        source="read",
+    )
+
+
+def add_land_sea_mask(graph_l: Graph, source: str = "read"):
     graph_l.add_node(
         operator=Operator(
             "Land-Sea-Mask",
@@ -53,7 +97,7 @@ def add_land_sea_mask(graph_l: Graph):
             shorelineExtension=10,
         ),
         node_id="land_sea_mask",
-        source="read",
+        source=source,
     )
 
 
@@ -102,18 +146,66 @@ def add_object_discrimination(graph_l: Graph):
     )
 
 
-def add_preprocessing(graph_l: Graph):
-    add_land_sea_mask(graph_l)
+def add_preprocessing(graph_l: Graph, source: str = "read"):
+    add_land_sea_mask(graph_l, source)
     add_calibration(graph_l)
     add_adaptive_thresholding(graph_l)
     add_object_discrimination(graph_l)
 
 
-def process(filename: Path):
+def split_region(
+    region: BoundingBox,
+    window_size: float = WINDOW_SIZE,
+    overlap: float = WINDOW_OVERLAP,
+) -> List[Window]:
+    """
+    Splits a region in a grid of windows of at most `window_size` degrees, extended
+    by `overlap` on every side.
+    """
+    columns = max(
+        math.ceil((region.max_longitude - region.min_longitude) / window_size), 1
+    )
+    rows = max(math.ceil((region.max_latitude - region.min_latitude) / window_size), 1)
+    width = (region.max_longitude - region.min_longitude) / columns
+    height = (region.max_latitude - region.min_latitude) / rows
+
+    windows = []
+    for row in range(rows):
+        for column in range(columns):
+            core = BoundingBox(
+                region.min_longitude + column * width,
+                region.min_latitude + row * height,
+                region.min_longitude + (column + 1) * width,
+                region.min_latitude + (row + 1) * height,
+            )
+            windows.append(
+                Window(
+                    core,
+                    BoundingBox(
+                        core.min_longitude - overlap,
+                        core.min_latitude - overlap,
+                        core.max_longitude + overlap,
+                        core.max_latitude + overlap,
+                    ),
+                )
+            )
+    return windows
+
+
+def process(
+    filename: Path,
+    output_path: Optional[Path] = None,
+    region: Optional[BoundingBox] = None,
+):
+    """
+    Runs the detection graph on a product, or only on `region` of it.
+    Outputs are written to `output_path`, next to the product by default.
+    """
     if not filename.exists():
         raise FileNotFoundError(filename)
 
-    output_path = filename.with_suffix(".dim")
+    if output_path is None:
+        output_path = filename.with_suffix(".dim")
 
     if output_path.exists():
         raise ValueError("Result already exists.")
@@ -121,7 +213,11 @@ def process(filename: Path):
     graph = Graph()
 
     add_read_node(graph, filename)
-    add_preprocessing(graph)
+    if region is None:
+        add_preprocessing(graph)
+    else:
+        add_subset_node(graph, region)
+        add_preprocessing(graph, source="subset")
     add_write_node(graph, output_path)
 
     with timer("Graph execution"):
@@ -0,0 +1,61 @@
+"""
+Reads the FlatGeobuf encoding back with GDAL, through pyogrio. Skipped when either
+pyogrio or flatbuffers is not installed.
+"""
+import datetime
+import math
+import struct
+
+import binary_formats
+import pytest
+
+pyogrio = pytest.importorskip("pyogrio")
+pytest.importorskip("flatbuffers")
+
+COLUMNS = {
+    "id": [1, 2, 3],
+    "tile_dataset": ["S1A_first", "S1A_first", "S1B_second"],
+    "width": [12.5, None, 30.0],
+    "length": [80.25, 45.0, None],
+    "latitude": [1.25, -3.5, None],
+    "longitude": [103.75, 12.0, None],
+    "pixel_x": [10, 2000, 7],
+    "pixel_y": [-1, 35, 9],
+    "acquisition_time": [
+        datetime.datetime(2023, 1, 2, 3, 4, 5),
+        datetime.datetime(2023, 1, 2, 3, 4, 5, 250000),
+        datetime.datetime(2023, 1, 3),
+    ],
+}
+
+
+def test_flatgeobuf_round_trip(tmp_path):
+    path = tmp_path / "detections.fgb"
+    path.write_bytes(binary_formats.encode_flatgeobuf(COLUMNS))
+
+    info = pyogrio.read_info(path)
+    assert info["layer_name"] == "detections"
+    assert info["crs"] == "EPSG:4326"
+    assert info["geometry_type"] == "Point"
+    assert info["features"] == 3
+    assert info["total_bounds"] == (12.0, -3.5, 103.75, 1.25)
+
+    meta, _, geometries, fields = pyogrio.raw.read(path)
+    values = dict(zip(meta["fields"], fields))
+    for name in ("id", "tile_dataset", "pixel_x", "pixel_y"):
+        assert values[name].tolist() == COLUMNS[name]
+    # Null values are read back as NaN
+    for name in ("width", "length"):
+        assert [
+            None if math.isnan(value) else value for value in values[name].tolist()
+        ] == COLUMNS[name]
+    assert values["acquisition_time"].astype(datetime.datetime).tolist() == (
+        COLUMNS["acquisition_time"]
+    )
+
+    # Points are read as little-endian WKB: byte order, type, then x and y
+    positions = [
+        None if geometry is None else struct.unpack("<dd", geometry[5:])
+        for geometry in geometries
+    ]
+    assert positions == [(103.75, 1.25), (12.0, -3.5), None]
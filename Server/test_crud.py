@@ -0,0 +1,79 @@
+"""
+Reports the coverage of requests by the ingested tiles, on an in-memory database.
+"""
+from datetime import date
+from datetime import datetime
+
+import crud
+import pytest
+from database import Base
+from models import CatalogueProduct
+from models import Tile
+from models import tiles_rtree
+from sqlalchemy import create_engine
+from sqlalchemy import insert
+from sqlalchemy.orm import sessionmaker
+
+SQUARE = {
+    "type": "FeatureCollection",
+    "features": [
+        {
+            "type": "Feature",
+            "properties": {},
+            "geometry": {
+                "type": "Polygon",
+                "coordinates": [[[0, 0], [2, 0], [2, 2], [0, 2], [0, 0]]],
+            },
+        }
+    ],
+}
+
+
+@pytest.fixture
+def db():
+    engine = create_engine("sqlite://")
+    Base.metadata.create_all(engine)
+    session = sessionmaker(bind=engine)()
+    yield session
+    session.close()
+
+
+def add_tile(db, dataset: str):
+    db.add(Tile(dataset=dataset, acquisition_time=datetime(2023, 1, 10)))
+    db.flush()
+    db.execute(
+        insert(tiles_rtree).values(
+            min_longitude=0.0,
+            min_latitude=0.0,
+            max_longitude=2.0,
+            max_latitude=2.0,
+            dataset=dataset,
+        )
+    )
+    db.commit()
+
+
+def test_coverage_of_tile_bounding_box(db):
+    add_tile(db, "S1A_WHOLE")
+
+    coverage = crud.get_coverage(db, SQUARE, date(2023, 1, 1), date(2023, 1, 31))
+    assert coverage["covered_fraction"] == 1.0
+    assert coverage["days"] == [
+        {"date": "2023-01-10", "covered_fraction": 1.0, "tiles": ["S1A_WHOLE"]}
+    ]
+
+
+def test_coverage_clipped_to_product_footprint(db):
+    # Tile of a region of a tilted swath, only covering half of its bounding box
+    add_tile(db, "S1A_TILTED_0123abcd")
+    db.add(
+        CatalogueProduct(
+            id="tilted",
+            title="S1A_TILTED",
+            footprint="POLYGON((-1 -1,3 3,3 -1,-1 -1))",
+        )
+    )
+    db.commit()
+
+    coverage = crud.get_coverage(db, SQUARE, date(2023, 1, 1), date(2023, 1, 31))
+    assert 0.4 < coverage["covered_fraction"] < 0.6
@@ -0,0 +1,92 @@
+"""
+Finds the finished jobs covering a request, on an in-memory database.
+"""
+import json
+from datetime import date
+from datetime import datetime
+
+import jobs
+import pytest
+from database import Base
+from models import Job
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+
+def square(min_longitude, min_latitude, max_longitude, max_latitude):
+    return {
+        "type": "FeatureCollection",
+        "features": [
+            {
+                "type": "Feature",
+                "properties": {},
+                "geometry": {
+                    "type": "Polygon",
+                    "coordinates": [
+                        [
+                            [min_longitude, min_latitude],
+                            [max_longitude, min_latitude],
+                            [max_longitude, max_latitude],
+                            [min_longitude, max_latitude],
+                            [min_longitude, min_latitude],
+                        ]
+                    ],
+                },
+            }
+        ],
+    }
+
+
+@pytest.fixture
+def db():
+    engine = create_engine("sqlite://")
+    Base.metadata.create_all(engine)
+    session = sessionmaker(bind=engine)()
+    yield session
+    session.close()
+
+
+def add_done_job(db, geo_dict, start_date, end_date) -> Job:
+    job = Job(
+        request_key=jobs.request_key(geo_dict, start_date, end_date),
+        request=json.dumps(geo_dict),
+        start_date=start_date,
+        end_date=end_date,
+        status=jobs.DONE,
+        result=json.dumps({"failed": {}}),
+        submitted_time=datetime(2023, 2, 1),
+        finished_time=datetime(2023, 2, 1),
+    )
+    db.add(job)
+    db.commit()
+    return job
+
+
+def test_same_polygon_over_wider_dates(db):
+    job = add_done_job(db, square(0, 0, 2, 2), date(2023, 1, 1), date(2023, 1, 31))
+
+    covering_job = jobs.find_covering_job(
+        db, square(0, 0, 2, 2), date(2023, 1, 10), date(2023, 1, 20)
+    )
+    assert covering_job is not None and covering_job.id == job.id
+
+
+def test_contained_polygon_sharing_edges(db):
+    job = add_done_job(db, square(0, 0, 2, 2), date(2023, 1, 1), date(2023, 1, 31))
+
+    # Shares the right and top edges, on which ray casting leaves points outside
+    covering_job = jobs.find_covering_job(
+        db, square(1, 1, 2, 2), date(2023, 1, 1), date(2023, 1, 31)
+    )
+    assert covering_job is not None and covering_job.id == job.id
+
+
+def test_overlapping_polygon(db):
+    add_done_job(db, square(0, 0, 2, 2), date(2023, 1, 1), date(2023, 1, 31))
+
+    assert (
+        jobs.find_covering_job(
+            db, square(1, 1, 3, 2), date(2023, 1, 1), date(2023, 1, 31)
+        )
+        is None
+    )
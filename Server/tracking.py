@@ -0,0 +1,256 @@
+"""
+Association of the detections of a new tile to the tracks of the previous tiles.
+A detection extends the track whose predicted position is nearest, among those it
+could have reached and of a similar size. Tracks of a single detection may have gone
+anywhere within `MAX_SPEED`, longer ones are expected to keep their last velocity.
+Pairs are matched greedily by increasing cost, each track and detection at most once.
+Tracks are looked up in a grid of cells sized after their density, in the rings of
+cells around each detection holding its nearest tracks, and only the
+`MAX_CANDIDATES` nearest ones within their gate are compared: the cost only depends
+on the new detections and the tracks ending around them, never on the history.
+"""
+import math
+from datetime import timedelta
+from typing import Dict
+from typing import List
+from typing import NamedTuple
+from typing import Tuple
+
+import numpy as np
+
+MAX_SPEED = 25.0  # knots
+KNOT = 1.852  # km/h
+# Tracks not extended for longer are closed
+TIME_WINDOW = timedelta(hours=12)
+# Relative difference of length and width between two detections of a vessel
+MAX_SIZE_DIFFERENCE = 0.5
+# Gate around the position predicted from the velocity of a track, as a fraction of
+# the distance at `MAX_SPEED`, and its minimum in km
+PREDICTION_GATE = 0.25
+MIN_PREDICTION_GATE = 2.0
+# Bounds of the size of the cells of the grid of tracks in km, and number of tracks
+# compared to each detection
+MIN_CELL_SIZE = 0.25
+MAX_CELL_SIZE = 50.0
+MAX_CANDIDATES = 16
+EARTH_RADIUS = 6371.0  # km
+KM_PER_DEGREE = math.pi * EARTH_RADIUS / 180.0
+
+
+class Points(NamedTuple):
+    longitudes: np.ndarray
+    latitudes: np.ndarray
+    lengths: np.ndarray
+    widths: np.ndarray
+
+
+def max_gate(elapsed_hours):
+    """
+    Distance in km a vessel may travel in `elapsed_hours`.
+    """
+    return MAX_SPEED * KNOT * elapsed_hours
+
+
+def distances(
+    longitude: float, latitude: float, longitudes: np.ndarray, latitudes: np.ndarray
+) -> np.ndarray:
+    """
+    Haversine distances in km from one position to many.
+    """
+    longitude, latitude = math.radians(longitude), math.radians(latitude)
+    longitudes, latitudes = np.radians(longitudes), np.radians(latitudes)
+    a = (
+        np.sin((latitudes - latitude) / 2) ** 2
+        + math.cos(latitude)
+        * np.cos(latitudes)
+        * np.sin((longitudes - longitude) / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))
+
+
+def _size_differences(size: float, sizes: np.ndarray) -> np.ndarray:
+    largest = np.maximum(np.maximum(sizes, size), 1e-9)
+    differences = np.abs(sizes - size) / largest
+    # Unknown sizes never prevent a match
+    return np.where(np.isnan(differences), 0.0, differences)
+
+
+def predict(
+    tracks: Points,
+    velocities_east: np.ndarray,
+    velocities_north: np.ndarray,
+    elapsed_hours: np.ndarray,
+) -> Tuple[Points, np.ndarray]:
+    """
+    Returns the positions of the tracks after `elapsed_hours` at their velocity in
+    km/h, NaN when unknown, and the gate in km around each of them.
+    """
+    known = ~(np.isnan(velocities_east) | np.isnan(velocities_north))
+    velocities_east = np.where(known, velocities_east, 0.0)
+    velocities_north = np.where(known, velocities_north, 0.0)
+    # Noisy positions give unrealistic velocities, vessels are not faster than
+    # `MAX_SPEED`
+    speeds = np.hypot(velocities_east, velocities_north)
+    scale = np.minimum(max_gate(1.0) / np.maximum(speeds, 1e-9), 1.0)
+    north = velocities_north * scale * elapsed_hours
+    east = velocities_east * scale * elapsed_hours
+    latitudes = tracks.latitudes + north / KM_PER_DEGREE
+    longitudes = tracks.longitudes + east / (
+        KM_PER_DEGREE * np.cos(np.radians(np.clip(tracks.latitudes, -85.0, 85.0)))
+    )
+    gates = np.where(
+        known,
+        np.maximum(PREDICTION_GATE * max_gate(elapsed_hours), MIN_PREDICTION_GATE),
+        max_gate(elapsed_hours),
+    )
+    return Points(longitudes, latitudes, tracks.lengths, tracks.widths), gates
+
+
+def velocity(
+    longitude: float,
+    latitude: float,
+    previous_longitude: float,
+    previous_latitude: float,
+    elapsed_hours: float,
+) -> Tuple[float, float]:
+    """
+    Returns the east and north velocity in km/h between two positions.
+    """
+    east = (
+        (longitude - previous_longitude)
+        * KM_PER_DEGREE
+        * math.cos(math.radians(previous_latitude))
+    )
+    north = (latitude - previous_latitude) * KM_PER_DEGREE
+    return east / elapsed_hours, north / elapsed_hours
+
+
+def _grid(
+    points: Points, cell_width: float, cell_height: float
+) -> Dict[Tuple[int, int], List[int]]:
+    """
+    Returns the indices of the points in each non-empty cell of a grid, in degrees.
+    """
+    cells: Dict[Tuple[int, int], List[int]] = {}
+    for index, cell in enumerate(
+        zip(
+            np.floor(points.longitudes / cell_width).astype(np.int64).tolist(),
+            np.floor(points.latitudes / cell_height).astype(np.int64).tolist(),
+        )
+    ):
+        cells.setdefault(cell, []).append(index)
+    return cells
+
+
+def associate(
+    detections: Points, tracks: Points, gates: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Returns the index of the track extended by each detection, -1 when it starts a
+    new track, and the distance in km to the predicted position of that track.
+    `gates` is the distance in km around each track a detection may be matched in,
+    given the time elapsed since its end.
+    """
+    matches = np.full(len(detections.longitudes), -1)
+    matched_distances = np.full(len(detections.longitudes), np.nan)
+    if not len(detections.longitudes) or not len(tracks.longitudes):
+        return matches, matched_distances
+
+    # Longitude degrees shrink with the latitude, cells are sized for the highest one
+    # so that they are at least `cell_size` wide everywhere
+    highest_latitude = min(
+        max(np.abs(detections.latitudes).max(), np.abs(tracks.latitudes).max()), 85.0
+    )
+    longitude_km = KM_PER_DEGREE * math.cos(math.radians(highest_latitude))
+    # Cells hold about `MAX_CANDIDATES` tracks where tracks are evenly spread, and
+    # are split until the densest ones, e.g. around ports, are not much fuller
+    area = max(
+        np.ptp(tracks.longitudes)
+        * longitude_km
+        * np.ptp(tracks.latitudes)
+        * KM_PER_DEGREE,
+        1e-6,
+    )
+    cell_size = min(
+        max(math.sqrt(area * MAX_CANDIDATES / len(tracks.longitudes)), MIN_CELL_SIZE),
+        MAX_CELL_SIZE,
+    )
+    while True:
+        cell_height = cell_size / KM_PER_DEGREE
+        cell_width = cell_size / longitude_km
+        cells = _grid(tracks, cell_width, cell_height)
+        densest = max(len(indices) for indices in cells.values())
+        if densest <= 4 * MAX_CANDIDATES or cell_size <= MIN_CELL_SIZE:
+            break
+        cell_size = max(cell_size / 2, MIN_CELL_SIZE)
+    # Rings of cells around a detection holding every track it may reach
+    max_ring = math.ceil(max(float(gates.max()), 1e-6) / cell_size)
+
+    cell_xs = np.array([x for x, _ in cells], dtype=np.int64)
+    cell_ys = np.array([y for _, y in cells], dtype=np.int64)
+    cell_tracks = [np.array(indices) for indices in cells.values()]
+    cell_counts = np.array([len(indices) for indices in cell_tracks])
+
+    pairs = []
+    for index, (longitude, latitude, length, width) in enumerate(
+        zip(
+            detections.longitudes.tolist(),
+            detections.latitudes.tolist(),
+            detections.lengths.tolist(),
+            detections.widths.tolist(),
+        )
+    ):
+        x, y = math.floor(longitude / cell_width), math.floor(latitude / cell_height)
+        rings = np.maximum(np.abs(cell_xs - x), np.abs(cell_ys - y))
+        reachable = rings <= max_ring
+        if not reachable.any():
+            continue
+        # Nearest rings holding `MAX_CANDIDATES` tracks, and the next one which may
+        # hold nearer tracks than their corners
+        counts = np.cumsum(
+            np.bincount(rings[reachable], weights=cell_counts[reachable])
+        )
+        ring = min(int(np.searchsorted(counts, MAX_CANDIDATES)) + 1, max_ring)
+        candidates = np.concatenate(
+            [cell_tracks[cell] for cell in np.flatnonzero(rings <= ring).tolist()]
+        )
+
+        candidate_distances = distances(
+            longitude,
+            latitude,
+            tracks.longitudes[candidates],
+            tracks.latitudes[candidates],
+        )
+        length_differences = _size_differences(length, tracks.lengths[candidates])
+        width_differences = _size_differences(width, tracks.widths[candidates])
+        gated = np.flatnonzero(
+            (candidate_distances <= gates[candidates])
+            & (length_differences <= MAX_SIZE_DIFFERENCE)
+            & (width_differences <= MAX_SIZE_DIFFERENCE)
+        )
+        # Only the nearest tracks are compared
+        gated = gated[np.argsort(candidate_distances[gated], kind="stable")][
+            :MAX_CANDIDATES
+        ]
+        costs = (
+            candidate_distances[gated] / np.maximum(gates[candidates[gated]], 1e-6)
+            + length_differences[gated]
+            + width_differences[gated]
+        )
+        pairs += [
+            (cost, index, track, distance)
+            for cost, track, distance in zip(
+                costs.tolist(),
+                candidates[gated].tolist(),
+                candidate_distances[gated].tolist(),
+            )
+        ]
+
+    matched_tracks = set()
+    for _, index, track, distance in sorted(pairs):
+        if matches[index] != -1 or track in matched_tracks:
+            continue
+        matches[index] = track
+        matched_distances[index] = distance
+        matched_tracks.add(track)
+    return matches, matched_distances
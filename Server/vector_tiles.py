@@ -0,0 +1,234 @@
+"""
+Mapbox Vector Tiles (version 2) of points, and an in-memory cache of encoded tiles.
+Only the few protobuf messages needed by point layers are encoded, by hand.
+See https://github.com/mapbox/vector-tile-spec/tree/master/2.1
+"""
+import math
+import os
+import struct
+import threading
+from collections import OrderedDict
+from typing import Dict
+from typing import Hashable
+from typing import Iterable
+from typing import List
+from typing import NamedTuple
+from typing import Optional
+from typing import Tuple
+from typing import Union
+
+from geo_helper import BoundingBox
+from geo_helper import MAX_MERCATOR_LATITUDE
+from geo_helper import tile_to_bbox
+from response_cache import make_etag
+
+EXTENT = 4096
+MEDIA_TYPE = "application/vnd.mapbox-vector-tile"
+MAX_SIZE = int(float(os.environ.get("BOATMAN_TILE_CACHE_MB", "128")) * 1024**2)
+
+PropertyValue = Union[str, int, float, bool]
+
+# Wire types
+_VARINT = 0
+_FIXED64 = 1
+_LENGTH_DELIMITED = 2
+
+_POINT = 1
+_MOVE_TO_ONE_POINT = (1 & 0x7) | (1 << 3)
+
+
+class PointFeature(NamedTuple):
+    longitude: float
+    latitude: float
+    properties: Dict[str, PropertyValue]
+    id: Optional[int] = None
+
+
+def _varint(value: int) -> bytes:
+    encoded = bytearray()
+    while value > 0x7F:
+        encoded.append((value & 0x7F) | 0x80)
+        value >>= 7
+    encoded.append(value)
+    return bytes(encoded)
+
+
+def _zigzag(value: int) -> int:
+    return (value << 1) ^ (value >> 63)
+
+
+def _key(field: int, wire_type: int) -> bytes:
+    return _varint((field << 3) | wire_type)
+
+
+def _message(field: int, payload: bytes) -> bytes:
+    return _key(field, _LENGTH_DELIMITED) + _varint(len(payload)) + payload
+
+
+def _packed(field: int, values: Iterable[int]) -> bytes:
+    return _message(field, b"".join(_varint(value) for value in values))
+
+
+def _value(value: PropertyValue) -> bytes:
+    if isinstance(value, bool):
+        payload = _key(7, _VARINT) + _varint(int(value))
+    elif isinstance(value, int):
+        payload = _key(6, _VARINT) + _varint(_zigzag(value))
+    elif isinstance(value, float):
+        payload = _key(3, _FIXED64) + struct.pack("<d", value)
+    else:
+        payload = _message(1, str(value).encode())
+    return payload
+
+
+def _tile_position(
+    longitude: float, latitude: float, z: int, x: int, y: int, extent: int
+) -> Tuple[int, int]:
+    number_of_tiles = 1 << z
+    latitude = max(min(latitude, MAX_MERCATOR_LATITUDE), -MAX_MERCATOR_LATITUDE)
+    world_x = (longitude + 180.0) / 360.0 * number_of_tiles
+    world_y = (
+        (1.0 - math.asinh(math.tan(math.radians(latitude))) / math.pi)
+        / 2.0
+        * number_of_tiles
+    )
+    return round((world_x - x) * extent), round((world_y - y) * extent)
+
+
+def encode_layer(
+    name: str,
+    features: Iterable[PointFeature],
+    z: int,
+    x: int,
+    y: int,
+    extent: int = EXTENT,
+) -> bytes:
+    """
+    Encodes a layer of points of the tile (z, x, y), as a field of the Tile message.
+    """
+    keys: Dict[str, int] = {}
+    values: Dict[Tuple[type, PropertyValue], int] = {}
+    encoded_features: List[bytes] = []
+
+    for feature in features:
+        tags = []
+        for key, value in feature.properties.items():
+            if value is None:
+                continue
+            tags.append(keys.setdefault(key, len(keys)))
+            # 1 and True are equal, the type keeps them apart
+            tags.append(values.setdefault((type(value), value), len(values)))
+
+        position_x, position_y = _tile_position(
+            feature.longitude, feature.latitude, z, x, y, extent
+        )
+        encoded = b""
+        if feature.id is not None:
+            encoded += _key(1, _VARINT) + _varint(feature.id)
+        if tags:
+            encoded += _packed(2, tags)
+        encoded += _key(3, _VARINT) + _varint(_POINT)
+        encoded += _packed(
+            4, (_MOVE_TO_ONE_POINT, _zigzag(position_x), _zigzag(position_y))
+        )
+        encoded_features.append(_message(2, encoded))
+
+    layer = (
+        _key(15, _VARINT)
+        + _varint(2)
+        + _message(1, name.encode())
+        + b"".join(encoded_features)
+        + b"".join(_message(3, key.encode()) for key in keys)
+        + b"".join(_message(4, _value(value)) for _, value in values)
+        + _key(5, _VARINT)
+        + _varint(extent)
+    )
+    return _message(3, layer)
+
+
+def encode_tile(layers: Iterable[bytes]) -> bytes:
+    return b"".join(layers)
+
+
+class CachedTile(NamedTuple):
+    content: bytes
+    etag: str
+
+
+def make_cached_tile(content: bytes) -> CachedTile:
+    return CachedTile(content, make_etag(content))
+
+
+def _intersects(first: BoundingBox, second: BoundingBox) -> bool:
+    return (
+        first.min_longitude <= second.max_longitude
+        and second.min_longitude <= first.max_longitude
+        and first.min_latitude <= second.max_latitude
+        and second.min_latitude <= first.max_latitude
+    )
+
+
+class TileKey(NamedTuple):
+    layer: str
+    z: int
+    x: int
+    y: int
+    # Any parameter of the query, e.g. its dates
+    parameters: Tuple[Hashable, ...] = ()
+
+
+class TileCache:
+    """
+    Least recently used cache of encoded tiles, bounded by the size of their content.
+    Each invalidation bumps the version of the cache: tiles computed from a version
+    read before it are not stored, they may predate the ingestion.
+    """
+
+    def __init__(self, max_size: int = MAX_SIZE):
+        self.max_size = max_size
+        self.size = 0
+        self.version = 0
+        self.tiles: "OrderedDict[TileKey, CachedTile]" = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key: TileKey) -> Optional[CachedTile]:
+        with self.lock:
+            tile = self.tiles.get(key)
+            if tile is not None:
+                self.tiles.move_to_end(key)
+            return tile
+
+    def put(self, key: TileKey, tile: CachedTile, version: int) -> bool:
+        """
+        Stores a tile computed after reading `version`, returns whether it was stored.
+        """
+        if len(tile.content) > self.max_size:
+            return False
+        with self.lock:
+            if version != self.version:
+                return False
+            previous = self.tiles.pop(key, None)
+            if previous is not None:
+                self.size -= len(previous.content)
+            self.tiles[key] = tile
+            self.size += len(tile.content)
+            while self.size > self.max_size:
+                _, evicted = self.tiles.popitem(last=False)
+                self.size -= len(evicted.content)
+            return True
+
+    def invalidate(self, layer: str, bbox: BoundingBox) -> int:
+        """
+        Drops the tiles of `layer` intersecting `bbox`, returns how many were dropped.
+        """
+        with self.lock:
+            self.version += 1
+            stale = [
+                key
+                for key in self.tiles
+                if key.layer == layer
+                and _intersects(tile_to_bbox(key.x, key.y, key.z), bbox)
+            ]
+            for key in stale:
+                self.size -= len(self.tiles.pop(key).content)
+            return len(stale)
@@ -1,58 +1,100 @@
+"""
+Publish/subscribe hub of the WebSocket clients.
+Publishing only puts the message in the bounded queue of each client, which is
+drained by its own sender task: a slow client never delays the others, and it is
+dropped once its queue is full.
+"""
 import asyncio
-from dataclasses import dataclass
-from typing import Callable
-from typing import List
+from typing import Dict
+from typing import Optional
 
 from fastapi import WebSocket
 
+SEND_QUEUE_SIZE = 64
+SEND_TIMEOUT = 10.0  # seconds
+# Close code asking the client to reconnect later
+TRY_AGAIN_LATER = 1013
 
-@dataclass
-class WebSocketAndId:
-    socket: WebSocket
-    id: int
+
+class Client:
+    def __init__(self, socket: WebSocket, client_id: int, queue_size: int):
+        self.socket = socket
+        self.id = client_id
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self.sender: Optional[asyncio.Task] = None
 
 
 class ConnectionManager:
-    is_blocking: bool = False
+    def __init__(
+        self, queue_size: int = SEND_QUEUE_SIZE, send_timeout: float = SEND_TIMEOUT
+    ):
+        self.clients: Dict[int, Client] = {}
+        self.queue_size = queue_size
+        self.send_timeout = send_timeout
 
-    def __init__(self):
-        self.active_connections: List[WebSocketAndId] = []
+    async def shutdown(self):
+        clients = list(self.clients.values())
+        self.clients.clear()
+        await asyncio.gather(*(self._close(client) for client in clients))
 
-    async def connect(self, websocket: WebSocket, socket_id: int):
+    async def connect(self, websocket: WebSocket, client_id: int):
         await websocket.accept()
-        self.active_connections.append(WebSocketAndId(websocket, socket_id))
 
-    def disconnect(self, websocket: WebSocket, socket_id: int):
-        self.active_connections.remove(WebSocketAndId(websocket, socket_id))
+        # A client reconnecting with the same ID replaces its previous socket
+        previous = self.clients.get(client_id)
+        if previous is not None:
+            self._drop(previous)
 
-    def unblock_clients(self):
-        self.is_blocking = False
-        self.broadcast("unblock")
+        client = Client(websocket, client_id, self.queue_size)
+        client.sender = asyncio.create_task(self._send_messages(client))
+        self.clients[client_id] = client
 
-    def block_clients(self):
-        self.is_blocking = True
-        self.broadcast("block")
+    def disconnect(self, websocket: WebSocket, client_id: int):
+        client = self.clients.get(client_id)
+        if client is not None and client.socket is websocket:
+            del self.clients[client_id]
+            if client.sender is not None:
+                client.sender.cancel()
 
-    async def awaitable_block_clients(self):
-        self.is_blocking = True
-        for connection in self.active_connections:
-            await connection.socket.send_text("block")
+    async def _send_messages(self, client: Client):
+        while True:
+            message = await client.queue.get()
+            try:
+                await asyncio.wait_for(
+                    client.socket.send_text(message), self.send_timeout
+                )
+            except Exception as exception:
+                print(f"Dropping client with ID({client.id}): {exception!r}")
+                self._drop(client)
+                return
 
-    # notice: changed from async to sync as background tasks mess up with async functions
-    # https://stackoverflow.com/questions/73707373/how-to-return-the-result-of-backgroundtasks-as-websocket-answer-in-fastapi
-    def send_text_to_client(
-        self, client_id: int, message: str, on_no_client_found: Callable
-    ):
-        for socket_and_id in self.active_connections:
-            if socket_and_id.id == client_id:
-                #
-                loop = asyncio.new_event_loop()
-                asyncio.set_event_loop(loop)
+    def _drop(self, client: Client):
+        if self.clients.get(client.id) is client:
+            del self.clients[client.id]
+        asyncio.create_task(self._close(client))
 
-                loop.run_until_complete(socket_and_id.socket.send_text(message))
-                return
-        on_no_client_found(client_id, message)
+    async def _close(self, client: Client):
+        if client.sender is not None:
+            client.sender.cancel()
+        try:
+            await client.socket.close(code=TRY_AGAIN_LATER)
+        except Exception:
+            # Already closed by the client
+            pass
+
+    def _publish(self, client: Client, message: str) -> bool:
+        try:
+            client.queue.put_nowait(message)
+        except asyncio.QueueFull:
+            print(f"Dropping slow client with ID({client.id})")
+            self._drop(client)
+            return False
+        return True
+
+    async def send_to_client(self, client_id: int, message: str) -> bool:
+        client = self.clients.get(client_id)
+        return client is not None and self._publish(client, message)
 
-    def broadcast(self, message: str):
-        for connection in self.active_connections:
-            self.send_text_to_client(connection.id, message, lambda x: None)
+    async def send_to_all(self, message: str):
+        for client in list(self.clients.values()):
+            self._publish(client, message)